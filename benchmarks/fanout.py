@@ -0,0 +1,189 @@
+"""
+Micro-benchmark: ต้นทุนการ broadcast หนึ่งข้อความไปยังทุกคนในห้อง
+Micro-benchmark: the cost of broadcasting one message to everyone in a room
+
+เทียบ 4 แบบที่ขนาดห้อง 15, 100 และ 1000 คน:
+Compares four fan-out paths at room sizes 15, 100 and 1000:
+
+- sequential:   วน await send_text(str) ทีละคนในตัว broadcast (แบบดั้งเดิม; คนช้าคนเดียวทำให้ทั้งห้องช้า)
+                await send_text(str) per recipient inside broadcast (the original loop; one slow
+                client stalls the room)
+- per-socket:   ConnectionWriter แบบก่อนหน้า: สร้าง ASGI message ใหม่ต่อคน และ asyncio.wait_for ต่อการส่ง
+                the previous ConnectionWriter: a fresh ASGI message per recipient and
+                asyncio.wait_for per send
+- shared:       OutboundFrame ตัวเดียว (ASGI message สร้างครั้งเดียว) + timeout ด้วย call_later
+                one OutboundFrame (ASGI message built once) + call_later timeouts
+- bytes frame:  เหมือน shared แต่ส่ง bytes ที่ encode ไว้แล้ว (ไม่ต้อง encode ต่อ socket)
+                like shared, but sends the pre-encoded bytes (no per-socket encode)
+
+socket เป็น Starlette WebSocket จริงที่ต่อกับ ASGI send ปลอมซึ่ง encode text
+เป็น UTF-8 แบบเดียวกับ uvicorn (ไม่มี network จริง)
+Sockets are real Starlette WebSockets wired to a fake ASGI send that encodes
+text to UTF-8 the way uvicorn does (no real network)
+
+Usage:
+    python benchmarks/fanout.py [--rounds 200]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from starlette.websockets import WebSocket  # noqa: E402
+
+import main  # noqa: E402
+
+ROOM_SIZES = (15, 100, 1000)
+
+# ข้อความภาษาไทยแบบที่ผู้ใช้ส่งจริง / A Thai chat line like real users send
+MESSAGE = "somchai: ถึงป้ายหน้าแล้วนะ รอแป๊บนึง รถติดมากแถวลาดกระบัง"
+
+
+class BytesFrame(main.OutboundFrame):
+    """frame ที่ส่งเป็น bytes ที่ encode ไว้แล้ว / A frame sent as its pre-encoded bytes"""
+    __slots__ = ()
+
+    @property
+    def message(self) -> dict:
+        if self._message is None:
+            self._message = {"type": "websocket.send", "bytes": self.data}
+        return self._message
+
+
+class PerSocketFrame(main.OutboundFrame):
+    """frame ที่สร้าง ASGI message ใหม่ทุกครั้ง (เหมือน send_text) / A frame that builds a new ASGI message each time"""
+    __slots__ = ()
+
+    @property
+    def message(self) -> dict:
+        return {"type": "websocket.send", "text": self.text}
+
+
+class WaitForWriter(main.ConnectionWriter):
+    """writer แบบก่อนหน้าที่ใช้ asyncio.wait_for ต่อการส่ง / The previous writer, asyncio.wait_for per send"""
+
+    async def _run(self):
+        while True:
+            if not self.queue:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            frame = self.queue.popleft()
+            try:
+                await asyncio.wait_for(self.websocket.send(frame.message), main.SEND_TIMEOUT_SECONDS)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._fail(f"send failed ({e!r})")
+                return
+
+
+class Sink:
+    """
+    ปลายทาง ASGI ปลอมที่นับ bytes และแจ้งเมื่อส่งครบ
+    Fake ASGI server side that counts bytes and signals when every copy arrived
+    """
+
+    def __init__(self):
+        self.delivered = 0
+        self.expected = 0
+        self.bytes = 0
+        self.done = asyncio.Event()
+
+    def socket(self) -> WebSocket:
+        async def receive():
+            return {"type": "websocket.connect"}
+
+        async def send(message):
+            if message["type"] != "websocket.send":
+                return
+            data = message.get("bytes")
+            if data is None:
+                data = message["text"].encode("utf-8")
+            self.bytes += len(data)
+            self.delivered += 1
+            if self.delivered >= self.expected:
+                self.done.set()
+
+        scope = {"type": "websocket", "path": "/ws", "headers": [], "query_string": b"", "client": ("127.0.0.1", 1)}
+        return WebSocket(scope, receive, send)
+
+    def expect(self, count: int):
+        self.delivered = 0
+        self.expected = count
+        self.done.clear()
+
+
+async def bench_sequential(size: int, rounds: int) -> float:
+    sink = Sink()
+    sockets = [sink.socket() for _ in range(size)]
+    for websocket in sockets:
+        await websocket.accept()
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for websocket in sockets:
+            await websocket.send_text(MESSAGE)
+    return (time.perf_counter() - started) / rounds
+
+
+async def bench_manager(size: int, rounds: int, frame_type: type, writer_type: type) -> float:
+    main.ConnectionWriter = writer_type
+    manager = main.ConnectionManager()
+    manager.create_room("bench", size, "taxi")
+    manager.scheduler.cancel("bench")
+    sink = Sink()
+    for index in range(size):
+        await manager.connect(sink.socket(), "bench", f"user{index}")
+    recipients = list(manager.room_members["bench"].values())
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        sink.expect(size)
+        manager._fan_out("bench", recipients, frame_type(MESSAGE))
+        await sink.done.wait()
+    elapsed = (time.perf_counter() - started) / rounds
+
+    tasks = [member.writer.task for member in recipients]
+    for websocket in list(manager.members):
+        manager._remove_member(websocket)
+    manager.scheduler.task.cancel()
+    await asyncio.sleep(0.01)
+
+    # asyncio.wait_for (Python <= 3.11) อาจกลืน cancel ที่มาพร้อมกับตอนส่งเสร็จ ทำให้ writer แบบเก่าค้าง
+    # asyncio.wait_for (Python <= 3.11) can swallow a cancel that races a finished send, leaking old writers
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+    await asyncio.sleep(0.01)
+    return elapsed
+
+
+async def run(rounds: int):
+    writer = main.ConnectionWriter
+    columns = ("sequential", "per-socket", "shared", "bytes frame")
+    print(f"{'room size':>9} | " + " | ".join(f"{name:>12}" for name in columns) + " | shared vs per-socket")
+    print("-" * 92)
+    for size in ROOM_SIZES:
+        results = (
+            await bench_sequential(size, rounds),
+            await bench_manager(size, rounds, PerSocketFrame, WaitForWriter),
+            await bench_manager(size, rounds, main.OutboundFrame, writer),
+            await bench_manager(size, rounds, BytesFrame, writer),
+        )
+        print(
+            f"{size:>9} | " + " | ".join(f"{value * 1e6:>9.1f} µs" for value in results)
+            + f" | {results[1] / results[2]:>5.2f}x"
+        )
+    main.ConnectionWriter = writer
+    print("\nเวลาต่อหนึ่ง broadcast จนส่งครบทุกคน / time per broadcast until every copy is written")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rounds", type=int, default=200)
+    asyncio.run(run(parser.parse_args().rounds))
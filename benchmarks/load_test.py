@@ -0,0 +1,349 @@
+"""
+Load test: จำลองคนขับและผู้โดยสารหลายพันคนกับ server จริงบนเครื่อง
+Load test: simulates thousands of drivers and passengers against a real local server
+
+ขั้นตอน / Phases:
+
+1. เริ่ม uvicorn (main:app) เป็น subprocess โดยตั้งอายุห้องให้สั้น เพื่อให้ห้องหมดอายุระหว่างทดสอบ
+   และปิดการจำกัดอัตรา connect (หรือใช้ --url ชี้ไปที่ server ที่รันอยู่แล้ว ซึ่งควรตั้ง
+   CONNECT_RATE_PER_SECOND=0 ไว้ ไม่อย่างนั้น client ส่วนหนึ่งจะถูกปฏิเสธ)
+   Start uvicorn (main:app) as a subprocess with a short room lifetime so rooms expire during
+   the run, and connect-rate limits off (or point --url at a server that is already running,
+   which should set CONNECT_RATE_PER_SECOND=0 or some clients will be refused)
+2. คนขับสร้างห้องผ่าน POST /rooms แล้วต่อ WebSocket
+   Drivers create rooms through POST /rooms, then connect their WebSocket
+3. ผู้โดยสารหาห้องผ่าน GET /rooms/random แล้วต่อ WebSocket (วัด connections/s)
+   Passengers find a room through GET /rooms/random, then connect (measures connections/s)
+4. ทุกคนแชทตามอัตราที่กำหนด; ข้อความมีเวลาที่ส่งฝังอยู่ ผู้รับจึงวัด delivery latency ได้
+   Everyone chats at a fixed rate; each message carries its send time so receivers measure
+   delivery latency
+5. รอจนห้องหมดอายุและผู้ใช้ถูกย้ายไป ped_pong (ROOM_CHANGE)
+   Wait for the rooms to expire and users to ride through to ped_pong (ROOM_CHANGE)
+
+หน่วยความจำต่อ connection วัดจาก RSS ของ server (/proc, เฉพาะ Linux และเฉพาะ server ที่ script เริ่มเอง)
+Memory per connection is the server's RSS growth (/proc, Linux only, only for a server this script starts)
+
+client ทุกตัวอยู่ใน process เดียวกับ script นี้ บนเครื่องที่มี CPU น้อย client เองอาจเป็นคอขวด
+ควรเทียบผลระหว่าง commit บนเครื่องเดียวกันเท่านั้น
+Every client lives in this one process; on small machines the clients themselves can be the
+bottleneck, so only compare results between commits on the same machine
+
+Usage:
+    python benchmarks/load_test.py [--clients 1000] [--room-size 10] [--chat-seconds 10]
+                                   [--rate 0.5] [--lifetime 20] [--url http://127.0.0.1:8000]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import websockets
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# ข้อความภาษาไทยแบบที่ผู้ใช้ส่งจริง / A Thai chat line like real users send
+MESSAGE = "ถึงป้ายหน้าแล้วนะ รอแป๊บนึง"
+
+# ข้อความแชทที่ script นี้ส่ง: "<MARKER> <เวลาที่ส่ง> <ข้อความ>"
+# Chat lines sent by this script: "<MARKER> <send time> <text>"
+MARKER = "lt"
+
+# จำนวนครั้งที่ผู้โดยสารลองหาห้องใหม่เมื่อห้องเต็ม / Times a passenger retries when its room filled up
+JOIN_ATTEMPTS = 3
+
+
+class Stats:
+    """ตัวเลขรวมของการทดสอบ / Aggregated numbers for a run"""
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.sent = 0
+        self.delivered = 0
+        self.misses = 0
+        self.full_on_join = 0
+        self.connect_errors = 0
+        self.room_changes = 0
+        self.disconnected = 0
+
+
+class Client:
+    """
+    ผู้ใช้จำลองหนึ่งคน: อ่านทุก frame และวัด latency ของข้อความแชทที่มีเวลาฝังอยู่
+    One simulated user: reads every frame and measures latency of chat lines carrying a send time
+    """
+
+    def __init__(self, name: str, stats: Stats):
+        self.name = name
+        self.stats = stats
+        self.websocket = None
+        self.room = None
+        self.since = 0.0     # ข้อความที่ส่งก่อนเวลานี้เป็นประวัติที่ replay / lines sent before this are history replays
+        self.reader = None
+
+    async def connect(self, base: str, room: str, role: str):
+        self.room = room
+        self.since = time.time()
+        self.websocket = await websockets.connect(
+            f"{base}/ws/{urllib.parse.quote(room)}/{self.name}?role={role}",
+            open_timeout=30,
+            max_queue=None,
+        )
+        self.reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        try:
+            async for text in self.websocket:
+                if text == "System: PING":
+                    await self.websocket.send("/pong")
+                    continue
+                self._on_frame(text)
+        except websockets.ConnectionClosed:
+            pass
+        self.stats.disconnected += 1
+
+    def _on_frame(self, text: str):
+        if text.startswith("System: ROOM_CHANGE:"):
+            self.room = text.split(":", 2)[2]
+            self.since = time.time()
+            self.stats.room_changes += 1
+            return
+        _, separator, body = text.partition(": ")
+        if not separator or not body.startswith(MARKER + " "):
+            return
+        sent_at = float(body.split(" ", 2)[1])
+        if sent_at >= self.since:
+            self.stats.delivered += 1
+            self.stats.latencies.append((time.time() - sent_at) * 1000)
+
+    async def chat(self, seconds: float, rate: float):
+        """ส่งข้อความทุก 1/rate วินาที (เริ่มแบบสุ่มเฟส) / Send a line every 1/rate seconds (random phase)"""
+        interval = 1 / rate
+        await asyncio.sleep(interval * (hash(self.name) % 1000) / 1000)
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            try:
+                await self.websocket.send(f"{MARKER} {time.time():.6f} {MESSAGE}")
+            except websockets.ConnectionClosed:
+                return
+            self.stats.sent += 1
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.reader is not None:
+            await self.reader
+
+
+def http(base: str, method: str, path: str, body: dict = None) -> tuple[int, dict]:
+    """HTTP request แบบ blocking (เรียกผ่าน asyncio.to_thread) / Blocking HTTP request (run via asyncio.to_thread)"""
+    request = urllib.request.Request(
+        base + path,
+        method=method,
+        data=json.dumps(body).encode() if body is not None else None,
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, {}
+
+
+def rss_kib(pid: int) -> int:
+    """RSS ของ process (KiB) จาก /proc / Process RSS (KiB) from /proc"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def raise_fd_limit():
+    """เพิ่มจำนวนไฟล์ที่เปิดได้ให้พอสำหรับหลายพัน socket / Raise the open-file limit for thousands of sockets"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def start_server(port: int, args) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "ENVIRONMENT": "development",
+        "ROOM_LIFETIME_SECONDS": str(args.lifetime),
+        "ROOM_WARNING_SECONDS": str(min(5, args.lifetime // 2)),
+        # ทุก client มาจาก IP เดียวและ connect พร้อมกัน: ปิดการจำกัดอัตรา connect
+        # Every client shares one IP and connects at once: no connect-rate limits
+        "CONNECT_RATE_PER_SECOND": "0",
+        "CONNECT_RATE_PER_IP": "0",
+        "MAX_CONNECTIONS": "0",
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,    # print() ของ server (เช่น "Room is full") / the server's print() noise
+    )
+
+
+async def wait_ready(base: str):
+    for _ in range(100):
+        try:
+            await asyncio.to_thread(http, base, "GET", "/rooms/random?transport_type=taxi&user_type=passenger")
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"server at {base} did not start")
+
+
+async def gather_limited(limit: int, coroutines) -> list:
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines), return_exceptions=True)
+
+
+async def run(args):
+    raise_fd_limit()
+    server = None
+    base = args.url.rstrip("/") if args.url else None
+    if base is None:
+        server = start_server(args.port, args)
+        base = f"http://127.0.0.1:{args.port}"
+    ws_base = "ws" + base[len("http"):]
+
+    stats = Stats()
+    report = {}
+    try:
+        await wait_ready(base)
+        baseline_kib = rss_kib(server.pid) if server else 0
+        tag = f"{os.getpid()}_{int(time.time())}"
+        room_count = max(1, args.clients // args.room_size)
+        rooms = [f"taxi_{index}_{tag}" for index in range(room_count)]
+
+        # 1. คนขับสร้างห้อง / Drivers create rooms
+        started = time.perf_counter()
+        results = await gather_limited(args.concurrency, (
+            asyncio.to_thread(http, base, "POST", "/rooms", {
+                "room_name": room, "capacity": args.room_size,
+                "creator_type": "driver", "transport_type": "taxi",
+            })
+            for room in rooms
+        ))
+        report["rooms created/s"] = room_count / (time.perf_counter() - started)
+        created_at = time.time()
+        failed = [result for result in results if not isinstance(result, tuple) or result[0] != 200]
+        if failed:
+            raise RuntimeError(f"{len(failed)} rooms could not be created: {failed[:3]}")
+
+        # 2. คนขับและผู้โดยสารต่อ WebSocket / Drivers and passengers connect
+        clients: list[Client] = []
+
+        async def join_driver(room: str):
+            client = Client(f"driver_{room}", stats)
+            await client.connect(ws_base, room, "driver")
+            clients.append(client)
+
+        async def join_passenger(index: int):
+            # /rooms/random ไม่ได้จองที่นั่ง ห้องอาจเต็มก่อนต่อ WebSocket จึงลองห้องอื่นใหม่
+            # /rooms/random does not reserve a seat; the room can fill before the socket opens, so retry
+            for attempt in range(JOIN_ATTEMPTS):
+                status, found = await asyncio.to_thread(
+                    http, base, "GET", "/rooms/random?transport_type=taxi&user_type=passenger"
+                )
+                if status != 200 or not found.get("room"):
+                    stats.misses += 1
+                    return
+                client = Client(f"p{index}_{tag}", stats)
+                try:
+                    await client.connect(ws_base, found["room"], "passenger")
+                except (websockets.InvalidHandshake, websockets.ConnectionClosed):
+                    stats.full_on_join += 1
+                    continue
+                clients.append(client)
+                return
+
+        passengers = args.clients - room_count
+        started = time.perf_counter()
+        results = await gather_limited(args.concurrency, (
+            [join_driver(room) for room in rooms] + [join_passenger(index) for index in range(passengers)]
+        ))
+        elapsed = time.perf_counter() - started
+        stats.connect_errors = sum(isinstance(result, Exception) for result in results)
+        report["connections"] = len(clients)
+        report["connections/s"] = len(clients) / elapsed
+        report["random misses"] = stats.misses
+        report["room full on join (retried)"] = stats.full_on_join
+        report["connect errors"] = stats.connect_errors
+
+        await asyncio.sleep(1)
+        if server:
+            report["server RSS growth (MiB)"] = (rss_kib(server.pid) - baseline_kib) / 1024
+            report["memory/connection (KiB)"] = (rss_kib(server.pid) - baseline_kib) / max(1, len(clients))
+
+        # 3. แชท / Chat
+        stats.latencies.clear()
+        started = time.perf_counter()
+        await asyncio.gather(*(client.chat(args.chat_seconds, args.rate) for client in clients))
+        await asyncio.sleep(1)    # รอ frame ที่ยังอยู่ระหว่างทาง / let in-flight frames land
+        elapsed = time.perf_counter() - started
+        report["messages sent/s"] = stats.sent / elapsed
+        report["messages delivered/s"] = stats.delivered / elapsed
+        report["delivery p50 (ms)"] = percentile(stats.latencies, 0.50)
+        report["delivery p99 (ms)"] = percentile(stats.latencies, 0.99)
+        report["delivery max (ms)"] = max(stats.latencies, default=0.0)
+
+        # 4. รอห้องหมดอายุแล้วย้ายไป ped_pong / Ride through the ped_pong transition
+        if not args.url:
+            remaining = created_at + args.lifetime - time.time()
+            await asyncio.sleep(max(0.0, remaining) + 2)
+            report["moved to ped_pong"] = stats.room_changes
+            report["still aboard (ped_pong full)"] = sum(
+                client.room != "ped_pong" for client in clients if client.websocket.open
+            )
+        report["dropped by server"] = sum(client.websocket.closed for client in clients)
+
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    width = max(len(name) for name in report)
+    for name, value in report.items():
+        text = f"{value:,.1f}" if isinstance(value, float) else f"{value:,}"
+        print(f"{name:<{width}}  {text:>12}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=1000, help="drivers + passengers")
+    parser.add_argument("--room-size", type=int, default=10, help="room capacity (one driver per room)")
+    parser.add_argument("--chat-seconds", type=float, default=10)
+    parser.add_argument("--rate", type=float, default=0.5, help="messages per second per client")
+    parser.add_argument("--lifetime", type=int, default=20, help="ROOM_LIFETIME_SECONDS for the started server")
+    parser.add_argument("--concurrency", type=int, default=100, help="parallel joins")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--url", help="test an already running server instead of starting one")
+    asyncio.run(run(parser.parse_args()))
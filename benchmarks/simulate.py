@@ -0,0 +1,276 @@
+"""
+Simulation: เล่น workload ทั้งวันด้วยเวลาจำลอง (VirtualClock) เพื่อวางแผน capacity
+Simulation: replays a full day of workload in virtual time (VirtualClock) for capacity planning
+
+ConnectionManager ตัวจริงทำงานกับ VirtualClock: ห้องหมดอายุ, การย้ายไป ped_pong,
+การลองย้ายใหม่ และ token bucket ทั้งหมดเดินตามเวลาจำลอง ส่วน socket เป็น
+Starlette WebSocket ที่ต่อกับ ASGI send ปลอม (ไม่มี network)
+The real ConnectionManager runs on a VirtualClock: room expiry, ped_pong moves,
+retries and token buckets all follow virtual time. Sockets are Starlette
+WebSockets wired to a fake ASGI send (no network)
+
+workload เป็น event เรียงตามเวลา (JSON lines) / The workload is time-ordered events (JSON lines):
+
+    {"t": 0.0,  "op": "driver",    "user": "d1", "room": "taxi_d1", "transport": "taxi", "capacity": 4}
+    {"t": 3.5,  "op": "passenger", "user": "p7", "transport": "taxi"}
+    {"t": 9.0,  "op": "chat",      "user": "p7", "text": "..."}
+    {"t": 200,  "op": "return",    "user": "p7"}
+    {"t": 260,  "op": "leave",     "user": "p7"}
+
+ถ้าไม่ระบุ --workload จะสร้าง workload สังเคราะห์ที่มีช่วงเร่งด่วนเช้า/เย็น (--save เพื่อบันทึกไว้เล่นซ้ำ)
+Without --workload a synthetic day with morning/evening peaks is generated (--save keeps it for replay)
+
+Usage:
+    python benchmarks/simulate.py [--users 5000] [--hours 24] [--seed 1]
+    python benchmarks/simulate.py --save day.jsonl
+    python benchmarks/simulate.py --workload day.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+
+# รวมรายชื่อผู้ใช้ทันที (ไม่มี timer จริงมาปนกับเวลาจำลอง)
+# Flush user lists immediately (no real-time timers mixed into virtual time)
+os.environ.setdefault("PRESENCE_DEBOUNCE_MS", "0")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from starlette.websockets import WebSocket  # noqa: E402
+
+import main  # noqa: E402
+
+TRANSPORTS = ("motorcycle", "taxi", "location", "evmini")
+CAPACITY = {"motorcycle": 2, "taxi": 4, "location": 15, "evmini": 8}
+
+# ความหนาแน่นของผู้ใช้ตามชั่วโมง (ช่วงเร่งด่วน 8 โมงและ 5 โมงเย็น)
+# Relative traffic by hour of day (rush hours at 08:00 and 17:00)
+HOURLY_PROFILE = [
+    0.1, 0.05, 0.05, 0.05, 0.1, 0.3, 0.8, 1.6, 2.5, 1.6, 0.9, 0.9,
+    1.1, 1.0, 0.9, 1.0, 1.6, 2.5, 1.8, 1.0, 0.7, 0.5, 0.3, 0.2,
+]
+
+# ข้อความภาษาไทยแบบที่ผู้ใช้ส่งจริง / Thai chat lines like real users send
+LINES = ("ถึงไหนแล้วครับ", "รอหน้าตึก ECC นะ", "อีก 5 นาทีถึง", "ขอบคุณครับ", "รถติดมากแถวลาดกระบัง")
+
+
+class Sink:
+    """
+    ปลายทาง ASGI ปลอมที่นับ frame และ bytes ที่ server ส่งออก
+    Fake ASGI server side that counts the frames and bytes the server sends
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    def socket(self) -> WebSocket:
+        async def receive():
+            return {"type": "websocket.connect"}
+
+        async def send(message):
+            if message["type"] != "websocket.send":
+                return
+            data = message.get("bytes")
+            self.bytes += len(data) if data is not None else len(message["text"].encode("utf-8"))
+            self.frames += 1
+
+        scope = {"type": "websocket", "path": "/ws", "headers": [], "query_string": b"", "client": ("127.0.0.1", 1)}
+        return WebSocket(scope, receive, send)
+
+
+def synthetic_day(users: int, hours: float, seed: int) -> list[dict]:
+    """
+    สร้าง workload สังเคราะห์: คนขับ 1 คนต่อผู้โดยสารราว 4 คน เข้าตามโปรไฟล์รายชั่วโมง
+    Build a synthetic workload: about one driver per four passengers, arriving by the hourly profile
+    """
+    rng = random.Random(seed)
+    weights = [HOURLY_PROFILE[int(hour) % 24] for hour in range(math.ceil(hours))]
+    events = []
+    for index in range(users):
+        hour = rng.choices(range(len(weights)), weights)[0]
+        start = min(hours * 3600 - 1, (hour + rng.random()) * 3600)
+        transport = rng.choice(TRANSPORTS)
+        name = f"u{index}"
+        if rng.random() < 0.2:
+            # คนขับสร้างห้องแล้วอยู่จนห้องหมดอายุหรือนานกว่านั้นเล็กน้อย
+            # A driver creates a room and stays until it expires, or a little longer
+            events.append({
+                "t": start, "op": "driver", "user": name, "room": f"{transport}_{name}",
+                "transport": transport, "capacity": CAPACITY[transport],
+            })
+            stay = main.ROOM_LIFETIME_SECONDS + rng.expovariate(1 / 60)
+        else:
+            events.append({"t": start, "op": "passenger", "user": name, "transport": transport})
+            stay = rng.expovariate(1 / 240)
+            if rng.random() < 0.1:
+                events.append({"t": start + rng.uniform(0, stay + 1), "op": "return", "user": name})
+
+        # แชทประมาณทุก 30 วินาทีระหว่างอยู่ในห้อง / Chat roughly every 30 seconds while connected
+        moment = start + rng.expovariate(1 / 30)
+        while moment < start + stay:
+            events.append({"t": moment, "op": "chat", "user": name, "text": rng.choice(LINES)})
+            moment += rng.expovariate(1 / 30)
+        events.append({"t": start + stay, "op": "leave", "user": name})
+
+    events.sort(key=lambda event: event["t"])
+    return events
+
+
+class Simulation:
+    """
+    เล่น event กับ ConnectionManager บน VirtualClock และเก็บสถิติรายชั่วโมง
+    Replays events against a ConnectionManager on a VirtualClock and keeps hourly stats
+    """
+
+    def __init__(self):
+        self.clock = main.VirtualClock()
+        self.metrics = main.PrometheusMetrics()
+        self.manager = main.ConnectionManager(metrics=self.metrics, clock=self.clock)
+        self.sink = Sink()
+        self.sockets: dict[str, WebSocket] = {}
+        self.hours: dict[int, dict] = {}
+        self.totals = {"events": 0, "deadlines": 0, "rejected": 0}
+
+    def hour(self) -> dict:
+        return self.hours.setdefault(int(self.clock() // 3600), {
+            "arrivals": 0, "misses": 0, "full": 0, "chats": 0, "returns": 0,
+            "peak users": 0, "peak rooms": 0,
+        })
+
+    async def advance_to(self, when: float):
+        """
+        เลื่อนเวลาไปถึง when โดยหยุดที่ทุก deadline ของห้องระหว่างทาง
+        Move time forward to when, stopping at every room deadline on the way
+        """
+        while True:
+            deadline = self.manager.scheduler.next_deadline()
+            if deadline is None or deadline > when:
+                break
+            self.clock.advance_to(deadline)
+            self.totals["deadlines"] += await self.manager.scheduler.run_due()
+            await asyncio.sleep(0)
+        self.clock.advance_to(when)
+
+    async def join(self, user: str, room: str, role: str) -> bool:
+        try:
+            websocket = self.sink.socket()
+            await self.manager.connect(websocket, room, user, role)
+        except main.HTTPException:
+            self.hour()["full"] += 1
+            return False
+        self.sockets[user] = websocket
+        await self.manager.broadcast(f"System: {user} has joined the chat", room)
+        self.manager.presence_changed(room, joined=[user])
+        return True
+
+    async def apply(self, event: dict):
+        op = event["op"]
+        user = event["user"]
+        stats = self.hour()
+        if op == "driver":
+            stats["arrivals"] += 1
+            if event["room"] not in self.manager.available_rooms:
+                self.manager.create_room(event["room"], event["capacity"], event["transport"])
+                await self.join(user, event["room"], "driver")
+        elif op == "passenger":
+            stats["arrivals"] += 1
+            found = self.manager.get_random_active_room(event["transport"], "passenger")
+            if found is None:
+                stats["misses"] += 1
+            else:
+                await self.join(user, found["room"], "passenger")
+        elif user in self.sockets:
+            websocket = self.sockets[user]
+            member = self.manager.members.get(websocket)
+            if member is None:
+                self.sockets.pop(user)
+            elif op == "chat":
+                if self.manager.check_incoming(member, event["text"], True) != main.FLOOD_OK:
+                    self.totals["rejected"] += 1
+                    return
+                stats["chats"] += 1
+                text = event["text"]
+                await self.manager.broadcast(
+                    f"{user}: {text}", member.room, record=True, event=("chat", {"u": user, "m": text})
+                )
+            elif op == "return":
+                if await self.manager.move_back_to_original_room(user, websocket):
+                    stats["returns"] += 1
+            elif op == "leave":
+                self.sockets.pop(user)
+                await self.manager.disconnect(websocket)
+
+        stats["peak users"] = max(stats["peak users"], len(self.manager.members))
+        stats["peak rooms"] = max(stats["peak rooms"], len(self.manager.available_rooms) - 2)
+
+    async def run(self, events: list[dict]):
+        for event in events:
+            await self.advance_to(event["t"])
+            await self.apply(event)
+            self.totals["events"] += 1
+            # ให้ writer task ส่ง frame ที่ค้างออกไป / let writer tasks drain their queues
+            await asyncio.sleep(0)
+
+        # ปล่อยให้ห้องที่เหลือหมดอายุ / Let the remaining rooms expire
+        await self.advance_to(self.clock() + main.ROOM_LIFETIME_SECONDS + main.PED_PONG_RETRY_SECONDS)
+        for websocket in list(self.sockets.values()):
+            await self.manager.disconnect(websocket)
+        await asyncio.sleep(0.05)
+
+
+def counter(metrics: main.PrometheusMetrics, name: str, label=None) -> int:
+    return int(metrics.counters.get((name, label), 0))
+
+
+async def run(args):
+    if args.workload:
+        with open(args.workload, encoding="utf-8") as workload:
+            events = [json.loads(line) for line in workload if line.strip()]
+        events.sort(key=lambda event: event["t"])
+    else:
+        events = synthetic_day(args.users, args.hours, args.seed)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as saved:
+            for event in events:
+                saved.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    simulation = Simulation()
+    started = time.perf_counter()
+    await simulation.run(events)
+    wall = time.perf_counter() - started
+    virtual = simulation.clock()
+    metrics = simulation.metrics
+
+    columns = ("arrivals", "misses", "full", "chats", "returns", "peak users", "peak rooms")
+    print(f"{'hour':>4} | " + " | ".join(f"{name:>10}" for name in columns))
+    print("-" * (7 + 13 * len(columns)))
+    for hour, stats in sorted(simulation.hours.items()):
+        print(f"{hour:>4} | " + " | ".join(f"{stats[name]:>10,}" for name in columns))
+
+    print()
+    print(f"events replayed        {simulation.totals['events']:>12,}")
+    print(f"room deadlines fired   {simulation.totals['deadlines']:>12,}")
+    print(f"chats rejected (flood) {simulation.totals['rejected']:>12,}")
+    print(f"moved to ped_pong      {counter(metrics, 'drivechat_ped_pong_migrations_total'):>12,}")
+    print(f"kept aboard (full)     {counter(metrics, 'drivechat_ped_pong_deferred_total'):>12,}")
+    print(f"frames delivered       {simulation.sink.frames:>12,}")
+    print(f"MiB delivered          {simulation.sink.bytes / 2 ** 20:>12,.1f}")
+    print(f"virtual time           {virtual / 3600:>10,.1f} h")
+    print(f"wall time              {wall:>10,.1f} s")
+    print(f"speed-up               {virtual / wall if wall else 0:>10,.0f} x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=5000, help="drivers + passengers over the day")
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workload", help="replay a recorded JSON-lines workload instead")
+    parser.add_argument("--save", help="write the workload that was run to this file")
+    asyncio.run(run(parser.parse_args()))
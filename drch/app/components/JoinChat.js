@@ -19,7 +19,7 @@
  * ================================================================================
  */
 
-import { useState } from 'react';
+import { useEffect, useState } from 'react';
 import { ROOM_TYPES } from '../lib/constants';
 import { buildApiUrl } from '../lib/config';
 import TransportButtons from './TransportButtons';
@@ -67,6 +67,102 @@ export default function JoinChat({
   // Room display name
   const [roomDisplayName, setRoomDisplayName] = useState("");
 
+  // สถานะตั๋วในคิวรอห้อง (จาก /rooms/queue) ขณะไม่มีห้องว่าง
+  // Queue ticket status (from /rooms/queue) while no room is available
+  const [queueStatus, setQueueStatus] = useState(null);
+
+  // ชื่อผู้ใช้ตอนเข้าคิว (แก้ชื่อระหว่างรอไม่ทำให้ออกตั๋วใหม่)
+  // Username at the time the queue was entered (editing the name while waiting issues no new ticket)
+  const [queueUsername, setQueueUsername] = useState(null);
+
+  // --------------------------------------------------------------------------
+  // ROOM QUEUE (รอห้องในคิวแทนการกดหาซ้ำ)
+  // --------------------------------------------------------------------------
+
+  // เมื่อไม่มีห้องว่าง ให้เข้าคิว /rooms/queue แล้ว long poll จนกว่าจะได้ห้อง
+  // เมื่อได้ห้องจะเข้าห้องทันที; ออกจากหน้านี้หรือกด Cancel = ยกเลิกตั๋ว
+  // When no room is available, join /rooms/queue and long poll until a room is assigned,
+  // then join it straight away; leaving this view or pressing Cancel cancels the ticket
+  useEffect(() => {
+    if (!noRoomsAvailable || userType !== 'passenger' || !selectedType || !queueUsername) {
+      setQueueStatus(null);
+      return undefined;
+    }
+
+    let active = true;
+    let assigned = false;
+
+    // POST ที่ออกตั๋ว: cleanup รอ promise นี้เพื่อยกเลิกตั๋วแม้ได้มาหลังออกจากหน้านี้แล้ว
+    // The POST that issues the ticket: cleanup waits on it so a ticket that arrives
+    // after this view was left is still cancelled
+    const ticketRequest = fetch(buildApiUrl('/rooms/queue'), {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({
+        username: queueUsername,
+        user_type: userType,
+        transport_type: selectedType,
+      }),
+    }).then(async (response) => {
+      const data = await response.json();
+      if (!response.ok) {
+        throw new Error(data.detail);
+      }
+      return data;
+    });
+
+    const waitForRoom = async () => {
+      try {
+        let data = await ticketRequest;
+        const ticket = data.ticket;
+        let response;
+
+        // รอทีละไม่เกิน 25 วินาที (server ตอบทันทีเมื่อได้ห้อง)
+        // Wait up to 25 seconds per request (the server answers as soon as a room is assigned)
+        while (active && data.status === 'waiting') {
+          setQueueStatus(data);
+          response = await fetch(buildApiUrl(`/rooms/queue/${ticket}?wait=25`));
+          data = response.ok ? await response.json() : { status: 'expired' };
+        }
+        if (!active) {
+          return;
+        }
+
+        setQueueStatus(data);
+        if (data.status === 'assigned') {
+          // ได้ห้องแล้ว - ที่นั่งถูกจองไว้จนกว่าจะเชื่อมต่อ
+          // Assigned - the seat is held until we connect
+          assigned = true;
+          setRoom(data.room);
+          setRoomCapacity(data.capacity);
+          joinChat(data.room);
+        }
+      } catch (error) {
+        console.error('Error waiting for a room:', error);
+        if (active) {
+          setQueueStatus({ status: 'expired' });
+        }
+      }
+    };
+
+    waitForRoom();
+    return () => {
+      active = false;
+      ticketRequest
+        .then((data) => {
+          if (!assigned) {
+            return fetch(buildApiUrl(`/rooms/queue/${data.ticket}`), { method: 'DELETE' });
+          }
+          return undefined;
+        })
+        .catch(() => {});
+    };
+  }, [noRoomsAvailable, userType, selectedType, queueUsername]);
+
+  const queueWaiting = queueStatus === null || queueStatus.status === 'waiting';
+
   // --------------------------------------------------------------------------
   // HELPER: GET CAPACITY BY TYPE (ดึงความจุตามประเภทยานพาหนะ)
   // --------------------------------------------------------------------------
@@ -144,6 +240,7 @@ export default function JoinChat({
     }
 
     setIsLoading(true);
+    setNoRoomsAvailable(false);
     try {
       // เรียก API หาห้องสุ่ม
       // Call API to find random room
@@ -162,8 +259,9 @@ export default function JoinChat({
         setRoomCapacity(data.capacity);
         joinChat(data.room);
       } else {
-        // ไม่พบห้องว่าง
-        // No rooms available
+        // ไม่พบห้องว่าง - เข้าคิวรอห้อง (ดู ROOM QUEUE)
+        // No rooms available - wait in the room queue (see ROOM QUEUE)
+        setQueueUsername(username);
         setNoRoomsAvailable(true);
       }
     } catch (error) {
@@ -316,11 +414,26 @@ export default function JoinChat({
               userType={userType}
             />
 
-            {/* แจ้งเตือนไม่มีห้องว่าง */}
+            {/* แจ้งเตือนไม่มีห้องว่าง / รออยู่ในคิว */}
             {noRoomsAvailable && userType === 'passenger' && (
-              <div className="p-4 bg-yellow-50 border border-yellow-200 rounded-lg text-yellow-800">
-                No available rooms for this transport type. Please try another type or wait for a driver to create a room.
-              </div>
+              queueWaiting ? (
+                <div className="p-4 bg-blue-50 border border-blue-200 rounded-lg text-blue-800 flex items-center justify-between gap-3">
+                  <span>
+                    No room is open yet. Waiting for a driver
+                    {queueStatus?.position ? ` (you are #${queueStatus.position} in line)` : ''}...
+                  </span>
+                  <button
+                    onClick={() => setNoRoomsAvailable(false)}
+                    className="px-3 py-1 bg-gray-100 text-gray-700 rounded-lg hover:bg-red-500 hover:text-white transition-colors"
+                  >
+                    Cancel
+                  </button>
+                </div>
+              ) : (
+                <div className="p-4 bg-yellow-50 border border-yellow-200 rounded-lg text-yellow-800">
+                  No available rooms for this transport type. Please try another type or wait for a driver to create a room.
+                </div>
+              )
             )}
 
             {/* ปุ่ม Action */}
@@ -329,7 +442,7 @@ export default function JoinChat({
               {userType === 'passenger' && (
                 <button
                   onClick={joinRandomRoom}
-                  disabled={isLoading || !username || !selectedType}
+                  disabled={isLoading || !username || !selectedType || (noRoomsAvailable && queueWaiting)}
                   className="flex-1 px-4 py-2 bg-blue-500 text-white rounded-lg hover:bg-blue-700 disabled:bg-gray-300 disabled:cursor-not-allowed transition-colors"
                 >
                   {isLoading ? 'Finding room...' : 'Join Random Room'}
@@ -73,6 +73,14 @@ export default function Home() {
   // WebSocket reference
   const socket = useRef(null);
 
+  // resume token จาก server และจำนวนครั้งที่ลองต่อกลับ (Resume token from the server and reconnect attempts)
+  const sessionToken = useRef(null);
+  const reconnectAttempts = useRef(0);
+
+  // ห้องปัจจุบันของ connection (อัพเดทตาม ROOM_CHANGE) ใช้ตอนต่อกลับ
+  // The connection's current room (follows ROOM_CHANGE), used when reconnecting
+  const currentRoom = useRef("");
+
   // --------------------------------------------------------------------------
   // 2.2 WEBSOCKET LOGIC (การจัดการ WebSocket)
   // --------------------------------------------------------------------------
@@ -82,16 +90,20 @@ export default function Home() {
    * Connect to chat room via WebSocket
    * 
    * @param {string} roomToJoin - ชื่อห้องที่จะเข้าร่วม
+   * @param {string} [resumeToken] - resume token เมื่อต่อกลับหลัง connection หลุด
    */
-  const joinChat = (roomToJoin) => {
+  const joinChat = (roomToJoin, resumeToken) => {
     // ตรวจสอบว่ามี username และ room
     // Validate username and room
     if (username && roomToJoin) {
-      // สร้าง WebSocket connection
-      // Create WebSocket connection
+      // สร้าง WebSocket connection (ขอรับ PING และ resume token, ต่อ session เดิมถ้ามี token)
+      // Create WebSocket connection (opting in to PINGs and resume tokens, resuming the old
+      // session when there is a token)
       const encodedRoom = encodeURIComponent(roomToJoin);
       const encodedUsername = encodeURIComponent(username);
-      socket.current = new WebSocket(buildWsUrl(`/ws/${encodedRoom}/${encodedUsername}`));
+      currentRoom.current = roomToJoin;
+      const query = "?heartbeat=1&session=1" + (resumeToken ? `&resume=${encodeURIComponent(resumeToken)}` : "");
+      socket.current = new WebSocket(buildWsUrl(`/ws/${encodedRoom}/${encodedUsername}${query}`));
 
       // ---------- Handle incoming messages ----------
       // จัดการข้อความที่เข้ามา
@@ -105,15 +117,24 @@ export default function Home() {
           const users = usersPart.split(", ");
           setActiveUsers(users);
         }
-        // จัดการการเปลี่ยนห้อง (เช่น ย้ายไป ped_pong)
-        // Handle room change (e.g., move to ped_pong)
+        // heartbeat จาก server: ตอบกลับทันทีและไม่แสดงในแชท
+        // Server heartbeat: reply straight away and keep it out of the chat
+        else if (message === "System: PING") {
+          socket.current.send("/pong");
+        }
+        // resume token สำหรับต่อกลับถ้า connection หลุด (ไม่แสดงในแชท)
+        // Resume token for reconnecting after a drop (kept out of the chat)
+        else if (message.startsWith("System: SESSION:")) {
+          sessionToken.current = message.slice("System: SESSION:".length);
+        }
+        // จัดการการเปลี่ยนห้อง (เช่น ย้ายไป ped_pong): server ย้าย connection นี้ให้แล้ว
+        // จึงแค่อัพเดทชื่อห้อง ไม่ต้องต่อใหม่
+        // Handle room change (e.g., move to ped_pong): the server already moved this
+        // connection, so only the room name is updated; no reconnect needed
         else if (message.startsWith("System: ROOM_CHANGE:")) {
           const newRoom = message.split(":")[2];
+          currentRoom.current = newRoom;
           setRoom(newRoom);
-          // ปิด connection เดิมและเชื่อมต่อห้องใหม่
-          // Close old connection and connect to new room
-          socket.current.close();
-          joinChat(newRoom);
         }
         // ข้อความปกติ
         // Normal message
@@ -125,9 +146,21 @@ export default function Home() {
       // ---------- Handle connection close ----------
       // จัดการเมื่อ connection ปิด
       socket.current.onclose = function (event) {
+        // หลุดเพราะเครือข่าย (1006): ต่อกลับด้วย token ภายในช่วง grace ของ server แล้วได้ข้อความ
+        // ที่พลาดไป โดยคนอื่นไม่เห็นว่าออก (server ตัดเพราะไม่ตอบ PING = 1001 ซึ่ง session จบแล้ว)
+        // Dropped by the network (1006): reconnect with the token within the server's grace
+        // period and get what was missed, without anyone else seeing a leave (a heartbeat
+        // timeout closes with 1001 and ends the session)
+        if (event.code === 1006 && sessionToken.current && reconnectAttempts.current < 5) {
+          const delay = 1000 * 2 ** reconnectAttempts.current;
+          reconnectAttempts.current += 1;
+          setTimeout(() => joinChat(currentRoom.current, sessionToken.current), delay);
+          return;
+        }
         if (event.reason) {
           alert(event.reason);
         }
+        sessionToken.current = null;
         setIsJoined(false);
         setActiveUsers([]);
       };
@@ -135,6 +168,7 @@ export default function Home() {
       // ---------- Handle connection open ----------
       // จัดการเมื่อเชื่อมต่อสำเร็จ
       socket.current.onopen = function () {
+        reconnectAttempts.current = 0;
         setIsJoined(true);
       };
     }
@@ -164,9 +198,10 @@ export default function Home() {
   const handleRoomChange = (newRoom) => {
     setRoom(newRoom);
     if (newRoom === 'duck_pond') {
-      // เชื่อมต่อใหม่สำหรับ duck_pond
-      // Reconnect for duck_pond
-      socket.current.close();
+      // เชื่อมต่อใหม่สำหรับ duck_pond (ออกจากห้องเดิมจริง จึงปิดแบบปกติ)
+      // Reconnect for duck_pond (a real leave, so close cleanly)
+      socket.current.close(1000);
+      sessionToken.current = null;
       joinChat('duck_pond');
     }
   };
@@ -8,9 +8,11 @@ DriveChat@KMITL - Backend Server
 โครงสร้างไฟล์:
 1. Imports & Configuration (การนำเข้าและตั้งค่า)
 2. Data Models (โมเดลข้อมูล)  
-3. ConnectionManager Class (คลาสจัดการการเชื่อมต่อ)
-4. API Endpoints (จุดเชื่อมต่อ API)
-5. WebSocket Handler (ตัวจัดการ WebSocket)
+3. Connection Helpers (ตัวช่วยจัดการการเชื่อมต่อ)
+4. ConnectionManager Class (คลาสจัดการการเชื่อมต่อ)
+5. API Endpoints (จุดเชื่อมต่อ API)
+6. WebSocket Handler (ตัวจัดการ WebSocket)
+7. Command Line (รันจาก command line)
 ================================================================================
 """
 
@@ -18,18 +20,71 @@ DriveChat@KMITL - Backend Server
 # 1. IMPORTS & CONFIGURATION (การนำเข้าและตั้งค่า)
 # ==============================================================================
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 import os
 import random
 import asyncio
-from typing import Optional
-from datetime import datetime, timedelta
+import bisect
+import heapq
+import hmac
+import itertools
+import json
+import math
+import secrets
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional, Union
+
+try:
+    # optional: ใช้กับ ?protocol=msgpack (pip install msgpack)
+    # Optional: enables ?protocol=msgpack (pip install msgpack)
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# ตัวกรองคำหยาบแยกอยู่ใน moderation.py (ไม่พึ่ง FastAPI หรือ state ของ server)
+# The profanity filter lives in moderation.py (no FastAPI or server state involved)
+from moderation import Moderator, NullModerator, WordMatcher, load_moderation_words
+
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    เริ่ม/หยุดส่วนที่ต้องใช้ event loop (เช่น broker) ตอน server start/shutdown
+    Start/stop the parts that need the event loop (e.g. the broker) with the server
+    """
+    if SNAPSHOT_PATH:
+        restore_snapshot(SNAPSHOT_PATH)
+    await manager.broker.start(manager)
+    loop_monitor.start()
+    manager.start_heartbeat()
+    try:
+        yield
+    finally:
+        manager.stop_heartbeat()
+        moderator.stop()
+        loop_monitor.stop()
+        if SNAPSHOT_PATH:
+            # ปกติ snapshot ถูกเก็บแล้วตอน socket แรกถูกปิดด้วย 1012; ถ้าไม่มีใครต่ออยู่ก็เก็บตอนนี้
+            # Normally taken when the first socket closed with 1012; with no connections, take it now
+            manager.prepare_shutdown()
+            save_snapshot(SNAPSHOT_PATH, manager.shutdown_snapshot)
+        await manager.broker.stop()
+
 
 # สร้าง FastAPI application instance
 # Create FastAPI application instance
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 DEFAULT_ALLOWED_ORIGINS = [
     "http://localhost:3000",
@@ -51,6 +106,188 @@ def get_allowed_origins() -> list[str]:
 
 ENVIRONMENT = os.getenv("ENVIRONMENT", "development").strip().lower()
 
+# เวลาสูงสุด (วินาที) ที่รอการส่งข้อความไปยัง client หนึ่งคนใน broadcast
+# Maximum seconds to wait for a single client send during a broadcast
+SEND_TIMEOUT_SECONDS = float(os.getenv("SEND_TIMEOUT_SECONDS", "5"))
+
+# จำนวนข้อความสูงสุดที่รอส่งได้ต่อ connection
+# Maximum number of pending outbound frames per connection
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "64"))
+
+# นโยบายเมื่อคิวเต็ม: drop_oldest, coalesce หรือ disconnect
+# Policy when a connection's queue is full: drop_oldest, coalesce or disconnect
+OUTBOUND_OVERFLOW_POLICY = os.getenv("OUTBOUND_OVERFLOW_POLICY", "coalesce").strip().lower()
+if OUTBOUND_OVERFLOW_POLICY not in ("drop_oldest", "coalesce", "disconnect"):
+    raise RuntimeError(
+        "OUTBOUND_OVERFLOW_POLICY must be one of: drop_oldest, coalesce, disconnect"
+    )
+
+# อายุของห้องปกติก่อนย้ายทุกคนไป ped_pong และเวลาแจ้งเตือนล่วงหน้า (วินาที)
+# Lifetime of a regular room before everyone moves to ped_pong, and the warning lead time (seconds)
+ROOM_LIFETIME_SECONDS = int(os.getenv("ROOM_LIFETIME_SECONDS", "180"))
+ROOM_WARNING_SECONDS = int(os.getenv("ROOM_WARNING_SECONDS", "20"))
+
+# ถ้า ped_pong เต็ม (ครบ MAX_SHARDS แล้ว) ผู้ใช้ที่เหลือจะอยู่ในห้องเดิมต่อ แล้วลองย้ายใหม่หลังจากนี้ (วินาที)
+# If ped_pong is full (MAX_SHARDS reached), leftover users stay aboard and the move is retried after this (seconds)
+PED_PONG_RETRY_SECONDS = 30
+
+# ห้องพิเศษ (duck_pond, ped_pong) แบ่งเป็น shard ได้สูงสุดกี่ shard ต่อห้อง
+# และ shard สองอันจะถูกรวมเมื่อรวมกันแล้วมีคนไม่เกินสัดส่วนนี้ของความจุ
+# Most shards per special room (duck_pond, ped_pong), and two shards are merged
+# once together they fill at most this fraction of the capacity
+MAX_SHARDS = int(os.getenv("MAX_SHARDS", "50"))
+SHARD_MERGE_FILL = 0.75
+
+# heartbeat: ส่ง PING ให้ client ที่เงียบนานเท่านี้ (วินาที, 0 = ปิด) และตัดเมื่อไม่ตอบติดกันกี่ครั้ง
+# เฉพาะ client ที่ขอด้วย ?heartbeat=1 (client เก่าไม่รู้จัก PING และไม่ตอบ /pong)
+# Heartbeat: PING clients that have been silent this long (seconds, 0 = off), and drop
+# them after this many unanswered pings in a row; only clients that opt in with
+# ?heartbeat=1 (older clients don't know PING and never answer /pong)
+HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("HEARTBEAT_INTERVAL_SECONDS", "20"))
+HEARTBEAT_MISSES = int(os.getenv("HEARTBEAT_MISSES", "2"))
+
+# ตัดผู้ใช้ที่ไม่ได้ส่งข้อความแชทนานเท่านี้ (วินาที, 0 = ไม่ตัด)
+# Drop users who have not sent a chat line for this long (seconds, 0 = never)
+IDLE_TIMEOUT_SECONDS = float(os.getenv("IDLE_TIMEOUT_SECONDS", "0"))
+
+# connection ที่หลุดกลางคัน (close 1006) ยังถือที่นั่งไว้เงียบๆ นานเท่านี้ ให้ต่อกลับด้วย resume token
+# (วินาที, 0 = ปิด); เฉพาะ client ที่ขอ token ด้วย ?session=1
+# A connection that drops abnormally (close 1006) silently keeps its seat this long so it can
+# come back with its resume token (seconds, 0 = off); only clients that ask for a token with ?session=1
+SESSION_GRACE_SECONDS = float(os.getenv("SESSION_GRACE_SECONDS", "30"))
+
+# ช่วงเวลา (มิลลิวินาที) ที่รวมการเปลี่ยนแปลงรายชื่อผู้ใช้ก่อนส่งครั้งเดียว
+# Window (milliseconds) in which user-list changes are coalesced into one update
+PRESENCE_DEBOUNCE_MS = int(os.getenv("PRESENCE_DEBOUNCE_MS", "100"))
+
+# ช่วงเวลา (มิลลิวินาที) ที่รวมข้อความของห้องที่กำลังคึกคักก่อนส่งครั้งเดียว; 0 = ส่งทันที (ปิด)
+# ห้องที่เงียบยังส่งทันทีเสมอ แนะนำ 20-50
+# Window (milliseconds) in which a busy room's messages are batched into one send; 0 = immediate (off)
+# Quiet rooms always send immediately; 20-50 is a sensible range
+ROOM_BATCH_WINDOW_MS = int(os.getenv("ROOM_BATCH_WINDOW_MS", "0"))
+
+# จำกัดอัตราข้อความ (token bucket): ต่อ connection และต่อห้อง (ข้อความ/วินาที และ burst)
+# Message rate limits (token buckets): per connection and per room (messages/second and burst)
+USER_RATE_PER_SECOND = float(os.getenv("USER_RATE_PER_SECOND", "5"))
+USER_RATE_BURST = int(os.getenv("USER_RATE_BURST", "10"))
+ROOM_RATE_PER_SECOND = float(os.getenv("ROOM_RATE_PER_SECOND", "50"))
+ROOM_RATE_BURST = int(os.getenv("ROOM_RATE_BURST", "100"))
+
+# ผู้ส่งได้คำเตือน "Room is busy" ไม่เกินหนึ่งครั้งต่อเวลาที่ bucket ของห้องใช้เติมจนเต็ม (วินาที)
+# A sender gets at most one "Room is busy" notice per time the room bucket takes to refill (seconds)
+ROOM_BUSY_NOTICE_SECONDS = ROOM_RATE_BURST / ROOM_RATE_PER_SECOND if ROOM_RATE_PER_SECOND > 0 else 1.0
+
+# ขนาดข้อความสูงสุด (UTF-8 bytes), ช่วงเวลาที่ข้อความซ้ำจะถูกทิ้ง (วินาที)
+# และจำนวนครั้งที่ผิดติดกันก่อนตัดการเชื่อมต่อ
+# Max message size (UTF-8 bytes), window in which a repeated message is dropped (seconds),
+# and consecutive violations before the connection is closed
+MAX_MESSAGE_BYTES = int(os.getenv("MAX_MESSAGE_BYTES", "2000"))
+DUPLICATE_WINDOW_SECONDS = float(os.getenv("DUPLICATE_WINDOW_SECONDS", "10"))
+FLOOD_DISCONNECT_AFTER = int(os.getenv("FLOOD_DISCONNECT_AFTER", "20"))
+
+# ประวัติแชทต่อห้องที่ส่งให้ผู้ที่เข้ามาทีหลัง: จำนวนข้อความ และขนาดรวม (bytes) สูงสุด; 0 = ปิด
+# Per-room chat history replayed to late joiners: max messages and max total bytes; 0 = disabled
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "50"))
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", "16384"))
+
+# broker สำหรับแชร์ห้องระหว่างหลาย worker: ว่าง = process เดียว, unix:///path/to.sock = ใช้ broker กลาง
+# Broker for sharing rooms across workers: empty = single process, unix:///path/to.sock = shared broker
+BROKER_URL = os.getenv("BROKER_URL", "").strip()
+
+# ข้อมูลที่ค้างส่งใน socket ของ broker ได้สูงสุด (bytes); ปลายทางที่อ่านไม่ทันจะถูกตัดแล้วต่อใหม่พร้อม sync
+# Most bytes allowed to pile up on a broker socket; a peer that cannot keep up is
+# disconnected and resyncs when it reconnects
+BROKER_MAX_BUFFER_BYTES = 8 * 1024 * 1024
+
+# เปิด /metrics (Prometheus) และ token ที่ต้องส่งมาด้วย (Authorization: Bearer ... หรือ ?token=)
+# Enable /metrics (Prometheus) and the token it requires (Authorization: Bearer ... or ?token=)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").strip().lower() in ("1", "true", "yes")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# ตรวจ event loop: ความถี่ในการวัด lag (ms, 0 = ปิด) และเกณฑ์ที่ถือว่า callback ช้า (ms)
+# Event-loop monitor: lag sampling interval (ms, 0 = off) and the slow-callback threshold (ms)
+LOOP_MONITOR_INTERVAL_MS = int(os.getenv("LOOP_MONITOR_INTERVAL_MS", "100"))
+SLOW_CALLBACK_MS = int(os.getenv("SLOW_CALLBACK_MS", "100"))
+
+# ไฟล์ JSON lines ที่บันทึก callback ช้าไว้วิเคราะห์ทีหลัง (ว่าง = ไม่บันทึก)
+# JSON-lines file that slow callbacks are appended to for offline analysis (empty = off)
+LOOP_MONITOR_DUMP = os.getenv("LOOP_MONITOR_DUMP", "").strip()
+
+# token สำหรับ endpoint /admin/* (ว่าง = เปิดเฉพาะ ENVIRONMENT=development)
+# Token for the /admin/* endpoints (empty = only available when ENVIRONMENT=development)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# ช่วงเวลา (ms) ที่รวมการเปลี่ยนแปลงห้องว่างก่อนส่งทาง /rooms/stream และช่วง keepalive (วินาที)
+# Window (ms) in which room-availability changes are coalesced for /rooms/stream, and the keepalive (seconds)
+ROOM_STREAM_INTERVAL_MS = int(os.getenv("ROOM_STREAM_INTERVAL_MS", "250"))
+ROOM_STREAM_KEEPALIVE_SECONDS = 15
+
+# จำนวน event สูงสุดที่ค้างต่อผู้ฟัง ถ้าเกินจะส่ง snapshot ใหม่แทน
+# Most events queued per listener; beyond this it gets a fresh snapshot instead
+ROOM_STREAM_QUEUE_SIZE = 256
+
+# ไฟล์ snapshot สถานะห้องตอน shutdown และโหลดกลับตอน start (ว่าง = ปิด)
+# File the room state is snapshotted to on shutdown and restored from on start (empty = off)
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "").strip()
+
+# snapshot ที่เก่ากว่านี้ (วินาที) จะไม่ถูกโหลด
+# Snapshots older than this (seconds) are not restored
+SNAPSHOT_MAX_AGE_SECONDS = int(os.getenv("SNAPSHOT_MAX_AGE_SECONDS", "300"))
+
+# เวลา (วินาที) ที่จองที่นั่งให้ผู้ใช้จาก snapshot กลับมาต่อ ก่อนปล่อยที่นั่ง
+# Seconds a restored user's seat is held for their reconnect before it is released
+RESUME_WINDOW_SECONDS = int(os.getenv("RESUME_WINDOW_SECONDS", "60"))
+
+# คิวรอห้องของผู้โดยสาร: เวลารอสูงสุด (วินาที), เวลาที่จองที่นั่งหลังได้ห้องจนกว่าจะเชื่อมต่อ (วินาที)
+# และจำนวนคนรอสูงสุดต่อ transport_type
+# Passenger matchmaking queue: longest wait (seconds), how long an assigned seat is held
+# until the passenger connects (seconds), and the most passengers waiting per transport_type
+MATCH_MAX_WAIT_SECONDS = int(os.getenv("MATCH_MAX_WAIT_SECONDS", "120"))
+MATCH_RESERVATION_SECONDS = int(os.getenv("MATCH_RESERVATION_SECONDS", "15"))
+MATCH_QUEUE_MAX = int(os.getenv("MATCH_QUEUE_MAX", "1000"))
+
+# long poll ของ GET /rooms/queue/{ticket} รอได้นานสุดเท่านี้ (วินาที)
+# ตั๋วที่ไม่ถูก poll นานกว่า MATCH_ABANDON_SECONDS ถือว่าผู้ใช้ไปแล้ว
+# Longest a GET /rooms/queue/{ticket} long poll waits (seconds); tickets not polled
+# for MATCH_ABANDON_SECONDS are treated as abandoned
+MATCH_POLL_SECONDS = 25
+MATCH_ABANDON_SECONDS = MATCH_POLL_SECONDS + 10
+
+# admission control ก่อน accept WebSocket: จำนวน connection สูงสุด (0 = ไม่จำกัด),
+# อัตรา connect ใหม่ทั้ง server และต่อ IP (ครั้ง/วินาที และ burst; 0 = ไม่จำกัด)
+# ต่อ IP ปิดไว้โดยปริยายเพราะผู้ใช้ใน network มหาวิทยาลัยมักออกผ่าน NAT IP เดียวกัน
+# Admission control before a WebSocket is accepted: max concurrent connections (0 = unlimited),
+# and the rate of new connects server-wide and per client IP (per second and burst; 0 = unlimited).
+# Per-IP is off by default because campus users often share one NAT address
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", "10000"))
+CONNECT_RATE_PER_SECOND = float(os.getenv("CONNECT_RATE_PER_SECOND", "100"))
+CONNECT_RATE_BURST = int(os.getenv("CONNECT_RATE_BURST", "200"))
+CONNECT_RATE_PER_IP = float(os.getenv("CONNECT_RATE_PER_IP", "0"))
+CONNECT_BURST_PER_IP = int(os.getenv("CONNECT_BURST_PER_IP", "10"))
+
+# ปฏิเสธ connect ใหม่เมื่อ event loop lag (ms) หรือจำนวน frame ค้างในคิวขาออกรวมเกินค่านี้ (0 = ไม่ตรวจ)
+# Shed new connects while event-loop lag (ms) or the total frames queued for sending exceed these (0 = off)
+SHED_LOOP_LAG_MS = int(os.getenv("SHED_LOOP_LAG_MS", "250"))
+SHED_QUEUE_DEPTH = int(os.getenv("SHED_QUEUE_DEPTH", "50000"))
+
+# วิธีสุ่มห้องสำหรับ /rooms/random: none (สุ่มเท่ากัน), seats (ตามที่นั่งว่าง), time (ตามเวลาที่เหลือ)
+# How /rooms/random picks a room: none (uniform), seats (by free seats), time (by time remaining)
+RANDOM_ROOM_WEIGHTING = os.getenv("RANDOM_ROOM_WEIGHTING", "none").strip().lower()
+if RANDOM_ROOM_WEIGHTING not in ("none", "seats", "time"):
+    raise RuntimeError("RANDOM_ROOM_WEIGHTING must be one of: none, seats, time")
+
+# กรองคำหยาบในข้อความแชท (คำถูกแทนด้วย *) ด้วย thread pool นอก event loop; ไฟล์คำเพิ่มเติม
+# (หนึ่งคำต่อบรรทัด, # เป็น comment) รวมกับรายการตั้งต้น
+# Filter profanity out of chat lines (matches become *) on a thread pool off the event loop;
+# an optional word file (one term per line, # comments) extends the built-in list
+MODERATION_ENABLED = os.getenv("MODERATION_ENABLED", "true").strip().lower() in ("1", "true", "yes")
+MODERATION_WORDS_PATH = os.getenv("MODERATION_WORDS_PATH", "").strip()
+MODERATION_WORKERS = int(os.getenv("MODERATION_WORKERS", "1"))
+
+# ข้อความที่รอตรวจเกินเท่านี้ = overload: ส่งต่อโดยไม่ตรวจ (pass-through) จนกว่าคิวจะลดลง
+# More messages awaiting review than this counts as overload: pass them through unchecked until it drains
+MODERATION_MAX_PENDING = int(os.getenv("MODERATION_MAX_PENDING", "500"))
+
 # ตั้งค่า CORS Middleware เพื่ออนุญาตการเชื่อมต่อจาก Frontend
 # Configure CORS Middleware to allow connections from Frontend
 app.add_middleware(
@@ -66,6 +303,10 @@ app.add_middleware(
 # 2. DATA MODELS (โมเดลข้อมูล)
 # ==============================================================================
 
+# ประเภทยานพาหนะที่รองรับ (ตรงกับ ROOM_TYPES ใน drch/app/lib/constants.js)
+# Supported transport types (matching ROOM_TYPES in drch/app/lib/constants.js)
+TRANSPORT_TYPES = ("motorcycle", "taxi", "location", "evmini")
+
 class RoomCreate(BaseModel):
     """
     โมเดลสำหรับสร้างห้องแชทใหม่
@@ -83,488 +324,4218 @@ class RoomCreate(BaseModel):
     transport_type: str
 
 
+class QueueJoin(BaseModel):
+    """
+    โมเดลสำหรับเข้าคิวรอห้อง (เฉพาะผู้โดยสาร)
+    Model for joining the room queue (passengers only)
+    
+    Attributes:
+        username: ชื่อผู้ใช้ที่จะใช้เชื่อมต่อ WebSocket
+        user_type: ประเภทผู้ใช้ - ต้องเป็น passenger
+        transport_type: ประเภทยานพาหนะที่ต้องการ
+    """
+    username: str
+    user_type: str
+    transport_type: str
+
+
 # ==============================================================================
-# 3. CONNECTION MANAGER CLASS (คลาสจัดการการเชื่อมต่อ)
+# 3. CONNECTION HELPERS (ตัวช่วยจัดการการเชื่อมต่อ)
 # ==============================================================================
 
-class ConnectionManager:
+# ประเภทของ frame ที่ส่งออก
+# Kinds of outbound frames
+FRAME_CHAT = "chat"            # ข้อความแชทและข้อความ System ทั่วไป (ทิ้งได้เมื่อคิวเต็ม)
+FRAME_PRESENCE = "presence"    # รายชื่อผู้ใช้ในห้อง (รวมเหลืออันล่าสุดได้)
+FRAME_CONTROL = "control"      # คำสั่งถึง client เช่น ROOM_CHANGE (ห้ามทิ้ง)
+
+# protocol ของ WebSocket ที่ client เลือกได้ (?protocol=... หรือ subprotocol)
+# WebSocket wire protocols a client can pick (?protocol=... or a subprotocol)
+PROTOCOL_TEXT = "text"          # ข้อความ string แบบเดิม (ค่าเริ่มต้น)
+PROTOCOL_JSON = "json"          # envelope JSON {t, r, s, ts, d}
+PROTOCOL_MSGPACK = "msgpack"    # envelope เดียวกันแบบ MessagePack (ต้องติดตั้ง msgpack)
+PROTOCOL_VERSION = 1
+
+# subprotocol (Sec-WebSocket-Protocol) ที่รองรับ
+# Supported subprotocols (Sec-WebSocket-Protocol)
+SUBPROTOCOLS = {
+    "drivechat.v1.json": PROTOCOL_JSON,
+    "drivechat.v1.msgpack": PROTOCOL_MSGPACK,
+}
+
+# event จาก client แบบมีชนิดที่แปลงเป็นคำสั่งแบบเดิม
+# Typed client events that map onto the legacy text commands
+CLIENT_COMMANDS = {"who": "/who", "return": "/return", "pong": "/pong"}
+
+
+# ห้องพิเศษที่แบ่ง shard อัตโนมัติ: shard แรกคือห้องเดิม, shard ถัดไปชื่อ ped_pong#2, ped_pong#3, ...
+# client เห็นแต่ชื่อห้องพิเศษ (logical) เสมอ
+# Special rooms are sharded automatically: the first shard is the room itself, the
+# next ones are named ped_pong#2, ped_pong#3, ...; clients only ever see the logical name
+SPECIAL_ROOMS = ("duck_pond", "ped_pong")
+SHARD_SEPARATOR = "#"
+
+
+def logical_room(room: Optional[str]) -> Optional[str]:
     """
-    คลาสหลักสำหรับจัดการการเชื่อมต่อ WebSocket และห้องแชท
-    Main class for managing WebSocket connections and chat rooms
-    
-    หน้าที่หลัก (Main responsibilities):
-    - จัดการการเชื่อมต่อ/ตัดการเชื่อมต่อ WebSocket
-    - จัดการห้องแชท (สร้าง, ลบ, ย้ายผู้ใช้)
-    - ส่งข้อความ broadcast ไปยังผู้ใช้ในห้อง
-    - จัดการ timer สำหรับ transition ไปยัง ped_pong
+    ชื่อห้องที่ client เห็น: shard ของห้องพิเศษกลายเป็นชื่อห้องพิเศษ ห้องอื่นคงเดิม
+    The room name clients see: a special room's shard maps to the special room, anything else is unchanged
     """
+    if room and SHARD_SEPARATOR in room:
+        base = room.split(SHARD_SEPARATOR, 1)[0]
+        if base in SPECIAL_ROOMS:
+            return base
+    return room
 
-    # --------------------------------------------------------------------------
-    # 3.1 INITIALIZATION (การเริ่มต้น)
-    # --------------------------------------------------------------------------
+
+def encode_payload(value, protocol: str) -> Union[str, bytes]:
+    """
+    encode ค่าตาม protocol (JSON เป็น str, MessagePack เป็น bytes)
+    Encode a value for a protocol (JSON as str, MessagePack as bytes)
+    """
+    if protocol == PROTOCOL_MSGPACK:
+        return msgpack.packb(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def asgi_send_message(payload: Union[str, bytes]) -> dict:
+    """สร้าง ASGI "websocket.send" message / Build an ASGI "websocket.send" message"""
+    if isinstance(payload, bytes):
+        return {"type": "websocket.send", "bytes": payload}
+    return {"type": "websocket.send", "text": payload}
+
+
+class OutboundFrame:
+    """
+    ข้อความหนึ่งชิ้นที่รอส่งไปยัง client
+    One message waiting to be sent to a client
     
-    def __init__(self):
+    frame หนึ่งตัวถูกใช้ร่วมกันโดยผู้รับทุกคนในห้อง: ASGI message และ UTF-8 bytes
+    ถูกสร้างครั้งเดียวตอนใช้ครั้งแรก แล้วทุก socket เขียน object เดียวกัน
+    One frame is shared by every recipient in the room: the ASGI message and the
+    UTF-8 bytes are built once on first use, then every socket writes the same object
+    
+    client แบบ protocol มีชนิดได้ envelope {t, r, s, ts, d} ของ frame เดียวกัน
+    ซึ่ง encode ครั้งเดียวต่อ protocol เช่นกัน
+    Typed-protocol clients get the same frame as a {t, r, s, ts, d} envelope,
+    also encoded once per protocol
+    
+    Attributes:
+        text: ข้อความที่จะส่ง (protocol แบบเดิม)
+        kind: ประเภท frame (FRAME_CHAT, FRAME_PRESENCE, FRAME_CONTROL)
+        event: (ชนิด, ข้อมูล) สำหรับ protocol แบบมีชนิด; None = สร้างจาก text
+        room: ห้องของ frame
+        seq: ลำดับข้อความในห้อง (เฉพาะข้อความที่ broadcast)
+        ts: เวลาที่สร้าง (epoch milliseconds)
+    """
+    __slots__ = ("text", "kind", "event", "room", "seq", "ts", "_data", "_message", "_encoded")
+
+    def __init__(self, text: str, kind: str = FRAME_CHAT, event: Optional[tuple[str, dict]] = None):
+        self.text = text
+        self.kind = kind
+        self.event = event
+        self.room: Optional[str] = None
+        self.seq: Optional[int] = None
+        self.ts = int(time.time() * 1000)
+        self._data: Optional[bytes] = None
+        self._message: Optional[dict] = None
+        self._encoded: Optional[dict] = None
+
+    @property
+    def data(self) -> bytes:
+        """ข้อความที่ encode เป็น UTF-8 แล้ว (encode ครั้งเดียว) / The UTF-8 encoded text (encoded once)"""
+        if self._data is None:
+            self._data = self.text.encode("utf-8")
+        return self._data
+
+    @property
+    def size(self) -> int:
+        """ขนาดเป็น bytes / Size in bytes"""
+        return len(self.data)
+
+    @property
+    def message(self) -> dict:
         """
-        เริ่มต้น ConnectionManager พร้อมสร้างห้องพิเศษ duck_pond และ ped_pong
-        Initialize ConnectionManager with special rooms duck_pond and ped_pong
+        ASGI "websocket.send" message ที่สร้างครั้งเดียวและใช้ร่วมกันทุก socket
+        The ASGI "websocket.send" message, built once and shared by every socket
         """
-        # เก็บ WebSocket connections แยกตามห้อง
-        # Store WebSocket connections by room
-        self.active_connections: dict[str, list[WebSocket]] = {}
-        
-        # เก็บ usernames แยกตามห้อง  
-        # Store usernames by room
-        self.active_users: dict[str, list[str]] = {}
-        
-        # เก็บข้อมูลห้องทั้งหมด (capacity, transition time, etc.)
-        # Store all room information
-        self.available_rooms: dict[str, dict] = {}
-        
-        # เก็บ cleanup tasks ของแต่ละห้อง
-        # Store cleanup tasks for each room
-        self.room_cleanup_tasks: dict[str, Optional[asyncio.Task]] = {}
-        
-        # เก็บ transition timer tasks ของแต่ละห้อง
-        # Store transition timer tasks for each room
-        self.room_transition_tasks: dict[str, asyncio.Task] = {}
-        
-        # เก็บห้องเดิมของผู้ใช้ (สำหรับกลับไปหลังจาก ped_pong)
-        # Store original rooms for users (for returning after ped_pong)
-        self.original_rooms: dict[str, str] = {}
+        if self._message is None:
+            self._message = {"type": "websocket.send", "text": self.text}
+        return self._message
 
-        # สร้างห้องพิเศษ duck_pond - ห้องสาธารณะถาวร
-        # Create special room duck_pond - permanent public room
-        self.available_rooms["duck_pond"] = {
-            "capacity": 15,
-            "next_transition": None,
-            "is_special": True,
-            "transport_type": None
-        }
-        
-        # สร้างห้องพิเศษ ped_pong - ห้องพักระหว่างทาง
-        # Create special room ped_pong - transit stop room
-        self.available_rooms["ped_pong"] = {
-            "capacity": 15,
-            "next_transition": None,
-            "is_special": True,
-            "transport_type": None
-        }
+    def envelope(self) -> dict:
+        """
+        envelope ของ protocol แบบมีชนิด: t=ชนิด, r=ห้อง, s=ลำดับ, ts=เวลา, d=ข้อมูล
+        The typed-protocol envelope: t=type, r=room, s=sequence, ts=timestamp, d=data
+        """
+        if self.event is not None:
+            event_type, data = self.event
+        elif self.text.startswith("System: "):
+            event_type, data = "system", {"m": self.text[len("System: "):]}
+        else:
+            event_type, data = "text", {"m": self.text}
+        envelope = {"t": event_type, "r": logical_room(self.room), "ts": self.ts, "d": data}
+        if self.seq is not None:
+            envelope["s"] = self.seq
+        return envelope
 
-    # --------------------------------------------------------------------------
-    # 3.2 CONNECTION MANAGEMENT (จัดการการเชื่อมต่อ)
-    # --------------------------------------------------------------------------
+    def encoded(self, protocol: str) -> Union[str, bytes]:
+        """envelope ที่ encode แล้ว (ครั้งเดียวต่อ protocol) / The encoded envelope (once per protocol)"""
+        return self._encode(protocol)[0]
 
-    async def connect(self, websocket: WebSocket, room: str, username: str):
+    def message_for(self, protocol: str) -> dict:
         """
-        เชื่อมต่อ WebSocket เข้ากับห้องแชท
-        Connect a WebSocket to a chat room
-        
-        Args:
-            websocket: การเชื่อมต่อ WebSocket
-            room: ชื่อห้องที่ต้องการเข้า
-            username: ชื่อผู้ใช้
-            
-        Raises:
-            HTTPException: ถ้าห้องไม่มีอยู่หรือห้องเต็ม
+        ASGI message ของ frame นี้ตาม protocol (ใช้ร่วมกันทุก socket)
+        This frame's ASGI message for a protocol (shared by every socket)
         """
-        # ตรวจสอบว่าห้องมีอยู่หรือไม่
-        # Check if room exists
-        if room not in self.available_rooms:
-            raise HTTPException(status_code=400, detail="Room does not exist")
+        if protocol == PROTOCOL_TEXT:
+            return self.message
+        return self._encode(protocol)[1]
 
-        # ตรวจสอบว่าห้องเต็มหรือไม่
-        # Check if room is full
-        if (room in self.active_users and 
-            len(self.active_users[room]) >= self.available_rooms[room]["capacity"]):
-            raise HTTPException(status_code=400, detail="Room is full")
+    def _encode(self, protocol: str) -> tuple[Union[str, bytes], dict]:
+        if self._encoded is None:
+            self._encoded = {}
+        cached = self._encoded.get(protocol)
+        if cached is None:
+            payload = encode_payload(self.envelope(), protocol)
+            cached = self._encoded[protocol] = (payload, asgi_send_message(payload))
+        return cached
 
-        # ยอมรับการเชื่อมต่อ WebSocket
-        # Accept WebSocket connection
-        await websocket.accept()
 
-        # สร้าง list ใหม่ถ้าห้องยังไม่มี connections
-        # Create new list if room has no connections yet
-        if room not in self.active_connections:
-            self.active_connections[room] = []
-            self.active_users[room] = []
+def batch_message(frames: list[OutboundFrame], protocol: str) -> dict:
+    """
+    รวมหลาย frame เป็น array frame เดียว โดยต่อ envelope ที่ encode ไว้แล้วของแต่ละ frame
+    Pack several frames into one array frame by joining each frame's already-encoded envelope
+    
+    Args:
+        frames: frame ที่จะรวม (เรียงตามลำดับส่ง)
+        protocol: PROTOCOL_JSON หรือ PROTOCOL_MSGPACK
+    """
+    payloads = [frame.encoded(protocol) for frame in frames]
+    if protocol == PROTOCOL_MSGPACK:
+        count = len(payloads)
+        if count < 16:
+            header = bytes([0x90 | count])
+        elif count < 0x10000:
+            header = b"\xdc" + count.to_bytes(2, "big")
+        else:
+            header = b"\xdd" + count.to_bytes(4, "big")
+        return asgi_send_message(header + b"".join(payloads))
+    return asgi_send_message("[" + ",".join(payloads) + "]")
 
-        # ยกเลิก cleanup task ถ้ามีคนเข้าห้อง
-        # Cancel cleanup task if someone joins
-        if room in self.room_cleanup_tasks and self.room_cleanup_tasks[room]:
-            self.room_cleanup_tasks[room].cancel()
-            self.room_cleanup_tasks[room] = None
 
-        # เพิ่มผู้ใช้เข้าห้อง
-        # Add user to room
-        self.active_connections[room].append(websocket)
-        self.active_users[room].append(username)
+def negotiate_protocol(websocket: WebSocket) -> tuple[str, Optional[str]]:
+    """
+    เลือก protocol ของ connection จาก subprotocol ที่ client เสนอ หรือ ?protocol=
+    Pick a connection's protocol from the offered subprotocols or ?protocol=
+    
+    ถ้าขอ msgpack แต่ไม่ได้ติดตั้ง จะใช้ JSON แทน
+    msgpack falls back to JSON when the package is not installed
+    
+    Returns:
+        (protocol, subprotocol ที่จะตอบรับ หรือ None)
+    """
+    for offered in websocket.scope.get("subprotocols", []):
+        protocol = SUBPROTOCOLS.get(offered)
+        if protocol and (protocol != PROTOCOL_MSGPACK or msgpack is not None):
+            return protocol, offered
+
+    requested = websocket.query_params.get("protocol", PROTOCOL_TEXT).lower()
+    if requested == PROTOCOL_MSGPACK and msgpack is None:
+        return PROTOCOL_JSON, None
+    if requested in (PROTOCOL_JSON, PROTOCOL_MSGPACK):
+        return requested, None
+    return PROTOCOL_TEXT, None
+
+
+async def receive_client_text(websocket: WebSocket, protocol: str) -> Optional[str]:
+    """
+    รับข้อความหนึ่งชิ้นจาก client แล้วแปลงเป็นรูปแบบเดิม (ข้อความแชท หรือ /who, /return)
+    Receive one client message and translate it to the legacy form (chat text, or /who, /return)
+    
+    client แบบมีชนิดส่ง {"t": "chat", "d": {"m": "..."}}, {"t": "who"}, {"t": "return"} หรือ {"t": "pong"}
+    (ข้อความ text ที่ไม่ใช่ envelope ถือเป็นข้อความแชท)
+    Typed clients send {"t": "chat", "d": {"m": "..."}}, {"t": "who"}, {"t": "return"} or {"t": "pong"}
+    (a text frame that is not an envelope counts as chat)
+    
+    Returns:
+        ข้อความ หรือ None ถ้าเป็น event ที่ไม่รู้จัก
+        
+    Raises:
+        WebSocketDisconnect: เมื่อ client ตัดการเชื่อมต่อ
+    """
+    if protocol == PROTOCOL_TEXT:
+        return await websocket.receive_text()
+
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    raw = message["text"] if message.get("text") is not None else message.get("bytes")
+    try:
+        if isinstance(raw, bytes) and msgpack is not None:
+            event = msgpack.unpackb(raw)
+        else:
+            event = json.loads(raw)
+    except (TypeError, ValueError):
+        event = None
+    if not isinstance(event, dict):
+        return raw if isinstance(raw, str) else None
+
+    event_type = event.get("t")
+    if event_type == "chat":
+        data = event.get("d")
+        text = data.get("m") if isinstance(data, dict) else None
+        return text if isinstance(text, str) else None
+    return CLIENT_COMMANDS.get(event_type)
+
+
+class ConnectionWriter:
+    """
+    คิวขาออกแบบจำกัดขนาดพร้อม writer task ของแต่ละ connection
+    Bounded outbound queue with a dedicated writer task for one connection
+    
+    ผู้ส่ง (เช่น broadcast) แค่ใส่ frame ลงคิวแล้วกลับทันที
+    writer task เป็นตัวเดียวที่เขียนลง socket จริง
+    Senders (e.g. broadcast) only enqueue and return immediately;
+    the writer task is the only coroutine that writes to the socket
+    
+    เมื่อส่งไม่สำเร็จหรือคิวล้นจนต้องตัด จะเรียก on_failure(websocket) หนึ่งครั้ง
+    และหลังส่งสำเร็จแต่ละครั้งเรียก on_sent(วินาที) ด้วยเวลาตั้งแต่ frame ที่เก่าที่สุดเข้าคิวจนส่งเสร็จ
+    On a failed send, or an overflow that requires eviction,
+    on_failure(websocket) is called exactly once; after every completed send,
+    on_sent(seconds) gets the time from the oldest frame's enqueue to the end of the send
+    """
 
-    async def disconnect(self, websocket: WebSocket, room: str):
+    def __init__(
+        self,
+        websocket: WebSocket,
+        on_failure: Callable[[WebSocket], None],
+        maxsize: int = OUTBOUND_QUEUE_SIZE,
+        policy: str = OUTBOUND_OVERFLOW_POLICY,
+        protocol: str = PROTOCOL_TEXT,
+        on_sent: Optional[Callable[[float], None]] = None,
+        clock: Callable[[], float] = time.monotonic,
+        call_later: Optional[Callable] = None,
+    ):
+        self.websocket = websocket
+        self.on_failure = on_failure
+        self.maxsize = maxsize
+        self.policy = policy
+        self.protocol = protocol
+        self.on_sent = on_sent
+        self.clock = clock
+        # timer ของ timeout การส่ง (None = loop.call_later, VirtualClock.call_later ใน simulation)
+        # Timer for the send timeout (None = loop.call_later; VirtualClock.call_later in simulations)
+        self.call_later = call_later
+        self.queue: deque[OutboundFrame] = deque()
+        # เวลาที่แต่ละ frame เข้าคิว (คู่กับ queue ทีละตำแหน่ง) / When each frame was queued (parallel to queue)
+        self.queued_at: deque[float] = deque()
+        self.ready = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.failed = False
+        self.timed_out = False
+        self.dropped = 0
+        # ห้องและลำดับของ frame ล่าสุดที่ส่งออกไปแล้ว (ใช้ replay เมื่อ client ไม่ได้บอก last_seq)
+        # Room and seq of the newest frame actually sent (for replay when the client gives no last_seq)
+        self.sent_room: Optional[str] = None
+        self.sent_seq = 0
+
+    def start(self):
+        """เริ่ม writer task / Start the writer task"""
+        self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        """หยุด writer task และทิ้ง frame ที่ค้าง / Stop the writer and discard pending frames"""
+        if self.task and self.task is not asyncio.current_task():
+            self.task.cancel()
+        self.queue.clear()
+        self.queued_at.clear()
+
+    def enqueue(self, frame: OutboundFrame) -> bool:
         """
-        ตัดการเชื่อมต่อ WebSocket จากห้องแชท
-        Disconnect a WebSocket from a chat room
+        ใส่ frame ลงคิว (ไม่ block)
+        Put a frame on the queue without blocking
         
-        Args:
-            websocket: การเชื่อมต่อ WebSocket ที่จะตัด
-            room: ชื่อห้องที่จะออก
-        """
-        if room in self.active_connections:
-            if websocket in self.active_connections[room]:
-                # หา index ของ websocket เพื่อหา username
-                # Find websocket index to get username
-                index = self.active_connections[room].index(websocket)
-                username = self.active_users[room][index]
-                
-                # ลบ connection และ username ออกจากห้อง
-                # Remove connection and username from room
-                self.active_connections[room].remove(websocket)
-                self.active_users[room].remove(username)
-
-                # ลบ tracking ห้องเดิมของผู้ใช้
-                # Clean up user's original room tracking
-                if username in self.original_rooms:
-                    del self.original_rooms[username]
-
-                # แจ้งคนในห้องว่ามีคนออก
-                # Notify room that someone left
-                await self.broadcast(f"System: {username} has left the chat", room)
-                await self.broadcast_user_list(room)
-
-                # ลบห้องถ้าไม่มีคนเหลือ (ยกเว้นห้องพิเศษ)
-                # Delete room if empty (except special rooms)
-                if len(self.active_users[room]) == 0 and room not in ["duck_pond", "ped_pong"]:
-                    if room in self.room_transition_tasks:
-                        self.room_transition_tasks[room].cancel()
-                        del self.room_transition_tasks[room]
-                    # Clean up all room data
-                    del self.available_rooms[room]
-                    del self.active_connections[room]
-                    del self.active_users[room]
+        Returns:
+            bool: False ถ้า connection ถูกตัดเพราะเสียหรือคิวล้น
+        """
+        if self.failed:
+            return False
+        if len(self.queue) >= self.maxsize and not self._make_room(frame):
+            self._fail("outbound queue overflow")
+            return False
+        self.queue.append(frame)
+        self.queued_at.append(self.clock())
+        self.ready.set()
+        return True
 
-    # --------------------------------------------------------------------------
-    # 3.3 ROOM TRANSITION MANAGEMENT (จัดการการย้ายห้อง)
-    # --------------------------------------------------------------------------
+    def enqueue_many(self, frames: list[OutboundFrame]) -> bool:
+        """
+        ใส่หลาย frame ลงคิวในครั้งเดียว (ใช้ตอน replay ประวัติ)
+        Put several frames on the queue at once (used for history replay)
+        
+        ใส่เฉพาะเท่าที่คิวยังว่าง โดยเก็บ frame ล่าสุดไว้ ไม่ทำให้คิวล้น
+        Only as many as the queue has room for, keeping the newest; never overflows
+        
+        Returns:
+            bool: False ถ้า connection เสียไปแล้ว
+        """
+        if self.failed:
+            return False
+        free = self.maxsize - len(self.queue)
+        if free <= 0 or not frames:
+            return True
+        frames = frames[-free:]
+        self.queue.extend(frames)
+        self.queued_at.extend([self.clock()] * len(frames))
+        self.ready.set()
+        return True
 
-    async def move_users_to_ped_pong(self, room: str):
+    def _make_room(self, incoming: OutboundFrame) -> bool:
         """
-        ย้ายผู้ใช้ทั้งหมดจากห้องหนึ่งไปยัง ped_pong (ป้ายพักรถ)
-        Move all users from a room to ped_pong (transit stop)
+        พยายามเคลียร์ที่ในคิวตามนโยบาย overflow
+        Try to free a slot according to the overflow policy
         
-        ฟังก์ชันนี้ถูกเรียกเมื่อ timer ของห้องหมดเวลา
-        This function is called when room timer expires
+        Returns:
+            bool: True ถ้ามีที่ว่างแล้ว, False ถ้าต้องตัด connection
+        """
+        if self.policy == "disconnect":
+            return False
+
+        # coalesce: รายชื่อผู้ใช้ที่ค้างอยู่ล้าสมัยแล้ว เก็บไว้แค่อันล่าสุด
+        # coalesce: pending user lists are stale, only the newest matters
+        if self.policy == "coalesce":
+            presence = [f for f in self.queue if f.kind == FRAME_PRESENCE]
+            if incoming.kind == FRAME_PRESENCE and presence:
+                stale = set(map(id, presence))
+            else:
+                stale = set(map(id, presence[:-1]))
+            if stale:
+                kept = [(f, t) for f, t in zip(self.queue, self.queued_at) if id(f) not in stale]
+                self.queue = deque(f for f, _ in kept)
+                self.queued_at = deque(t for _, t in kept)
+                self.dropped += len(stale)
+                return True
+
+        # ทิ้งข้อความแชทที่เก่าที่สุด (ไม่ทิ้ง control frame)
+        # Drop the oldest chat line (control frames are never dropped)
+        for index, frame in enumerate(self.queue):
+            if frame.kind != FRAME_CONTROL:
+                del self.queue[index]
+                del self.queued_at[index]
+                self.dropped += 1
+                return True
+        return False
+
+    def _fail(self, reason: str):
+        """ทำเครื่องหมายว่า connection เสีย แล้วแจ้ง manager / Mark as failed and notify the manager"""
+        if self.failed:
+            return
+        self.failed = True
+        self.queue.clear()
+        self.queued_at.clear()
+        print(f"Dropping slow or dead connection: {reason}")
+        self.on_failure(self.websocket)
+
+    def _on_send_timeout(self):
+        """ส่งนานเกิน SEND_TIMEOUT_SECONDS: ยกเลิกการส่ง / A send took too long: cancel it"""
+        self.timed_out = True
+        self.task.cancel()
+
+    async def _run(self):
+        """
+        วนส่ง frame จากคิวทีละอัน โดยแต่ละการส่งมี timeout
+        Drain the queue one frame at a time, each send bounded by a timeout
         
-        Args:
-            room: ชื่อห้องที่จะย้ายผู้ใช้ออก
+        timeout ใช้ timer ของ loop (call_later) แทน asyncio.wait_for
+        ซึ่งสร้าง Task ใหม่ทุกครั้งที่ส่ง (แพงมากเมื่อห้องใหญ่)
+        The timeout is a loop timer (call_later) instead of asyncio.wait_for,
+        which creates a new Task for every send (costly in large rooms)
+        
+        client แบบมีชนิดได้ทุก frame ที่ค้างในคิวรวมเป็น array frame เดียว
+        Typed-protocol clients get every queued frame packed into one array frame
         """
-        # ไม่ย้ายถ้าเป็นห้องพิเศษหรือไม่มี connections
-        # Don't move if special room or no connections
-        if room in ["ped_pong", "duck_pond"] or not self.active_connections.get(room):
+        call_later = self.call_later or asyncio.get_running_loop().call_later
+        while True:
+            if not self.queue:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            frame = self.queue.popleft()
+            queued_at = self.queued_at.popleft()
+            batch = [frame]
+            if self.protocol == PROTOCOL_TEXT:
+                message = frame.message
+            elif self.queue:
+                batch.extend(self.queue)
+                self.queue.clear()
+                self.queued_at.clear()
+                message = batch_message(batch, self.protocol)
+            else:
+                message = frame.message_for(self.protocol)
+            deadline = call_later(SEND_TIMEOUT_SECONDS, self._on_send_timeout)
+            try:
+                await self.websocket.send(message)
+            except asyncio.CancelledError:
+                if not self.timed_out:
+                    raise
+                self._fail("send timed out")
+                return
+            except Exception as e:
+                self._fail(f"send failed ({e!r})")
+                return
+            finally:
+                deadline.cancel()
+            if self.on_sent is not None:
+                self.on_sent(self.clock() - queued_at)
+            for sent in reversed(batch):
+                if sent.seq is not None:
+                    self.sent_room, self.sent_seq = sent.room, sent.seq
+                    break
+
+
+# รูปแบบการรับรายชื่อผู้ใช้ของ client
+# How a client receives the room's user list
+PRESENCE_FULL = "full"      # ข้อความ "Active users (...)" ทั้งรายการ (ค่าเริ่มต้น)
+PRESENCE_DELTA = "delta"    # JSON เฉพาะส่วนที่เปลี่ยน + version (ขอ snapshot ได้ด้วย /who)
+
+
+class RoomPresence:
+    """
+    การเปลี่ยนแปลงรายชื่อผู้ใช้ของห้องที่รอส่ง
+    Pending user-list changes of one room
+    
+    Attributes:
+        version: เลข version ของรายชื่อ (เพิ่มทีละ 1 ทุกครั้งที่ส่ง delta)
+        joined: ชื่อผู้ที่เข้ามาในช่วง debounce นี้
+        left: ชื่อผู้ที่ออกไปในช่วง debounce นี้
+        snapshot_requests: client แบบ delta ที่รอรับ snapshot ตอน flush
+        handle: timer ที่จะ flush การเปลี่ยนแปลง (None ถ้าไม่มีอะไรค้าง)
+    """
+    __slots__ = ("version", "joined", "left", "snapshot_requests", "handle")
+
+    def __init__(self):
+        self.version = 0
+        self.joined: list[str] = []
+        self.left: list[str] = []
+        self.snapshot_requests: set[WebSocket] = set()
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+
+class RoomBatch:
+    """
+    ข้อความของห้องที่รอส่งรวมกันในช่วง ROOM_BATCH_WINDOW_MS
+    A room's messages waiting to go out together within ROOM_BATCH_WINDOW_MS
+    
+    Attributes:
+        pending: (frame, record) ที่รอส่ง
+        handle: timer ที่จะ flush (None ถ้าไม่มีอะไรค้าง)
+        last_send: เวลา (loop.time()) ที่ส่งครั้งล่าสุด
+    """
+    __slots__ = ("pending", "handle", "last_send")
+
+    def __init__(self):
+        self.pending: list[tuple[OutboundFrame, bool]] = []
+        self.handle: Optional[asyncio.TimerHandle] = None
+        self.last_send = float("-inf")
+
+
+class RoomHistory:
+    """
+    ประวัติข้อความแชทล่าสุดของห้องหนึ่ง (ring buffer จำกัดทั้งจำนวนและขนาด)
+    Recent chat lines of one room (a ring buffer capped by count and by bytes)
+    
+    เก็บ OutboundFrame ตัวเดียวกับที่ broadcast ไปแล้ว จึงไม่ต้องสร้างข้อความใหม่ตอน replay
+    หน่วยความจำต่อห้องไม่เกิน HISTORY_MAX_BYTES และสร้างเฉพาะห้องที่มีคนพิมพ์
+    Holds the very OutboundFrames that were broadcast, so replay builds nothing new;
+    memory per room is bounded by HISTORY_MAX_BYTES and only rooms with chat get one
+    
+    Attributes:
+        frames: frame ที่เก็บไว้ (เก่าสุดอยู่หน้า)
+        sizes: ขนาด (UTF-8 bytes) ของแต่ละ frame
+        size: ขนาดรวม (bytes)
+    """
+    __slots__ = ("frames", "sizes", "size")
+
+    def __init__(self):
+        self.frames: deque[OutboundFrame] = deque()
+        self.sizes: deque[int] = deque()
+        self.size = 0
+
+    def append(self, frame: OutboundFrame):
+        """เพิ่ม frame แล้วตัดอันเก่าที่เกินขีดจำกัดทิ้ง / Add a frame and evict the oldest beyond the caps"""
+        frame_size = frame.size
+        if frame_size > HISTORY_MAX_BYTES:
             return
+        self.frames.append(frame)
+        self.sizes.append(frame_size)
+        self.size += frame_size
+        while len(self.frames) > HISTORY_MAX_MESSAGES or self.size > HISTORY_MAX_BYTES:
+            self.frames.popleft()
+            self.size -= self.sizes.popleft()
+
+    def recent(self) -> list[OutboundFrame]:
+        """frame ทั้งหมดเรียงจากเก่าไปใหม่ / Every frame, oldest first"""
+        return list(self.frames)
 
-        # เก็บข้อมูลผู้ใช้ที่จะย้าย
-        # Store users to move
-        users_to_move = list(zip(self.active_connections[room], self.active_users[room]))
 
-        # บันทึกห้องเดิมสำหรับทุกคน (เพื่อกลับมาได้)
-        # Store original room for all users (for returning)
-        for _, username in users_to_move:
-            self.original_rooms[username] = room
+class TokenBucket:
+    """
+    token bucket สำหรับจำกัดอัตรา: เติม rate token ต่อวินาที เก็บได้สูงสุด burst
+    Token bucket rate limiter: refills rate tokens per second, holds at most burst
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated", "clock")
+
+    def __init__(self, rate: float, burst: int, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.clock = clock
+        self.updated = clock()
+
+    def take(self) -> bool:
+        """ใช้ 1 token; False ถ้าไม่พอ / Spend one token; False if none is left"""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+# ผลการตรวจข้อความขาเข้า
+# Verdicts for an incoming message
+FLOOD_OK = "ok"                  # ส่งต่อได้
+FLOOD_DROP = "drop"              # ทิ้งข้อความนี้ (throttle)
+FLOOD_DISCONNECT = "disconnect"  # ผิดซ้ำเกินกำหนด: ตัดการเชื่อมต่อ
+
+
+class Member:
+    """
+    ข้อมูลผู้ใช้หนึ่งคนที่เชื่อมต่ออยู่ (หนึ่ง WebSocket)
+    One connected user (one WebSocket)
+    
+    ConnectionManager เก็บ Member ทั้งในดัชนีรายห้องและดัชนีรวมตาม socket
+    การเข้า/ออก/ค้นหา/ย้ายห้องจึงเป็น O(1) และข้อมูลไม่มีทางแยกกัน
+    ConnectionManager indexes each Member both per room and globally by
+    socket, so join, leave, lookup and move are O(1) and cannot drift apart
+    
+    Attributes:
+        websocket: การเชื่อมต่อ WebSocket
+        username: ชื่อผู้ใช้
+        role: บทบาท (passenger/driver)
+        joined_at: เวลาที่เข้าร่วม (ตาม clock ของ ConnectionManager)
+        room: ห้องปัจจุบัน
+        original_room: ห้องเดิมก่อนถูกย้ายไป ped_pong (None ถ้าไม่ได้ถูกย้าย)
+        writer: คิวขาออกของ connection นี้
+        presence: รูปแบบรายชื่อผู้ใช้ที่ client ต้องการ (PRESENCE_FULL หรือ PRESENCE_DELTA)
+        protocol: protocol ของ connection (PROTOCOL_TEXT, PROTOCOL_JSON, PROTOCOL_MSGPACK)
+        bucket: token bucket ของข้อความขาเข้า
+        last_text, last_text_at: ข้อความแชทล่าสุดและเวลา (สำหรับทิ้งข้อความซ้ำ)
+        strikes: จำนวนครั้งที่ผิดติดกัน (รีเซ็ตเมื่อส่งข้อความได้ปกติ)
+        busy_notified_at: เวลาที่ได้คำเตือน "Room is busy" ล่าสุด
+        violations: จำนวนครั้งที่ผิดทั้งหมด
+        last_seen: เวลาที่ได้รับอะไรจาก client ล่าสุด (รวม /pong)
+        last_chat: เวลาที่ส่งข้อความแชทล่าสุด (หรือเวลาที่เข้าร่วม)
+        pings: จำนวน PING ที่ส่งไปแล้วยังไม่ได้คำตอบ
+        heartbeat: client ขอรับ PING (?heartbeat=1) และตอบ /pong ได้
+        token: resume token ของ connection นี้ (None ถ้าปิด SESSION_GRACE_SECONDS)
+    """
+    __slots__ = (
+        "websocket", "username", "role", "joined_at", "room", "original_room", "writer", "presence",
+        "protocol", "bucket", "last_text", "last_text_at", "strikes", "busy_notified_at", "violations",
+        "last_seen", "last_chat", "pings", "heartbeat", "token",
+    )
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        username: str,
+        role: str,
+        writer: "ConnectionWriter",
+        presence: str = PRESENCE_FULL,
+        protocol: str = PROTOCOL_TEXT,
+        clock: Callable[[], float] = time.monotonic,
+        heartbeat: bool = False,
+    ):
+        self.websocket = websocket
+        self.username = username
+        self.role = role
+        self.joined_at = clock()
+        self.room: Optional[str] = None
+        self.original_room: Optional[str] = None
+        self.writer = writer
+        self.presence = presence
+        self.protocol = protocol
+        self.bucket = TokenBucket(USER_RATE_PER_SECOND, USER_RATE_BURST, clock)
+        self.last_text: Optional[str] = None
+        self.last_text_at = 0.0
+        self.strikes = 0
+        self.busy_notified_at = float("-inf")
+        self.violations = 0
+        self.last_seen = self.joined_at
+        self.last_chat = self.joined_at
+        self.pings = 0
+        self.heartbeat = heartbeat
+        self.token: Optional[str] = None
+
+
+class DetachedSession:
+    """
+    ผู้ใช้ที่ connection หลุดและยังอยู่ในช่วง SESSION_GRACE_SECONDS
+    A user whose connection dropped and who is still within SESSION_GRACE_SECONDS
+    
+    ระหว่างนี้ที่นั่งยังถูกจองและชื่อยังอยู่ในรายชื่อผู้ใช้ (listed) คนอื่นจึงไม่เห็นการออก/เข้าใหม่
+    While detached the seat stays held and the name stays in the user list (listed),
+    so nobody else sees a leave and a rejoin
+    
+    Attributes:
+        token: resume token ที่ client ใช้ต่อกลับ
+        username, role: ข้อมูลผู้ใช้เดิม
+        room: ห้อง (หรือ shard) ที่ผู้ใช้หลุดไป
+        original_room: ห้องเดิมก่อนถูกย้ายไป ped_pong (ใช้ /return ต่อได้)
+        since: ลำดับข้อความล่าสุดที่ส่งถึงแล้ว (replay เฉพาะหลังจากนี้)
+        listed: ยังจองที่นั่งและอยู่ในรายชื่อของ room (False หลังห้องถูกย้ายไป ped_pong)
+        handle: timer ที่จะปล่อยที่นั่งเมื่อหมดเวลา
+    """
+    __slots__ = ("token", "username", "role", "room", "original_room", "since", "listed", "handle")
+
+    def __init__(self, member: "Member", since: Optional[int]):
+        self.token = member.token
+        self.username = member.username
+        self.role = member.role
+        self.room = member.room
+        self.original_room = member.original_room
+        self.since = since
+        self.listed = True
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+
+class RoomDirectory:
+    """
+    ดัชนีห้องที่ยังมีที่นั่งว่าง (และยังรับคนใหม่) แยกตาม transport_type
+    Index of rooms that still have free seats (and are still boarding), keyed by transport_type
+    
+    ConnectionManager อัพเดทดัชนีทุกครั้งที่จำนวนคนในห้องเปลี่ยน
+    การสุ่มห้องจึงเป็น O(1) แทนการวนดูทุกห้อง
+    ConnectionManager updates the index whenever a room's occupancy changes,
+    so picking a random room is O(1) instead of a scan over every room
+    """
+
+    def __init__(self):
+        # ห้องที่ว่างของแต่ละ transport_type (list เพื่อสุ่มได้ O(1))
+        # Open rooms per transport_type (a list so random picks are O(1))
+        self.open_rooms: dict[str, list[str]] = {}
+
+        # ตำแหน่งของห้องใน list และ transport_type ของห้อง
+        # Position of each room in its list, and its transport_type
+        self.positions: dict[str, int] = {}
+        self.transport_types: dict[str, str] = {}
+
+    def update(self, room: str, transport_type: Optional[str], has_space: bool):
+        """
+        เพิ่มหรือลบห้องจากดัชนีตามสถานะที่นั่ง
+        Add or remove a room from the index according to seat availability
+        
+        Args:
+            room: ชื่อห้อง
+            transport_type: ประเภทยานพาหนะของห้อง (None = ห้องพิเศษ ไม่ถูก index)
+            has_space: ห้องยังมีที่นั่งว่างหรือไม่
+        """
+        if has_space and transport_type is not None:
+            if room not in self.positions:
+                rooms = self.open_rooms.setdefault(transport_type, [])
+                self.positions[room] = len(rooms)
+                self.transport_types[room] = transport_type
+                rooms.append(room)
+        else:
+            self.remove(room)
+
+    def remove(self, room: str):
+        """
+        ลบห้องออกจากดัชนี (สลับกับตัวสุดท้ายแล้ว pop เพื่อให้เป็น O(1))
+        Remove a room from the index (swap with the last entry and pop, O(1))
+        """
+        index = self.positions.pop(room, None)
+        if index is None:
+            return
+        rooms = self.open_rooms[self.transport_types.pop(room)]
+        last = rooms.pop()
+        if last != room:
+            rooms[index] = last
+            self.positions[last] = index
+
+    def rooms_for(self, transport_type: str) -> list[str]:
+        """ห้องที่ยังว่างของ transport_type นี้ / Open rooms for a transport_type"""
+        return self.open_rooms.get(transport_type, [])
+
+    def pick(self, transport_type: str, weight: Optional[Callable[[str], float]] = None) -> Optional[str]:
+        """
+        สุ่มห้องที่ว่างหนึ่งห้อง
+        Pick one open room at random
+        
+        Args:
+            transport_type: ประเภทยานพาหนะ
+            weight: ฟังก์ชันน้ำหนักของแต่ละห้อง (optional, ทำให้เป็น O(k) ตามจำนวนห้องว่าง)
+            
+        Returns:
+            ชื่อห้อง หรือ None ถ้าไม่มีห้องว่าง
+        """
+        rooms = self.open_rooms.get(transport_type)
+        if not rooms:
+            return None
+        if weight is None:
+            return random.choice(rooms)
+        weights = [max(weight(room), 0) for room in rooms]
+        if not any(weights):
+            return random.choice(rooms)
+        return random.choices(rooms, weights=weights)[0]
+
+
+# action ของ scheduler สำหรับห้อง
+# Scheduler actions for rooms
+ACTION_WARN = "warn"              # แจ้งเตือนก่อนย้ายไป ped_pong
+ACTION_TRANSITION = "transition"  # ย้ายทุกคนไป ped_pong
+
+
+# สถานะของตั๋วในคิวรอห้อง
+# Matchmaking ticket states
+TICKET_WAITING = "waiting"      # อยู่ในคิว
+TICKET_ASSIGNED = "assigned"    # ได้ห้องแล้ว ที่นั่งถูกจองไว้จนกว่าจะเชื่อมต่อ
+TICKET_JOINED = "joined"        # เชื่อมต่อเข้าห้องที่ได้แล้ว
+TICKET_EXPIRED = "expired"      # รอนานเกินหรือไม่มาใช้ที่นั่งที่จองไว้
+TICKET_CANCELLED = "cancelled"  # ผู้ใช้ยกเลิก
+TICKET_ABANDONED = "abandoned"  # ผู้ใช้หยุด poll ไปแล้ว
+
+
+class MatchTicket:
+    """
+    ผู้โดยสารหนึ่งคนที่รอห้องในคิว (หรือได้ห้องแล้วและรอเชื่อมต่อ)
+    One passenger waiting in the room queue (or assigned and about to connect)
+    
+    Attributes:
+        id: รหัสตั๋วที่ client ใช้ poll/ยกเลิก
+        username: ชื่อผู้ใช้ (ใช้จับคู่กับ WebSocket ที่เข้ามา)
+        transport_type: ประเภทยานพาหนะที่รอ
+        status: สถานะ (TICKET_*)
+        room: ห้องที่ได้ (เมื่อ TICKET_ASSIGNED)
+        created, seen, deadline: เวลาที่เข้าคิว, ที่ poll ล่าสุด และที่ตั๋วหมดอายุ (ตาม clock)
+        handle: timer ของการหมดอายุ
+        ready: ตั้งเมื่อสถานะเปลี่ยนจาก waiting (ปลุก long poll)
+    """
+    __slots__ = (
+        "id", "username", "transport_type", "status", "room", "created", "seen", "deadline", "handle", "ready",
+    )
+
+    def __init__(self, username: str, transport_type: str, now: float):
+        self.id = uuid.uuid4().hex
+        self.username = username
+        self.transport_type = transport_type
+        self.status = TICKET_WAITING
+        self.room: Optional[str] = None
+        self.created = now
+        self.seen = now
+        self.deadline = now + MATCH_MAX_WAIT_SECONDS
+        self.handle: Optional[asyncio.TimerHandle] = None
+        self.ready = asyncio.Event()
+
+
+class FeedSubscriber:
+    """
+    ผู้ฟัง /rooms/stream หนึ่งราย
+    One /rooms/stream listener
+    
+    Attributes:
+        transport_type: ประเภทยานพาหนะที่สนใจ (None = ทั้งหมด)
+        pending: event ที่รอส่ง (ชนิด, ข้อมูล)
+        ready: set เมื่อมี event ใหม่
+        overflowed: True ถ้าอ่านไม่ทันจนต้องส่ง snapshot ใหม่
+    """
+    __slots__ = ("transport_type", "pending", "ready", "overflowed")
+
+    def __init__(self, transport_type: Optional[str]):
+        self.transport_type = transport_type
+        self.pending: deque[tuple[str, dict]] = deque()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+
+
+class RoomFeed:
+    """
+    ส่งการเปลี่ยนแปลงของห้องว่าง (opened, seats, closed) ให้ผู้ฟัง /rooms/stream
+    Pushes room-availability changes (opened, seats, closed) to /rooms/stream listeners
+    
+    ConnectionManager เรียก changed(room) ทุกครั้งที่ดัชนีห้องว่างอาจเปลี่ยน
+    การเปลี่ยนแปลงถูกรวมภายใน ROOM_STREAM_INTERVAL_MS แล้วเทียบกับสิ่งที่ส่งไปแล้ว
+    (last) จึงส่งเฉพาะส่วนต่าง ถ้าไม่มีผู้ฟังจะไม่ทำอะไรเลย
+    ConnectionManager calls changed(room) whenever the open-room index may have
+    changed. Changes are coalesced over ROOM_STREAM_INTERVAL_MS and compared with
+    what was already sent (last), so only differences go out. With no listeners
+    it does nothing at all
+    
+    view(room) คืนข้อมูลห้องสำหรับ client หรือ None ถ้าไม่ใช่ห้องที่เข้าได้
+    view(room) returns the client-facing room info, or None if it is not joinable
+    """
+
+    def __init__(self, view: Callable[[str], Optional[dict]]):
+        self.view = view
+        self.subscribers: set[FeedSubscriber] = set()
+        self.last: dict[str, dict] = {}
+        self.dirty: set[str] = set()
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+    def subscribe(self, transport_type: Optional[str], rooms) -> FeedSubscriber:
+        """
+        เพิ่มผู้ฟัง (ผู้ฟังรายแรกสร้าง last จากห้องทั้งหมด)
+        Add a listener (the first one builds last from every room)
+        """
+        if not self.subscribers:
+            self.last = {room: view for room in rooms if (view := self._open_view(room))}
+        subscriber = FeedSubscriber(transport_type)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: FeedSubscriber):
+        """เอาผู้ฟังออก / Remove a listener"""
+        self.subscribers.discard(subscriber)
+        if not self.subscribers:
+            self.last.clear()
+            self.dirty.clear()
+            if self.handle:
+                self.handle.cancel()
+                self.handle = None
+
+    def snapshot(self, transport_type: Optional[str]) -> list[dict]:
+        """ห้องว่างที่ผู้ฟังเห็นอยู่ตอนนี้ / The open rooms listeners currently see"""
+        return [
+            view for view in self.last.values()
+            if transport_type is None or view["transport_type"] == transport_type
+        ]
+
+    def changed(self, room: str):
+        """บันทึกว่าห้องอาจเปลี่ยน (รวมส่งทีหลัง) / Note that a room may have changed (sent later, coalesced)"""
+        if not self.subscribers:
+            return
+        self.dirty.add(room)
+        if self.handle is None:
+            self.handle = asyncio.get_running_loop().call_later(ROOM_STREAM_INTERVAL_MS / 1000, self._flush)
+
+    def _open_view(self, room: str) -> Optional[dict]:
+        view = self.view(room)
+        return view if view and view["free"] > 0 else None
+
+    def _flush(self):
+        """
+        เทียบห้องที่เปลี่ยนกับที่ส่งไปแล้ว และส่งเฉพาะส่วนต่างให้ผู้ฟังที่เกี่ยวข้อง
+        Compare changed rooms with what was sent and push only the differences
+        """
+        self.handle = None
+        events = []
+        for room in self.dirty:
+            old = self.last.get(room)
+            new = self._open_view(room)
+            if new is None:
+                if old is not None:
+                    del self.last[room]
+                    events.append(("closed", {"room": room, "transport_type": old["transport_type"]}))
+            elif old is None:
+                self.last[room] = new
+                events.append(("opened", new))
+            elif new["free"] != old["free"]:
+                self.last[room] = new
+                events.append(("seats", new))
+        self.dirty.clear()
+
+        for subscriber in self.subscribers:
+            wanted = [
+                event for event in events
+                if subscriber.transport_type is None or event[1]["transport_type"] == subscriber.transport_type
+            ]
+            if not wanted:
+                continue
+            if len(subscriber.pending) + len(wanted) > ROOM_STREAM_QUEUE_SIZE:
+                subscriber.pending.clear()
+                subscriber.overflowed = True
+            else:
+                subscriber.pending.extend(wanted)
+            subscriber.ready.set()
+
+
+def spawn_tracked(tasks: set[asyncio.Task], coro: Awaitable) -> asyncio.Task:
+    """
+    เริ่ม task แล้วเก็บ reference ไว้ใน tasks จนกว่าจะเสร็จ (event loop เก็บ task ไว้แค่ weak reference
+    task ที่ไม่มีใครถือจึงอาจถูก GC กลางทาง) และพิมพ์ error ที่หลุดออกมาจาก task
+    Start a task and keep it in tasks until it finishes (the event loop only holds weak
+    references, so an unreferenced task can be garbage-collected mid-run), printing any
+    error that escapes it
+    """
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+
+    def finished(done: asyncio.Task):
+        tasks.discard(done)
+        if not done.cancelled() and done.exception() is not None:
+            print(f"Background task failed: {done.exception()!r}")
+
+    task.add_done_callback(finished)
+    return task
+
+
+class VirtualClock:
+    """
+    นาฬิกาจำลองสำหรับ simulation: เวลาเดินเมื่อเรียก advance เท่านั้น
+    Simulated clock: time only moves when advanced
+    
+    ส่งให้ ConnectionManager(clock=...) แล้ว deadline ของห้องจะไม่ทำงานเอง
+    ผู้เรียกต้องเลื่อนเวลาแล้วเรียก scheduler.run_due() ทำให้เล่น workload
+    ทั้งวันได้ในไม่กี่วินาที (ดู benchmarks/simulate.py)
+    Pass it to ConnectionManager(clock=...) and room deadlines stop firing on
+    their own; the caller advances time and calls scheduler.run_due(), so a
+    full day of workload replays in seconds (see benchmarks/simulate.py)
+    """
+
+    def __init__(self, start: float = 0.0):
+        self.now = start
+        # timer ของ call_later: heap ของ (เวลา, ลำดับ, handle) / call_later timers: heap of (when, seq, handle)
+        self.timers: list[tuple[float, int, VirtualTimer]] = []
+        self.counter = itertools.count()
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        """เลื่อนเวลาไปข้างหน้า / Move time forward"""
+        self.advance_to(self.now + max(0.0, seconds))
+
+    def advance_to(self, when: float):
+        """
+        เลื่อนเวลาไปถึง when (ไม่ย้อนกลับ) แล้วเรียก timer ที่ถึงเวลาตามลำดับ
+        Move time forward to when (never backwards), firing due timers in order
+        """
+        self.now = max(self.now, when)
+        while self.timers and self.timers[0][0] <= self.now:
+            _, _, timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                timer.callback()
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> "VirtualTimer":
+        """
+        เหมือน loop.call_later แต่นับตามเวลาจำลอง (ใช้กับ timeout การส่งของ ConnectionWriter)
+        Like loop.call_later, on simulated time (used for ConnectionWriter's send timeout)
+        """
+        timer = VirtualTimer(callback)
+        heapq.heappush(self.timers, (self.now + delay, next(self.counter), timer))
+        return timer
+
+
+class VirtualTimer:
+    """timer ของ VirtualClock.call_later / A VirtualClock.call_later timer"""
+    __slots__ = ("callback", "cancelled")
+
+    def __init__(self, callback: Callable[[], None]):
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class RoomScheduler:
+    """
+    ตัวจับเวลากลางตัวเดียวสำหรับ deadline ของทุกห้อง (heap + task เดียว)
+    Single scheduler for every room deadline (a heap driven by one task)
+    
+    แทนที่จะมี asyncio task ที่ sleep ค้างไว้หนึ่งตัวต่อห้อง ทุก deadline
+    อยู่ใน heap เดียวและใช้ monotonic clock การยกเลิกเป็นแบบ lazy
+    (ทำเครื่องหมายไว้แล้วข้ามตอน pop) จึงเป็น O(1) ส่วนการตั้งใหม่เป็น O(log n)
+    Instead of one sleeping asyncio task per room, every deadline lives in a
+    single heap on the monotonic clock. Cancellation is lazy (entries are
+    marked and skipped when popped) so it is O(1); rescheduling is O(log n)
+    
+    handler(room, action) จะถูกเรียกเป็น task ใหม่เมื่อถึงเวลา
+    ถ้า autorun=False (เช่นใช้ VirtualClock) จะไม่มี runner task ผู้เรียกต้องเรียก run_due() เอง
+    handler(room, action) is started as a new task when an entry comes due.
+    With autorun=False (e.g. with a VirtualClock) there is no runner task;
+    the caller drives it with run_due()
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[str, str], Awaitable],
+        clock: Callable[[], float] = time.monotonic,
+        autorun: bool = True,
+    ):
+        self.handler = handler
+        self.clock = clock
+        self.autorun = autorun
+
+        # heap ของ [deadline, seq, room, action, active]
+        # Heap of [deadline, seq, room, action, active]
+        self.heap: list[list] = []
+
+        # entry ที่ยังใช้งานอยู่ ตาม (room, action)
+        # Live entries by (room, action)
+        self.entries: dict[tuple[str, str], list] = {}
+
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+        # handler ที่กำลังทำงาน (เก็บ reference ไว้จนเสร็จ)
+        # Handlers currently running (referenced until they finish)
+        self.running: set[asyncio.Task] = set()
+
+    def schedule(self, room: str, action: str, delay: float):
+        """
+        ตั้ง (หรือตั้งใหม่) action ของห้องให้ทำงานในอีก delay วินาที
+        Schedule (or reschedule) a room action to fire in delay seconds
+        """
+        self.cancel(room, action)
+        deadline = self.clock() + delay
+        entry = [deadline, next(self.counter), room, action, True]
+        self.entries[(room, action)] = entry
+        heapq.heappush(self.heap, entry)
+
+        # ปลุก runner ถ้า deadline ใหม่มาก่อนตัวที่รออยู่
+        # Wake the runner if the new deadline is earlier than the one it awaits
+        if self.heap[0] is entry:
+            self.wakeup.set()
+        self._ensure_running()
+
+    def cancel(self, room: str, action: Optional[str] = None):
+        """
+        ยกเลิก action ของห้อง (หรือทุก action ถ้าไม่ระบุ)
+        Cancel one action of a room (or all of them if action is None)
+        """
+        actions = [action] if action else [ACTION_WARN, ACTION_TRANSITION]
+        for name in actions:
+            entry = self.entries.pop((room, name), None)
+            if entry:
+                entry[4] = False
+
+        # ล้าง entry ที่ถูกยกเลิกเมื่อสะสมเยอะเกินไป
+        # Compact the heap when cancelled entries pile up
+        if len(self.heap) > 64 and len(self.heap) > 2 * len(self.entries):
+            self.heap = [entry for entry in self.heap if entry[4]]
+            heapq.heapify(self.heap)
+
+    def deadline(self, room: str, action: str = ACTION_TRANSITION) -> Optional[float]:
+        """เวลา (monotonic) ที่ action จะทำงาน / Monotonic time at which an action fires"""
+        entry = self.entries.get((room, action))
+        return entry[0] if entry else None
+
+    def upcoming(self, limit: int = 20) -> list[dict]:
+        """
+        รายการ deadline ที่ใกล้ที่สุด
+        The nearest pending deadlines
+        
+        Returns:
+            list ของ dict (room, action, in_seconds)
+        """
+        now = self.clock()
+        nearest = heapq.nsmallest(limit, self.entries.values())
+        return [
+            {"room": room, "action": action, "in_seconds": round(deadline - now, 3)}
+            for deadline, _, room, action, _ in nearest
+        ]
+
+    def next_deadline(self) -> Optional[float]:
+        """เวลาของ deadline ถัดไปที่ยังไม่ถูกยกเลิก / Time of the next live deadline"""
+        while self.heap and not self.heap[0][4]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    async def run_due(self) -> int:
+        """
+        เรียก handler ของทุก entry ที่ถึงเวลาตาม clock ทีละตัวจนเสร็จ (สำหรับ autorun=False)
+        Run the handler of every entry due by the clock, one at a time to completion
+        (for autorun=False)
+        
+        Returns:
+            int: จำนวน entry ที่ทำงาน
+        """
+        fired = 0
+        due = self._pop_due(self.clock())
+        while due:
+            for room, action in due:
+                await self.handler(room, action)
+                fired += 1
+            # handler อาจตั้ง deadline ใหม่ที่ถึงเวลาแล้ว / handlers may schedule entries that are already due
+            due = self._pop_due(self.clock())
+        return fired
+
+    def _ensure_running(self):
+        """เริ่ม runner task ถ้ายังไม่ทำงาน / Start the runner task if it isn't running"""
+        if not self.autorun:
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def _pop_due(self, now: float) -> list[tuple[str, str]]:
+        """ดึง entry ที่ถึงเวลาแล้วออกจาก heap / Pop every entry that is due"""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, room, action, active = heapq.heappop(self.heap)
+            if active:
+                del self.entries[(room, action)]
+                due.append((room, action))
+        return due
+
+    def _fire(self, room: str, action: str):
+        """เรียก handler เป็น task แยก / Run the handler as its own task"""
+        spawn_tracked(self.running, self.handler(room, action))
+
+    async def _run(self):
+        """
+        วนรอ deadline ถัดไปแล้วเรียก handler ของทุก entry ที่ถึงเวลา
+        Sleep until the next deadline, then fire every entry that is due
+        """
+        while True:
+            self.wakeup.clear()
+            for room, action in self._pop_due(self.clock()):
+                self._fire(room, action)
+
+            # ข้าม entry ที่ถูกยกเลิกที่อยู่หัว heap
+            # Skip cancelled entries sitting at the head of the heap
+            while self.heap and not self.heap[0][4]:
+                heapq.heappop(self.heap)
+
+            timeout = self.heap[0][0] - self.clock() if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class LocalBroker:
+    """
+    broker แบบ process เดียว (ค่าเริ่มต้น): ไม่มีใครอื่นให้ส่งต่อ ทุก method จึงไม่ทำอะไร
+    Single-process broker (the default): there is nobody to relay to, so every method is a no-op
+    
+    ConnectionManager เรียก method เหล่านี้ทุกครั้งที่ broadcast, สร้าง/ลบห้อง,
+    ตั้งเวลา transition หรือสมาชิกในห้องเปลี่ยน broker แบบหลาย process
+    จะส่งต่อเหตุการณ์เหล่านี้ให้ worker อื่น
+    ConnectionManager calls these on every broadcast, room create/delete,
+    transition (re)schedule and membership change; a multi-process broker
+    relays them to the other workers
+    """
+
+    def __init__(self):
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        # ห้องที่ worker นี้ประกาศไว้ (ว่างเสมอเมื่อไม่มี broker) / Rooms this worker announced (always empty without a broker)
+        self.owned_rooms: dict[str, dict] = {}
+
+    async def start(self, manager: "ConnectionManager"):
+        """เริ่มทำงาน / Start"""
+
+    async def stop(self):
+        """หยุดทำงาน / Stop"""
+
+    def publish(
+        self, room: str, text: str, kind: str, record: bool = False, event: Optional[tuple] = None,
+        seq: Optional[int] = None,
+    ):
+        """
+        ส่งข้อความของห้องไปยัง worker อื่น (seq = ลำดับที่ worker นี้ให้ไว้ ทุก worker ใช้เลขเดียวกัน)
+        Relay a room message to other workers (seq is the number this worker gave it; every worker uses it)
+        """
+
+    def room_updated(self, room: str, info: dict):
+        """แจ้งว่าห้องถูกสร้างหรือเลื่อนเวลา / Announce a created or rescheduled room"""
+
+    def room_deleted(self, room: str):
+        """แจ้งว่าห้องถูกลบ / Announce a deleted room"""
+
+    def members_changed(self, room: str):
+        """แจ้งว่าสมาชิกใน worker นี้ของห้องเปลี่ยน / Announce this worker's members of a room changed"""
+
+
+class UnixSocketBroker(LocalBroker):
+    """
+    client ของ broker กลางผ่าน Unix socket สำหรับรันหลาย uvicorn worker
+    Client of a shared broker over a Unix socket, for running several uvicorn workers
+    
+    แต่ละ worker ยังเก็บ WebSocket ของตัวเอง แต่ส่งต่อข้อความแชท, ข้อมูลห้อง
+    (รวมเวลา transition) และรายชื่อสมาชิกผ่าน broker ทุก worker จึงเห็นห้อง
+    และจำนวนคนเท่ากัน ทำให้ /rooms/random, แชท และการย้ายไป ped_pong
+    ทำงานข้าม worker ได้ (ทุก worker ตั้งเวลาเดียวกันและย้ายสมาชิกของตัวเอง)
+    Each worker keeps its own WebSockets but relays chat lines, room info
+    (including transition deadlines) and member lists through the broker,
+    so every worker sees the same rooms and head counts: /rooms/random,
+    chat and ped_pong moves work across workers (each worker runs the same
+    deadlines and moves its own members)
+    
+    Protocol: JSON หนึ่งบรรทัดต่อข้อความ / one JSON object per line
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.manager: Optional["ConnectionManager"] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.task: Optional[asyncio.Task] = None
+        self.dirty_rooms: set[str] = set()
+        self.flush_scheduled = False
+
+    async def start(self, manager: "ConnectionManager"):
+        self.manager = manager
+        connected = asyncio.get_running_loop().create_future()
+        self.task = asyncio.create_task(self._run(connected))
+        # รอให้เชื่อมต่อครั้งแรก (ไม่เกิน 5 วินาที) เพื่อให้ได้ห้องจาก worker อื่นก่อนรับ request
+        # Wait (up to 5 s) for the first connection so other workers' rooms are known before serving
+        try:
+            await asyncio.wait_for(asyncio.shield(connected), 5)
+        except asyncio.TimeoutError:
+            print(f"Broker at {self.path} not reachable yet, retrying in background")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+        if self.writer:
+            self.writer.close()
+
+    def publish(
+        self, room: str, text: str, kind: str, record: bool = False, event: Optional[tuple] = None,
+        seq: Optional[int] = None,
+    ):
+        self._send({
+            "op": "publish", "room": room, "text": text, "kind": kind, "record": record, "event": event, "seq": seq,
+        })
+
+    def room_updated(self, room: str, info: dict):
+        self.owned_rooms[room] = info
+        self._send({"op": "room", "room": room, "info": info})
+
+    def room_deleted(self, room: str):
+        self.owned_rooms.pop(room, None)
+        self._send({"op": "room_deleted", "room": room})
+
+    def members_changed(self, room: str):
+        # รวมการเปลี่ยนแปลงในรอบ event loop เดียวกันเป็นข้อความเดียวต่อห้อง
+        # Coalesce changes within one loop iteration into one message per room
+        self.dirty_rooms.add(room)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush_members)
+
+    def _flush_members(self):
+        self.flush_scheduled = False
+        rooms, self.dirty_rooms = self.dirty_rooms, set()
+        for room in rooms:
+            self._send({"op": "members", "room": room, "users": self.manager.local_usernames(room)})
+
+    def _send(self, message: dict):
+        if self.writer is None or self.writer.is_closing():
+            return
+        # broker อ่านไม่ทัน: ตัดแล้วต่อใหม่ (ส่งสถานะทั้งหมดอีกครั้ง) แทนที่จะเก็บค้างไม่จำกัด
+        # The broker is not keeping up: drop and reconnect (resending all state) instead of buffering forever
+        if self.writer.transport.get_write_buffer_size() > BROKER_MAX_BUFFER_BYTES:
+            print(f"Broker at {self.path} is not reading, reconnecting")
+            self.writer.close()
+            return
+        self.writer.write(json.dumps(message, separators=(",", ":")).encode() + b"\n")
+
+    async def _run(self, connected: asyncio.Future):
+        """
+        เชื่อมต่อ (และต่อใหม่เมื่อหลุด) แล้วอ่านข้อความจาก broker
+        Connect (and reconnect when dropped), then read messages from the broker
+        """
+        delay = 0.5
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path, limit=2 ** 24)
+                self._send({"op": "hello", "worker": self.worker_id})
+
+                # ส่งสถานะของ worker นี้ให้ broker (สำคัญตอนต่อใหม่)
+                # Send this worker's state to the broker (matters after a reconnect)
+                for room, info in self.owned_rooms.items():
+                    self._send({"op": "room", "room": room, "info": info})
+                for room in list(self.manager.room_members):
+                    self.members_changed(room)
+
+                if not connected.done():
+                    connected.set_result(True)
+                delay = 0.5
+                async for line in reader:
+                    try:
+                        self.manager.apply_broker_message(json.loads(line))
+                    except Exception as e:
+                        print(f"Error applying broker message: {e}")
+            except asyncio.CancelledError:
+                raise
+            except (OSError, ValueError) as e:
+                # ValueError: บรรทัดยาวเกิน limit ของ reader (ต่อใหม่แทนที่ task จะตายเงียบ)
+                # ValueError: a line longer than the reader's limit (reconnect rather than let the task die)
+                print(f"Broker connection failed: {e}")
+            if self.writer is not None:
+                self.writer.close()
+            self.writer = None
+            self.manager.clear_remote_members()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+
+
+def create_broker(url: str) -> LocalBroker:
+    """
+    สร้าง broker จาก BROKER_URL
+    Create the broker described by BROKER_URL
+    
+    Args:
+        url: "" สำหรับ process เดียว หรือ "unix:///path/to.sock"
+    """
+    if not url:
+        return LocalBroker()
+    if url.startswith("unix://"):
+        return UnixSocketBroker(url[len("unix://"):])
+    raise RuntimeError("BROKER_URL must be empty or unix:///path/to/socket")
+
+
+async def run_broker_server(path: str):
+    """
+    รัน broker กลางที่ worker ทุกตัวเชื่อมต่อผ่าน Unix socket
+    Run the shared broker that every worker connects to over a Unix socket
+    
+    broker เก็บทะเบียนห้องและรายชื่อสมาชิกของแต่ละ worker เพื่อส่งให้ worker
+    ที่เพิ่งต่อเข้ามา และส่งต่อทุกข้อความไปยัง worker อื่น (ใส่ worker id ผู้ส่งให้)
+    The broker keeps the room registry and each worker's member lists for
+    late joiners, and relays every message to the other workers (stamped
+    with the sender's worker id)
+    
+    Args:
+        path: path ของ Unix socket
+    """
+    clients: dict[asyncio.StreamWriter, str] = {}
+    rooms: dict[str, dict] = {}
+    # worker ที่ประกาศห้องล่าสุด (ห้องถูกลบเมื่อ worker นั้นหลุด) / The worker that last announced each room (dropped with it)
+    owners: dict[str, str] = {}
+    members: dict[str, dict[str, list[str]]] = {}
+
+    def relay(message: dict, sender: Optional[asyncio.StreamWriter]):
+        line = json.dumps(message, separators=(",", ":")).encode() + b"\n"
+        for writer in list(clients):
+            if writer is sender or writer.is_closing():
+                continue
+            # worker ที่อ่านไม่ทันถูกตัด (ต่อใหม่แล้วได้ sync) แทนที่ broker จะเก็บข้อมูลค้างไม่จำกัด
+            # A worker that cannot keep up is cut off (it gets a sync on reconnect) rather than
+            # letting the broker buffer without bound
+            if writer.transport.get_write_buffer_size() > BROKER_MAX_BUFFER_BYTES:
+                print(f"Broker client {clients[writer]} is not reading, disconnecting")
+                writer.close()
+                continue
+            writer.write(line)
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker = None
+        try:
+            async for line in reader:
+                message = json.loads(line)
+                if not isinstance(message, dict):
+                    continue
+                op = message.get("op")
+                if op == "hello":
+                    worker = message["worker"]
+                    clients[writer] = worker
+                    writer.write(json.dumps({"op": "sync", "rooms": rooms, "members": members}).encode() + b"\n")
+                    continue
+                if worker is None:
+                    continue
+                message["worker"] = worker
+                if op == "room":
+                    rooms[message["room"]] = message["info"]
+                    owners[message["room"]] = worker
+                elif op == "room_deleted":
+                    rooms.pop(message["room"], None)
+                    owners.pop(message["room"], None)
+                    members.pop(message["room"], None)
+                elif op == "members":
+                    by_worker = members.setdefault(message["room"], {})
+                    if message["users"]:
+                        by_worker[worker] = message["users"]
+                    else:
+                        by_worker.pop(worker, None)
+                relay(message, writer)
+        except (ConnectionError, ValueError) as e:
+            # ValueError: JSON เสีย หรือบรรทัดยาวเกิน limit / Bad JSON, or a line over the limit
+            print(f"Broker client error: {e}")
+        finally:
+            clients.pop(writer, None)
+            writer.close()
+            if worker is not None:
+                # worker หลุด: ลบสมาชิกของ worker นั้นออกจากทุกห้อง
+                # Worker went away: drop its members from every room
+                for room, by_worker in members.items():
+                    if by_worker.pop(worker, None) is not None:
+                        relay({"op": "members", "room": room, "users": [], "worker": worker}, None)
+                # ห้องของ worker นั้นถูกลบด้วย (worker อื่นเก็บไว้เฉพาะห้องที่ยังมีสมาชิกของตัวเอง)
+                # Its rooms go too (other workers keep only those that still hold their own members)
+                for room in [room for room, owner in owners.items() if owner == worker]:
+                    del owners[room]
+                    rooms.pop(room, None)
+                    members.pop(room, None)
+                    relay({"op": "room_deleted", "room": room, "worker": worker}, None)
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(handle, path, limit=2 ** 24)
+    print(f"Broker listening on {path}")
+    async with server:
+        await server.serve_forever()
+
+
+# ชื่อ metric แบบ counter ที่นับผ่าน hook และคำอธิบาย
+# Counter metrics fed by hooks, with their help text
+METRIC_COUNTERS = {
+    "drivechat_ped_pong_migrations_total": "Users moved to ped_pong when their room expired",
+    "drivechat_ped_pong_deferred_total": "Users kept aboard because ped_pong was full",
+    "drivechat_random_room_requests_total": "/rooms/random requests by result (hit/miss)",
+    "drivechat_match_tickets_total": "Matchmaking tickets by outcome (assigned/joined/expired/cancelled/abandoned)",
+    "drivechat_reaped_connections_total": "Connections dropped by the heartbeat sweep by reason (dead/idle)",
+    "drivechat_shard_merges_total": "Special-room shards merged into another shard",
+    "drivechat_session_resumes_total": "Resume-token reconnects and grace periods by result (resumed/takeover/expired)",
+    "drivechat_moderation_messages_total": "Chat lines seen by moderation by result (clean/masked/bypassed)",
+}
+
+# histogram ที่วัดผ่าน hook: (คำอธิบาย, bucket)
+# Histograms fed by hooks: (help text, buckets)
+METRIC_HISTOGRAMS = {
+    "drivechat_broadcast_recipients": (
+        "Recipients per broadcast (fan-out size)",
+        (1, 2, 5, 10, 15, 25, 50, 100, 250, 500, 1000),
+    ),
+    "drivechat_broadcast_seconds": (
+        "Time to enqueue one broadcast on every recipient",
+        (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05),
+    ),
+    "drivechat_delivery_seconds": (
+        "Time from enqueue to a completed WebSocket send (oldest frame of each send)",
+        (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5),
+    ),
+    "drivechat_match_wait_seconds": (
+        "Time a queued passenger waited for a room",
+        (0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 120),
+    ),
+    "drivechat_moderation_queue_seconds": (
+        "Moderation stage 1: time a batch waited for a pool thread",
+        (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1),
+    ),
+    "drivechat_moderation_scan_seconds": (
+        "Moderation stage 2: time to scan one batch with the word matcher",
+        (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05),
+    ),
+    "drivechat_moderation_seconds": (
+        "Moderation end to end: first line of a batch submitted to verdicts back on the loop",
+        (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+    ),
+}
+
+
+class Histogram:
+    """
+    histogram แบบ Prometheus (bucket สะสมตอน render)
+    Prometheus-style histogram (buckets are made cumulative when rendered)
+    """
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class NullMetrics:
+    """
+    metrics แบบปิด (ค่าเริ่มต้น): hook ทุกตัวไม่ทำอะไร จึงแทบไม่มีต้นทุน
+    Disabled metrics (the default): every hook is a no-op, so it costs next to nothing
+    """
+    enabled = False
+
+    def inc(self, name: str, value: float = 1, label: Optional[tuple[str, str]] = None):
+        """เพิ่มค่า counter / Increment a counter"""
+
+    def observe(self, name: str, value: float):
+        """บันทึกค่าลง histogram / Record a histogram observation"""
+
+
+def escape_label_value(value) -> str:
+    """
+    escape ค่า label ตาม Prometheus text format (backslash, double quote, newline)
+    Escape a label value as the Prometheus text format requires (backslash, double quote, newline)
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class PrometheusMetrics(NullMetrics):
+    """
+    เก็บ counter/histogram ในหน่วยความจำ แล้ว render เป็น Prometheus text format
+    Keeps counters/histograms in memory and renders the Prometheus text format
+    
+    ค่าที่อ่านได้จากสถานะปัจจุบัน (จำนวน connection, ห้อง, คิว ฯลฯ) ไม่ต้องมี hook
+    ConnectionManager.collect_metrics ส่งมาให้ตอน scrape
+    Values readable from current state (connections, rooms, queues, ...) need
+    no hook: ConnectionManager.collect_metrics supplies them at scrape time
+    """
+    enabled = True
+
+    def __init__(self):
+        self.counters: dict[tuple[str, Optional[tuple[str, str]]], float] = {}
+        self.histograms = {name: Histogram(buckets) for name, (_, buckets) in METRIC_HISTOGRAMS.items()}
+
+    def inc(self, name: str, value: float = 1, label: Optional[tuple[str, str]] = None):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float):
+        self.histograms[name].observe(value)
+
+    def render(self, collected: list[tuple[str, str, str, list[tuple[dict, float]]]]) -> str:
+        """
+        สร้าง Prometheus text format
+        Render the Prometheus text exposition format
+        
+        Args:
+            collected: metric ที่อ่านตอน scrape: (ชื่อ, ชนิด, คำอธิบาย, [(labels, ค่า)])
+        """
+        lines = []
+
+        def family(name: str, kind: str, help_text: str):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def sample(name: str, labels: dict, value: float):
+            if labels:
+                label_text = ",".join(f'{key}="{escape_label_value(val)}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value:g}")
+            else:
+                lines.append(f"{name} {value:g}")
+
+        for name, kind, help_text, samples in collected:
+            family(name, kind, help_text)
+            for labels, value in samples:
+                sample(name, labels, value)
+
+        for name, help_text in METRIC_COUNTERS.items():
+            family(name, "counter", help_text)
+            samples = [(label, value) for (key, label), value in self.counters.items() if key == name]
+            for label, value in samples or [(None, 0)]:
+                sample(name, dict([label]) if label else {}, value)
+
+        for name, (help_text, _) in METRIC_HISTOGRAMS.items():
+            family(name, "histogram", help_text)
+            histogram = self.histograms[name]
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                sample(f"{name}_bucket", {"le": f"{bound:g}"}, cumulative)
+            sample(f"{name}_bucket", {"le": "+Inf"}, histogram.count)
+            sample(f"{name}_sum", {}, histogram.total)
+            sample(f"{name}_count", {}, histogram.count)
+
+        return "\n".join(lines) + "\n"
+
+
+class LoopMonitor:
+    """
+    วัด lag ของ event loop และจับ callback/coroutine ที่บล็อก loop นานเกินเกณฑ์
+    Samples event-loop lag and catches callbacks/coroutines that block the loop
+    past a threshold
+    
+    - heartbeat task ตื่นทุก interval แล้ววัดว่าตื่นช้ากว่าที่ควรเท่าไร (= lag)
+    - watchdog thread ดู heartbeat; ถ้า loop ค้างเกินเกณฑ์ จะอ่าน stack ของ
+      thread ที่รัน loop ขณะที่ยังค้างอยู่ จึงรู้ว่าเมธอดไหนของ owner
+      (ConnectionManager) กำลังทำงาน
+    - ไม่ได้ครอบทุก callback จึงไม่มีต้นทุนบน hot path
+    
+    - A heartbeat task wakes every interval and measures how late it woke (= lag)
+    - A watchdog thread watches the heartbeat; when the loop is stuck past the
+      threshold it reads the loop thread's stack while it is still stuck, so it
+      knows which method of the owner (ConnectionManager) is running
+    - Callbacks are not wrapped, so the hot path pays nothing
+    """
+
+    def __init__(self, interval_ms: int, threshold_ms: int, owner: type, dump_path: str = "", keep: int = 100):
+        self.interval = interval_ms / 1000
+        self.threshold = threshold_ms / 1000
+        self.dump_path = dump_path
+        self.owner_codes = {
+            func.__code__: f"{owner.__name__}.{name}"
+            for name, func in vars(owner).items()
+            if hasattr(func, "__code__")
+        }
+        self.events: deque[dict] = deque(maxlen=keep)
+        self.offenders: dict[str, list] = {}   # method -> [count, total_ms, max_ms]
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.samples = 0
+        self.lag_total = 0.0
+        self.slow_count = 0
+        self.last_tick = 0.0
+        self.capture: Optional[dict] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread = 0
+        self.task: Optional[asyncio.Task] = None
+        self.stopping = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    def start(self):
+        """เริ่ม heartbeat และ watchdog / Start the heartbeat and the watchdog"""
+        if not self.enabled or self.task is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.last_tick = time.perf_counter()
+        self.stopping.clear()
+        self.task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-monitor", daemon=True).start()
+
+    def stop(self):
+        """หยุด heartbeat และ watchdog / Stop the heartbeat and the watchdog"""
+        self.stopping.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _heartbeat(self):
+        """วัด lag ทุก interval / Measure lag every interval"""
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag = max(0.0, now - expected)
+            self.last_tick = now
+            capture, self.capture = self.capture, None
+
+            self.lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.samples += 1
+            self.lag_total += lag
+            if lag >= self.threshold:
+                self._record(lag, capture)
+
+    def _watch(self):
+        """
+        (thread แยก) อ่าน stack ของ loop ขณะที่ loop ค้าง
+        (Separate thread) Read the loop's stack while the loop is stuck
+        """
+        poll = min(self.interval, self.threshold) / 4 or self.interval / 4
+        while not self.stopping.wait(poll):
+            stuck_for = time.perf_counter() - self.last_tick - self.interval
+            if self.capture is None and stuck_for >= self.threshold:
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None:
+                    self.capture = self._describe(frame)
+
+    def _describe(self, frame) -> dict:
+        """
+        หาเมธอดของ owner ที่อยู่ใน stack (ชั้นในสุดก่อน) และเก็บ stack แบบย่อ
+        Find the owner's method on the stack (innermost first) and keep a short stack
+        """
+        method = None
+        outermost = None
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            if method is None:
+                method = self.owner_codes.get(code)
+            if f"{os.sep}asyncio{os.sep}" not in code.co_filename:
+                outermost = getattr(code, "co_qualname", code.co_name)
+                if len(stack) < 10:
+                    stack.append(f"{outermost} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return {"method": method or outermost or "unknown", "stack": stack}
+
+    def _record(self, lag: float, capture: Optional[dict]):
+        """
+        บันทึกเหตุการณ์ loop ค้างและสรุปตามเมธอด
+        Record a stall and aggregate it per method
+        """
+        lag_ms = round(lag * 1000, 1)
+        event = {
+            "at": time.time(),
+            "lag_ms": lag_ms,
+            "method": capture["method"] if capture else "unknown",
+            "stack": capture["stack"] if capture else [],
+        }
+        self.events.append(event)
+        self.slow_count += 1
+        stats = self.offenders.setdefault(event["method"], [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += lag_ms
+        stats[2] = max(stats[2], lag_ms)
+        if self.dump_path:
+            self.loop.run_in_executor(None, self._dump, event)
+
+    def _dump(self, event: dict):
+        """(thread pool) ต่อท้ายไฟล์ JSON lines / (Thread pool) Append to the JSON-lines file"""
+        try:
+            with open(self.dump_path, "a", encoding="utf-8") as dump:
+                dump.write(json.dumps(event, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"Error writing loop monitor dump: {e}")
+
+    def report(self, limit: int = 10) -> dict:
+        """
+        สรุป lag และผู้ที่ทำให้ loop ค้างมากที่สุด
+        Summarize lag and the worst offenders
+        """
+        offenders = sorted(self.offenders.items(), key=lambda item: item[1][2], reverse=True)
+        return {
+            "enabled": self.enabled,
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "lag_ms": round(self.lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "avg_lag_ms": round(self.lag_total / self.samples * 1000, 2) if self.samples else 0.0,
+            "slow_events": self.slow_count,
+            "offenders": [
+                {"method": method, "count": count, "total_ms": round(total, 1), "max_ms": worst}
+                for method, (count, total, worst) in offenders[:limit]
+            ],
+            "worst": sorted(self.events, key=lambda event: event["lag_ms"], reverse=True)[:limit],
+        }
+
+    def collect_metrics(self) -> list[tuple[str, str, str, list[tuple[dict, float]]]]:
+        """ค่าสำหรับ /metrics / Values for /metrics"""
+        if not self.enabled:
+            return []
+        return [
+            ("drivechat_event_loop_lag_seconds", "gauge", "Most recent event-loop lag sample",
+             [({}, self.lag)]),
+            ("drivechat_event_loop_max_lag_seconds", "gauge", "Worst event-loop lag since start",
+             [({}, self.max_lag)]),
+            ("drivechat_slow_callbacks_total", "counter", "Event-loop stalls above SLOW_CALLBACK_MS",
+             [({"method": method}, count) for method, (count, _, _) in sorted(self.offenders.items())]),
+        ]
+
+
+# เหตุผลที่ปฏิเสธ connect ใหม่ และ Retry-After (วินาที) ของแต่ละเหตุผลที่ไม่ได้มาจาก token bucket
+# Reasons a new connect is refused, and the Retry-After (seconds) of those not derived from a token bucket
+SHED_CAPACITY = "capacity"
+SHED_LAG = "loop_lag"
+SHED_QUEUE = "queue_depth"
+SHED_RATE = "rate"
+SHED_IP_RATE = "ip_rate"
+SHED_RETRY_AFTER = {SHED_CAPACITY: 10, SHED_LAG: 2, SHED_QUEUE: 2}
+
+
+class AdmissionController:
+    """
+    ตัดสินว่าจะรับ WebSocket ใหม่หรือไม่ ก่อน accept (ถูกกว่าการรับแล้วค่อยตัด)
+    Decide whether to take a new WebSocket before it is accepted (cheaper than
+    accepting and then dropping it)
+    
+    ตรวจตามลำดับ: จำนวน connection สูงสุด, event loop lag, frame ค้างในคิวขาออก
+    แล้วจึงใช้ token ของ bucket ทั้ง server และของ IP (token ถูกใช้เฉพาะเมื่อผ่านข้ออื่นแล้ว)
+    Checks, in order: max connections, event-loop lag, queued outbound frames,
+    then spends a token from the server-wide and the per-IP bucket (tokens are
+    only spent once everything else passed)
+    """
+
+    # อ่านจำนวน frame ค้างใหม่ไม่บ่อยกว่านี้ (วินาที) และลบ bucket ของ IP ที่เต็มแล้วไม่บ่อยกว่านี้
+    # Re-read the queued-frame total at most this often (seconds), and prune full per-IP buckets at most this often
+    DEPTH_SAMPLE_SECONDS = 0.1
+    PRUNE_SECONDS = 60
+
+    def __init__(
+        self,
+        lag: Callable[[], float],
+        queue_depth: Callable[[], int],
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Args:
+            lag: ฟังก์ชันคืน event loop lag ล่าสุด (วินาที)
+            queue_depth: ฟังก์ชันคืนจำนวน frame ที่ค้างในคิวขาออกทั้งหมด
+            clock: นาฬิกาของ token bucket
+        """
+        self.lag = lag
+        self.queue_depth = queue_depth
+        self.clock = clock
+        self.bucket = TokenBucket(CONNECT_RATE_PER_SECOND, CONNECT_RATE_BURST, clock)
+        self.ip_buckets: dict[str, TokenBucket] = {}
+        self.depth = 0
+        self.depth_at = float("-inf")
+        self.pruned_at = clock()
+        self.admitted = 0
+        self.rejected: Counter[str] = Counter()
+
+    def check(self, client_ip: str, connections: int) -> Optional[tuple[str, int]]:
+        """
+        ตรวจ connect ใหม่หนึ่งครั้ง
+        Check one new connect
+        
+        Args:
+            client_ip: IP ของ client (จาก websocket.client)
+            connections: จำนวน connection ที่เปิดอยู่ตอนนี้
+            
+        Returns:
+            None ถ้ารับได้ หรือ (เหตุผล, Retry-After วินาที) ถ้าต้องปฏิเสธ
+        """
+        now = self.clock()
+        reason = None
+        if MAX_CONNECTIONS > 0 and connections >= MAX_CONNECTIONS:
+            reason = SHED_CAPACITY
+        elif SHED_LOOP_LAG_MS > 0 and self.lag() * 1000 >= SHED_LOOP_LAG_MS:
+            reason = SHED_LAG
+        elif SHED_QUEUE_DEPTH > 0 and self._sample_depth(now) >= SHED_QUEUE_DEPTH:
+            reason = SHED_QUEUE
+        if reason is not None:
+            self.rejected[reason] += 1
+            return reason, SHED_RETRY_AFTER[reason]
+
+        ip_bucket = None
+        if CONNECT_RATE_PER_IP > 0:
+            ip_bucket = self.ip_buckets.get(client_ip)
+            if ip_bucket is None:
+                ip_bucket = self.ip_buckets[client_ip] = TokenBucket(
+                    CONNECT_RATE_PER_IP, CONNECT_BURST_PER_IP, self.clock
+                )
+            if not ip_bucket.take():
+                self.rejected[SHED_IP_RATE] += 1
+                return SHED_IP_RATE, self._retry_after(ip_bucket)
+        if CONNECT_RATE_PER_SECOND > 0 and not self.bucket.take():
+            if ip_bucket is not None:
+                ip_bucket.tokens += 1  # ไม่นับกับ IP นี้ / not this IP's fault
+            self.rejected[SHED_RATE] += 1
+            return SHED_RATE, self._retry_after(self.bucket)
+
+        if now - self.pruned_at >= self.PRUNE_SECONDS:
+            self._prune(now)
+        self.admitted += 1
+        return None
+
+    def _sample_depth(self, now: float) -> int:
+        """จำนวน frame ค้าง (อ่านใหม่ทุก DEPTH_SAMPLE_SECONDS) / Queued frames (re-read every DEPTH_SAMPLE_SECONDS)"""
+        if now - self.depth_at >= self.DEPTH_SAMPLE_SECONDS:
+            self.depth = self.queue_depth()
+            self.depth_at = now
+        return self.depth
+
+    @staticmethod
+    def _retry_after(bucket: TokenBucket) -> int:
+        """วินาทีจนกว่าจะมี token (อย่างน้อย 1) / Seconds until a token is available (at least 1)"""
+        return max(1, math.ceil((1 - bucket.tokens) / bucket.rate))
+
+    def _prune(self, now: float):
+        """ลบ bucket ของ IP ที่เติมเต็มแล้ว (เหมือนไม่เคย connect) / Drop per-IP buckets that have refilled"""
+        self.pruned_at = now
+        full = [
+            ip for ip, bucket in self.ip_buckets.items()
+            if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.burst
+        ]
+        for ip in full:
+            del self.ip_buckets[ip]
+
+    def collect_metrics(self) -> list[tuple[str, str, str, list[tuple[dict, float]]]]:
+        """ค่าสำหรับ /metrics / Values for /metrics"""
+        return [
+            ("drivechat_admission_accepted_total", "counter", "WebSocket connects admitted",
+             [({}, self.admitted)]),
+            ("drivechat_admission_rejected_total", "counter", "WebSocket connects refused before accept by reason",
+             [({"reason": reason}, count) for reason, count in sorted(self.rejected.items())]),
+        ]
+
+
+def create_moderator(metrics: NullMetrics) -> NullModerator:
+    """
+    สร้างตัวกรองตาม MODERATION_ENABLED (compile คำครั้งเดียวตอนเริ่ม)
+    Create the moderation stage described by MODERATION_ENABLED (terms are compiled once at start)
+    """
+    if not MODERATION_ENABLED:
+        return NullModerator()
+    return Moderator(
+        WordMatcher(load_moderation_words(MODERATION_WORDS_PATH)), metrics,
+        workers=MODERATION_WORKERS, max_pending=MODERATION_MAX_PENDING,
+    )
+
+
+# รูปแบบไฟล์ snapshot: magic + version (big-endian) ตามด้วย JSON ที่บีบอัดด้วย zlib
+# Snapshot file format: magic + version (big-endian), then zlib-compressed JSON
+SNAPSHOT_MAGIC = b"DCSN"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct(">4sH")
+
+
+def encode_snapshot(state: dict) -> bytes:
+    """
+    แปลงสถานะเป็น snapshot แบบ binary
+    Encode a state dict as a binary snapshot
+    """
+    payload = json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION) + zlib.compress(payload, 6)
+
+
+def decode_snapshot(data: bytes) -> dict:
+    """
+    อ่าน snapshot แบบ binary
+    Decode a binary snapshot
+    
+    Raises:
+        ValueError: ถ้าไม่ใช่ snapshot, version ไม่ตรง หรือข้อมูลเสีย
+    """
+    if len(data) < SNAPSHOT_HEADER.size:
+        raise ValueError("snapshot is truncated")
+    magic, version = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("not a snapshot file")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"unsupported snapshot version {version}")
+    try:
+        return json.loads(zlib.decompress(data[SNAPSHOT_HEADER.size:]))
+    except (zlib.error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"corrupt snapshot ({e})") from e
+
+
+# ==============================================================================
+# 4. CONNECTION MANAGER CLASS (คลาสจัดการการเชื่อมต่อ)
+# ==============================================================================
+
+class ConnectionManager:
+    """
+    คลาสหลักสำหรับจัดการการเชื่อมต่อ WebSocket และห้องแชท
+    Main class for managing WebSocket connections and chat rooms
+    
+    หน้าที่หลัก (Main responsibilities):
+    - จัดการการเชื่อมต่อ/ตัดการเชื่อมต่อ WebSocket
+    - จัดการห้องแชท (สร้าง, ลบ, ย้ายผู้ใช้)
+    - ส่งข้อความ broadcast ไปยังผู้ใช้ในห้อง
+    - จัดการ timer สำหรับ transition ไปยัง ped_pong
+    """
+
+    # --------------------------------------------------------------------------
+    # 4.1 INITIALIZATION (การเริ่มต้น)
+    # --------------------------------------------------------------------------
+    
+    def __init__(
+        self,
+        broker: Optional[LocalBroker] = None,
+        metrics: Optional[NullMetrics] = None,
+        clock: Optional[VirtualClock] = None,
+    ):
+        """
+        เริ่มต้น ConnectionManager พร้อมสร้างห้องพิเศษ duck_pond และ ped_pong
+        Initialize ConnectionManager with special rooms duck_pond and ped_pong
+        
+        Args:
+            broker: broker สำหรับแชร์ห้องกับ worker อื่น (ค่าเริ่มต้น LocalBroker = process เดียว)
+            metrics: ที่เก็บ metrics (ค่าเริ่มต้น NullMetrics = ปิด)
+            clock: นาฬิกาจำลองสำหรับ simulation (ค่าเริ่มต้น None = time.monotonic และ
+                scheduler ทำงานเอง); ถ้าส่งมา deadline จะทำงานเมื่อเรียก scheduler.run_due() เท่านั้น
+        """
+        # สมาชิกของแต่ละห้อง (dict เรียงตามลำดับการเข้าห้อง)
+        # Members of each room (dicts keep join order)
+        self.room_members: dict[str, dict[WebSocket, Member]] = {}
+
+        # สมาชิกทั้งหมดตาม WebSocket (ดัชนีรวม)
+        # All members by WebSocket (global index)
+        self.members: dict[WebSocket, Member] = {}
+
+        # broker และรายชื่อ/จำนวนสมาชิกของห้องที่อยู่ใน worker อื่น
+        # Broker, plus member names/counts of each room held by other workers
+        self.broker = broker or LocalBroker()
+        self.metrics = metrics or NullMetrics()
+        self.clock: Callable[[], float] = clock or time.monotonic
+        # timer ของ timeout การส่ง: เวลาจำลองเมื่อใช้ VirtualClock (None = loop.call_later)
+        # Send-timeout timers: simulated time with a VirtualClock (None = loop.call_later)
+        self.call_later = clock.call_later if clock is not None else None
+
+        # drain: ไม่รับผู้ใช้ใหม่; shutting_down: กำลังปิด process (ออกแบบเงียบ) และ snapshot ที่เก็บตอนเริ่มปิด
+        # draining: no new joins; shutting_down: the process is exiting (silent leaves), with the
+        # snapshot taken when shutdown began
+        self.draining = False
+        self.shutting_down = False
+        self.shutdown_snapshot: Optional[dict] = None
+
+        # ผู้ใช้จาก snapshot ที่รอกลับมาต่อ (ตาม username) และจำนวนที่นั่งที่จองไว้ต่อห้อง
+        # Restored users awaiting their reconnect (by username) and seats held for them per room
+        self.resumes: dict[str, list[dict]] = {}
+        self.reserved: Counter[str] = Counter()
+
+        # คิวรอห้องของผู้โดยสาร (FIFO ต่อ transport_type), ตั๋วตาม id, ตั๋วที่ได้ห้องแล้วตาม
+        # (ห้อง, username) และ transport_type ที่รอจับคู่ใน loop รอบถัดไป
+        # Passenger queues (FIFO per transport_type), tickets by id, assigned tickets by
+        # (room, username), and transport types waiting for the next matching pass
+        self.match_queues: dict[str, deque[MatchTicket]] = {}
+        self.tickets: dict[str, MatchTicket] = {}
+        self.assignments: dict[tuple[str, str], MatchTicket] = {}
+        self.match_pending: set[str] = set()
+        self.match_handle: Optional[asyncio.Handle] = None
+
+        # task เดียวที่ส่ง PING และตัด connection ที่ตาย/ไม่ใช้งาน (เริ่มใน lifespan)
+        # The single task that sends PINGs and reaps dead/idle connections (started in lifespan)
+        self.heartbeat_task: Optional[asyncio.Task] = None
+
+        # task สั้นๆ ที่เริ่มจาก callback (ตัด connection, ปิด socket ฯลฯ) เก็บ reference ไว้จนเสร็จ
+        # Short tasks started from callbacks (pruning, closing sockets, ...), referenced until they finish
+        self.tasks: set[asyncio.Task] = set()
+
+        # resume token ของ connection ที่ต่ออยู่, ผู้ใช้ที่หลุดและยังอยู่ในช่วง grace (ตาม token)
+        # และผู้ใช้ที่หลุดแต่ยังอยู่ในรายชื่อของแต่ละห้อง
+        # Resume tokens of open connections, users in their grace period (by token), and
+        # the detached users still listed in each room
+        self.tokens: dict[str, Member] = {}
+        self.detached: dict[str, DetachedSession] = {}
+        self.detached_rooms: dict[str, dict[str, DetachedSession]] = {}
+
+        # การเปลี่ยนแปลงห้องว่างสำหรับ /rooms/stream
+        # Room-availability changes for /rooms/stream
+        self.room_feed = RoomFeed(self.room_view)
+        self.remote_members: dict[str, dict[str, list[str]]] = {}
+        self.remote_counts: Counter[str] = Counter()
+        
+        # เก็บข้อมูลห้องทั้งหมด (capacity, transition time, etc.)
+        # Store all room information
+        self.available_rooms: dict[str, dict] = {}
+        
+        # เก็บ cleanup tasks ของแต่ละห้อง
+        # Store cleanup tasks for each room
+        self.room_cleanup_tasks: dict[str, Optional[asyncio.Task]] = {}
+        
+        # ตัวจับเวลากลางสำหรับ warning/transition ของทุกห้อง
+        # Central scheduler for every room's warning/transition deadline
+        self.scheduler = RoomScheduler(self._handle_room_deadline, self.clock, autorun=clock is None)
+
+        # ดัชนีห้องที่ยังว่างสำหรับ /rooms/random
+        # Index of open rooms for /rooms/random
+        self.directory = RoomDirectory()
+
+        # การเปลี่ยนแปลงรายชื่อผู้ใช้ที่รอส่งของแต่ละห้อง
+        # Pending user-list changes per room
+        self.presence: dict[str, RoomPresence] = {}
+
+        # ประวัติแชทล่าสุดของแต่ละห้อง (สร้างเมื่อมีข้อความแรก)
+        # Recent chat history per room (created on the first chat line)
+        self.history: dict[str, RoomHistory] = {}
+
+        # ลำดับข้อความล่าสุดของแต่ละห้อง (s ใน envelope)
+        # Last message sequence number per room (s in the envelope)
+        self.room_seq: dict[str, int] = {}
+
+        # ข้อความที่รอส่งรวมของแต่ละห้อง (เมื่อเปิด ROOM_BATCH_WINDOW_MS)
+        # Batched messages waiting per room (when ROOM_BATCH_WINDOW_MS is on)
+        self.batches: dict[str, RoomBatch] = {}
+
+        # token bucket ของแต่ละห้องและสถิติการจำกัดอัตรา
+        # Per-room token buckets and rate-limit statistics
+        self.room_buckets: dict[str, TokenBucket] = {}
+        self.flood_stats: dict[str, int] = {
+            "throttled": 0,
+            "room_throttled": 0,
+            "oversized": 0,
+            "duplicates": 0,
+            "disconnected": 0,
+        }
+
+        # สถิติการ broadcast (จำนวนครั้ง, ผู้รับ, การส่งล้มเหลว, เวลาใส่คิว และ latency จริงตั้งแต่เข้าคิวจนส่งเสร็จ)
+        # Broadcast statistics (count, recipients, send failures, enqueue time, and the real
+        # latency from enqueue to a completed send)
+        self.broadcast_stats: dict[str, float] = {
+            "broadcasts": 0,
+            "batched": 0,
+            "recipients": 0,
+            "failures": 0,
+            "last_enqueue_ms": 0.0,
+            "max_enqueue_ms": 0.0,
+            "last_latency_ms": 0.0,
+            "max_latency_ms": 0.0,
+        }
+
+        # สร้างห้องพิเศษ duck_pond - ห้องสาธารณะถาวร
+        # Create special room duck_pond - permanent public room
+        self.available_rooms["duck_pond"] = {
+            "capacity": 15,
+            "is_special": True,
+            "transport_type": None,
+            "shard_of": "duck_pond",
+        }
+        
+        # สร้างห้องพิเศษ ped_pong - ห้องพักระหว่างทาง
+        # Create special room ped_pong - transit stop room
+        self.available_rooms["ped_pong"] = {
+            "capacity": 15,
+            "is_special": True,
+            "transport_type": None,
+            "shard_of": "ped_pong",
+        }
+
+        # shard ของห้องพิเศษแต่ละห้อง (shard แรกคือห้องเอง) และห้องพิเศษที่รอรวม shard ใน loop รอบถัดไป
+        # Shards of each special room (the first is the room itself) and special rooms
+        # waiting for a merge pass on the next loop iteration
+        self.shards: dict[str, list[str]] = {room: [room] for room in SPECIAL_ROOMS}
+        self.merge_pending: set[str] = set()
+        self.merge_handle: Optional[asyncio.Handle] = None
+
+    # --------------------------------------------------------------------------
+    # 4.2 CONNECTION MANAGEMENT (จัดการการเชื่อมต่อ)
+    # --------------------------------------------------------------------------
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        room: str,
+        username: str,
+        role: str = "passenger",
+        presence: str = PRESENCE_FULL,
+        protocol: str = PROTOCOL_TEXT,
+        subprotocol: Optional[str] = None,
+        since: Optional[int] = None,
+        heartbeat: bool = False,
+        resumable: bool = False,
+    ):
+        """
+        เชื่อมต่อ WebSocket เข้ากับห้องแชท
+        Connect a WebSocket to a chat room
+        
+        Args:
+            websocket: การเชื่อมต่อ WebSocket
+            room: ชื่อห้องที่ต้องการเข้า
+            username: ชื่อผู้ใช้
+            role: บทบาทของผู้ใช้ (passenger/driver)
+            presence: รูปแบบรายชื่อผู้ใช้ (PRESENCE_FULL หรือ PRESENCE_DELTA)
+            protocol: protocol ของ connection (จาก negotiate_protocol)
+            subprotocol: subprotocol ที่ตอบรับตอน accept (ถ้ามี)
+            since: replay เฉพาะข้อความหลังลำดับนี้ (ตอน resume; None = ประวัติทั้งหมด)
+            heartbeat: client ขอรับ PING (?heartbeat=1)
+            resumable: client ขอ resume token (?session=1 หรือกำลัง resume)
+            
+        Raises:
+            HTTPException: ถ้าห้องไม่มีอยู่หรือห้องเต็ม
+        """
+        # ตรวจสอบว่าห้องมีอยู่หรือไม่
+        # Check if room exists
+        if room not in self.available_rooms:
+            raise HTTPException(status_code=400, detail="Room does not exist")
+
+        # ตรวจสอบว่าห้องเต็มหรือไม่
+        # Check if room is full
+        if self.get_room_count(room) >= self.available_rooms[room]["capacity"]:
+            raise HTTPException(status_code=400, detail="Room is full")
+
+        # ยอมรับการเชื่อมต่อ WebSocket (จองที่นั่งไว้ระหว่างรอ accept ไม่ให้ใครแย่งหรือถูกรวม shard ทิ้ง)
+        # Accept WebSocket connection (the seat is held while accept is awaited, so it is
+        # neither taken by someone else nor merged away)
+        self.reserved[room] += 1
+        try:
+            await websocket.accept(subprotocol=subprotocol)
+        except BaseException:
+            self._release_seat(room)
+            raise
+        self.reserved[room] -= 1
+        if self.reserved[room] <= 0:
+            del self.reserved[room]
+
+        # ยกเลิก cleanup task ถ้ามีคนเข้าห้อง
+        # Cancel cleanup task if someone joins
+        if room in self.room_cleanup_tasks and self.room_cleanup_tasks[room]:
+            self.room_cleanup_tasks[room].cancel()
+            self.room_cleanup_tasks[room] = None
+
+        # เริ่ม writer task ของ connection นี้
+        # Start this connection's writer task
+        writer = ConnectionWriter(
+            websocket, self._on_writer_failure, protocol=protocol,
+            on_sent=self._on_delivered, clock=self.clock, call_later=self.call_later,
+        )
+        writer.start()
+
+        # เพิ่มผู้ใช้เข้าห้อง
+        # Add user to room
+        member = Member(websocket, username, role, writer, presence, protocol, self.clock, heartbeat)
+        self.members[websocket] = member
+        self._place_member(member, room)
+
+        # client แบบมีชนิดได้ hello บอก protocol ที่ตกลงกัน
+        # Typed-protocol clients get a hello naming the negotiated protocol
+        if protocol != PROTOCOL_TEXT:
+            hello = {"protocol": protocol, "version": PROTOCOL_VERSION, "username": username}
+            self.send_personal(websocket, "", FRAME_CONTROL, event=("hello", hello))
+
+        # resume token สำหรับต่อกลับหลัง connection หลุด (เฉพาะ client ที่ขอ)
+        # A resume token for coming back after a dropped connection (only for clients that ask)
+        if resumable:
+            self._issue_token(member)
+
+        # ส่งข้อความที่คุยกันก่อนหน้าให้ผู้ที่เพิ่งเข้ามา (หรือเฉพาะที่พลาดไปตอน resume)
+        # Replay what was said before this user arrived (or only what was missed, on resume)
+        self.replay_history(member, room, since)
+
+    async def disconnect(self, websocket: WebSocket, room: Optional[str] = None, grace: bool = False):
+        """
+        ตัดการเชื่อมต่อ WebSocket จากห้องแชท
+        Disconnect a WebSocket from a chat room
+        
+        ใช้ห้องปัจจุบันของสมาชิกเสมอ (ผู้ใช้อาจถูกย้ายไป ped_pong แล้ว)
+        Always uses the member's current room (they may have been moved to ped_pong)
+        
+        Args:
+            websocket: การเชื่อมต่อ WebSocket ที่จะตัด
+            room: ชื่อห้องที่ client เข้ามาตอนแรก (ไม่ได้ใช้หาห้อง เก็บไว้เพื่อ compatibility)
+            grace: connection หลุดกลางคัน (1006): ถือที่นั่งไว้ให้ resume ภายใน SESSION_GRACE_SECONDS
+                ถ้า connection มี resume token
+        """
+        member = self._remove_member(websocket)
+        if member is None:
+            return
+
+        # ระหว่างปิด server ทุกคนออกพร้อมกัน: ไม่ต้องแจ้งใครและไม่ลบห้อง (อยู่ใน snapshot แล้ว)
+        # During shutdown everyone leaves at once: notify nobody and keep rooms (they are in the snapshot)
+        if self.shutting_down:
+            return
+
+        # หลุดกลางคัน: ยังไม่แจ้งว่าออก รอให้ต่อกลับด้วย token ก่อน
+        # Dropped mid-session: announce nothing yet, wait for a reconnect with the token
+        if grace and member.token:
+            self._detach(member)
+            return
+
+        # แจ้งคนในห้องว่ามีคนออก
+        # Notify room that someone left
+        await self.broadcast(f"System: {member.username} has left the chat", member.room)
+        self.presence_changed(member.room, left=[member.username])
+        self._delete_room_if_empty(member.room)
+
+    def _place_member(self, member: Member, room: str):
+        """
+        ใส่สมาชิกเข้าห้อง (ต้องไม่อยู่ในห้องอื่นแล้ว)
+        Put a member into a room (it must not be in any other room)
+        """
+        member.room = room
+        self.room_members.setdefault(room, {})[member.websocket] = member
+        self._refresh_room_index(room)
+        self.broker.members_changed(room)
+
+    def _unplace_member(self, member: Member):
+        """
+        เอาสมาชิกออกจากห้องปัจจุบัน (ยังอยู่ในดัชนีรวม)
+        Take a member out of its current room (it stays in the global index)
+        """
+        members = self.room_members.get(member.room)
+        if members is not None:
+            members.pop(member.websocket, None)
+            self._refresh_room_index(member.room)
+            self.broker.members_changed(member.room)
+
+    def _move_member(self, member: Member, room: str):
+        """ย้ายสมาชิกไปอีกห้อง O(1) / Move a member to another room in O(1)"""
+        self._unplace_member(member)
+        self._place_member(member, room)
+
+    def _remove_member(self, websocket: WebSocket) -> Optional[Member]:
+        """
+        ลบ connection ออกจากระบบโดยไม่แจ้งใคร
+        Remove a connection entirely without notifying anyone
+        
+        Args:
+            websocket: การเชื่อมต่อ WebSocket ที่จะลบ
+            
+        Returns:
+            Member ที่ถูกลบ (member.room คือห้องที่เพิ่งออก) หรือ None ถ้าไม่พบ
+        """
+        member = self.members.pop(websocket, None)
+        if member is None:
+            return None
+        self._unplace_member(member)
+        if member.token:
+            self.tokens.pop(member.token, None)
+
+        # หยุด writer task ของ connection นี้
+        # Stop this connection's writer task
+        member.writer.stop()
+        return member
+
+    def get_member(self, websocket: WebSocket) -> Optional[Member]:
+        """ดึงข้อมูลสมาชิกจาก WebSocket / Look up a member by its WebSocket"""
+        return self.members.get(websocket)
+
+    def _delete_room_if_empty(self, room: str):
+        """
+        ลบห้องถ้าไม่มีคนเหลือ (ยกเว้นห้องพิเศษ)
+        Delete room if empty (except special rooms)
+        
+        Args:
+            room: ชื่อห้อง
+        """
+        if room in SPECIAL_ROOMS or room not in self.room_members:
+            return
+        if self.get_room_count(room) > 0:
+            return
+
+        # shard ที่ว่างของห้องพิเศษ: เอาออกจากรายการ shard (ไม่ต้องแจ้ง broker)
+        # An empty special-room shard: drop it from the shard list (nothing to tell the broker)
+        shard_of = self.available_rooms.get(room, {}).get("shard_of")
+        if shard_of:
+            self.shards[shard_of].remove(room)
+
+        self._drop_room(room)
+        if not shard_of:
+            self.broker.room_deleted(room)
+
+    def _drop_room(self, room: str):
+        """
+        ลบข้อมูลทั้งหมดของห้อง (timer, presence, batch, bucket, ดัชนี, ประวัติ, สมาชิกจาก worker อื่น)
+        โดยไม่แจ้ง broker; ใช้ทั้งตอนห้องว่างและตอน worker อื่นลบห้อง
+        Drop every piece of a room's state (timers, presence, batch, bucket, index,
+        history, other workers' members) without telling the broker; used both when
+        a room empties and when another worker deletes it
+        """
+        self.scheduler.cancel(room)
+        presence = self.presence.pop(room, None)
+        if presence and presence.handle:
+            presence.handle.cancel()
+        batch = self.batches.pop(room, None)
+        if batch and batch.handle:
+            batch.handle.cancel()
+        self.room_buckets.pop(room, None)
+        # Clean up all room data
+        self.directory.remove(room)
+        self.room_feed.changed(room)
+        self.available_rooms.pop(room, None)
+        self.history.pop(room, None)
+        self.room_seq.pop(room, None)
+        self.room_members.pop(room, None)
+        self.remote_members.pop(room, None)
+        self.remote_counts.pop(room, None)
+
+    def create_room(self, room: str, capacity: int, transport_type: str):
+        """
+        สร้างห้องปกติ (ของคนขับ) และเริ่ม transition timer
+        Create a regular (driver) room and start its transition timer
+        
+        Args:
+            room: ชื่อห้อง
+            capacity: จำนวนผู้ใช้สูงสุด
+            transport_type: ประเภทยานพาหนะ
+        """
+        self.available_rooms[room] = {
+            "capacity": capacity,
+            "is_special": False,
+            "transport_type": transport_type
+        }
+        self._refresh_room_index(room)
+
+        # ตั้ง warning และ transition ของห้องใหม่
+        # Schedule the new room's warning and transition
+        self.schedule_room_transition(room)
+
+    def _refresh_room_index(self, room: str):
+        """
+        อัพเดทดัชนีห้องว่างหลังจากจำนวนคนในห้องเปลี่ยน
+        Update the open-room index after a room's occupancy changed
+        
+        Args:
+            room: ชื่อห้อง
+        """
+        self.room_feed.changed(room)
+        room_info = self.available_rooms.get(room)
+        if room_info is None or room_info.get("is_special"):
+            self.directory.remove(room)
+            # ห้องพิเศษที่มีหลาย shard: ลองรวม shard ที่คนน้อยลง
+            # A special room with several shards: try merging the ones that drained
+            shard_of = room_info and room_info.get("shard_of")
+            if shard_of and len(self.shards[shard_of]) > 1:
+                self._merge_soon(shard_of)
+            return
+        # ห้องที่ใกล้ย้ายไป ped_pong หรือย้ายไปแล้วไม่ถูกจ่ายให้ใคร (/rooms/random, คิว, /rooms/stream)
+        # Rooms about to move to ped_pong, or already moved, are handed to nobody
+        # (/rooms/random, the queue, /rooms/stream)
+        has_space = self.get_room_count(room) < room_info["capacity"] and self.is_boarding(room)
+        self.directory.update(room, room_info.get("transport_type"), has_space)
+
+        # มีที่นั่งว่างและมีคนรอ: จับคู่ใน loop รอบถัดไป
+        # A free seat with passengers waiting: match on the next loop pass
+        if has_space and self.match_queues.get(room_info.get("transport_type")):
+            self._match_soon(room_info["transport_type"])
+
+    # --------------------------------------------------------------------------
+    # 4.3 ROOM TRANSITION MANAGEMENT (จัดการการย้ายห้อง)
+    # --------------------------------------------------------------------------
+
+    async def move_users_to_ped_pong(self, room: str):
+        """
+        ย้ายผู้ใช้ทั้งหมดจากห้องหนึ่งไปยัง ped_pong (ป้ายพักรถ)
+        Move all users from a room to ped_pong (transit stop)
+        
+        ฟังก์ชันนี้ถูกเรียกเมื่อ timer ของห้องหมดเวลา
+        This function is called when room timer expires
+        
+        ย้ายทั้งกลุ่มในครั้งเดียว: ผู้ถูกย้ายแต่ละคนได้ ROOM_CHANGE หนึ่งครั้ง (ชื่อ ped_pong เสมอ)
+        และแต่ละ shard ของ ped_pong ได้ข้อความแจ้งรวมหนึ่งข้อความกับรายชื่อผู้ใช้หนึ่งครั้ง
+        กลุ่มถูกจัดลง shard ที่พอดีที่สุด (เปิด shard ใหม่ถ้าไม่มีที่พอ) ถ้าครบ MAX_SHARDS
+        และที่นั่งไม่พอ คนที่เหลือจะอยู่ห้องเดิมและลองใหม่ภายหลัง
+        The whole group moves at once: each migrant gets a single ROOM_CHANGE
+        (always naming ped_pong), and each ped_pong shard gets one combined
+        arrival line and one user list. The group goes to the best-fitting shard
+        (a new shard opens if none has room); if MAX_SHARDS is reached and seats
+        run out, the rest stay aboard and the move is retried
+        
+        Args:
+            room: ชื่อห้องที่จะย้ายผู้ใช้ออก
+        """
+        # ไม่ย้ายถ้าเป็นห้องพิเศษหรือไม่มี connections
+        # Don't move if special room or no connections
+        if self.available_rooms.get(room, {}).get("is_special"):
+            return
+        if not self.room_members.get(room):
+            self._redirect_detached(room, "ped_pong")
+            return
+
+        # แบ่งผู้ใช้ลง shard ของ ped_pong ตามที่นั่งว่าง
+        # Split users across ped_pong's shards by free seats
+        members = list(self.room_members[room].values())
+        groups = []
+        start = 0
+        for shard, seats in self._allocate_seats("ped_pong", len(members)):
+            groups.append((shard, members[start:start + seats]))
+            start += seats
+        movers, staying = members[:start], members[start:]
+        self.metrics.inc("drivechat_ped_pong_migrations_total", len(movers))
+        self.metrics.inc("drivechat_ped_pong_deferred_total", len(staying))
+
+        # ย้ายทั้งกลุ่ม (ไม่มี await ระหว่างย้าย จึงไม่มีใครเห็นสถานะครึ่งๆ กลางๆ)
+        # Move the whole group (no await in between, so nobody sees a half-done move)
+        for shard, group in groups:
+            for member in group:
+                member.original_room = room
+                self._move_member(member, shard)
+
+                # แจ้งผู้ใช้และส่งคำสั่งให้ client เปลี่ยนห้อง
+                # Notify the user and tell the client to change room
+                self.send_personal(member.websocket, "System: Moving all users to ped pong...")
+                self.send_personal(
+                    member.websocket, "System: ROOM_CHANGE:ped_pong", FRAME_CONTROL,
+                    event=("room_change", {"room": "ped_pong"}),
+                )
+                self.replay_history(member, shard)
+
+        # คนที่หลุดอยู่ตามไป ped_pong ด้วย (ได้ shard ตอนต่อกลับ)
+        # Detached users follow to ped_pong (they get a shard on reconnect)
+        if not staying:
+            self._redirect_detached(room, "ped_pong")
+
+        # ped_pong เต็ม: คนที่เหลืออยู่ห้องเดิมต่อ แล้วลองใหม่ภายหลัง
+        # ped_pong is full: the rest stay aboard and we try again later
+        if staying:
+            for member in staying:
+                self.send_personal(member.websocket, "System: Ped pong is full, staying on board for now")
+            self.schedule_room_transition(room, PED_PONG_RETRY_SECONDS, publish=False)
+
+        if not movers:
+            return
+
+        # แจ้งแต่ละ shard ครั้งเดียวว่ามีใครเข้ามาบ้าง
+        # Notify each shard once about everyone who arrived
+        for shard, group in groups:
+            names = ", ".join(member.username for member in group)
+            verb = "was" if len(group) == 1 else "were"
+            await self.broadcast(f"System: {names} {verb} moved from {room}", shard)
+            self.presence_changed(shard, joined=[member.username for member in group])
+        for member in movers:
+            if member.presence == PRESENCE_DELTA:
+                self.send_presence_snapshot(member.websocket)
+        moved = [member.username for member in movers]
+        if staying:
+            self.presence_changed(room, left=moved)
+
+    async def move_back_to_original_room(self, username: str, websocket: WebSocket):
+        """
+        ย้ายผู้ใช้กลับไปห้องเดิม (หลังจากอยู่ที่ ped_pong)
+        Move user back to their original room (after being at ped_pong)
+        
+        ผู้ใช้สามารถใช้คำสั่ง /return เพื่อกลับห้องเดิม
+        User can use /return command to go back
+        
+        Args:
+            username: ชื่อผู้ใช้ที่จะย้าย
+            websocket: WebSocket connection ของผู้ใช้
+            
+        Returns:
+            bool: True ถ้าย้ายสำเร็จ, False ถ้าไม่สำเร็จ
+        """
+        # หาข้อมูลผู้ใช้และห้องเดิมที่บันทึกไว้ (O(1) จาก socket)
+        # Look up the member and its recorded original room (O(1) by socket)
+        member = self.members.get(websocket)
+        if member is None or member.original_room is None:
+            return False
+
+        original_room = member.original_room
+        current_room = member.room
+
+        # ไม่ย้ายถ้าอยู่ห้องเดิมแล้ว หรือห้องเดิมถูกลบไปแล้ว
+        # Don't move if already in original room, or it has been deleted
+        if current_room == original_room or original_room not in self.available_rooms:
+            return False
+
+        # ดำเนินการย้ายกลับห้องเดิม
+        # Execute move back to original room
+        try:
+            self._move_member(member, original_room)
+
+            # อัพเดท client
+            # Update client
+            self.send_personal(websocket, f"System: Moving back to {original_room}...")
+            self.send_personal(
+                websocket, f"System: ROOM_CHANGE:{original_room}", FRAME_CONTROL,
+                event=("room_change", {"room": original_room}),
+            )
+            self.replay_history(member, original_room)
+
+            # แจ้งห้องเดิมว่ากลับมาแล้ว
+            # Notify original room about return
+            await self.broadcast(f"System: {username} has returned to the room", original_room)
+            self.presence_changed(original_room, joined=[username])
+            self.presence_changed(current_room, left=[username])
+            if member.presence == PRESENCE_DELTA:
+                self.send_presence_snapshot(websocket)
+
+            # ลบ tracking
+            # Clean up tracking
+            member.original_room = None
+
+            return True
+        except Exception as e:
+            print(f"Error moving user back: {e}")
+            return False
+
+    def schedule_room_transition(self, room: str, delay: float = ROOM_LIFETIME_SECONDS, publish: bool = True):
+        """
+        ตั้งเวลาย้ายผู้ใช้ไป ped_pong (ค่าเริ่มต้น 3 นาที) พร้อมแจ้งเตือนล่วงหน้า
+        Schedule the move to ped_pong (3 minutes by default) plus an advance warning
+        
+        ห้องปกติจะมีเวลา 3 นาที หลังจากนั้นทุกคนจะถูกย้ายไป ped_pong
+        เรียกซ้ำได้เพื่อเลื่อนเวลา (reschedule)
+        Normal rooms have 3 minutes, after which everyone moves to ped_pong;
+        calling this again reschedules the room
+        
+        Args:
+            room: ชื่อห้องที่จะตั้ง timer
+            delay: วินาทีจนถึง transition
+            publish: แจ้ง worker อื่นผ่าน broker (False เมื่อรับมาจาก broker เองหรือเป็นการลองใหม่เฉพาะ worker นี้)
+        """
+        # ไม่ตั้ง timer สำหรับห้องพิเศษ
+        # Don't set timer for special rooms
+        if self.available_rooms[room].get("is_special"):
+            return
+
+        if delay > ROOM_WARNING_SECONDS:
+            self.scheduler.schedule(room, ACTION_WARN, delay - ROOM_WARNING_SECONDS)
+        else:
+            self.scheduler.cancel(room, ACTION_WARN)
+        self.scheduler.schedule(room, ACTION_TRANSITION, delay)
+        self._refresh_room_index(room)
+
+        if publish:
+            info = dict(self.available_rooms[room], transition_at=time.time() + delay)
+            self.broker.room_updated(room, info)
+
+    async def _handle_room_deadline(self, room: str, action: str):
+        """
+        ทำงานเมื่อ deadline ของห้องมาถึง (เรียกโดย RoomScheduler)
+        Run a room's due action (called by RoomScheduler)
+        
+        Args:
+            room: ชื่อห้อง
+            action: ACTION_WARN หรือ ACTION_TRANSITION
+        """
+        # ช่วงเตือน/ย้ายแล้ว: ปิดรับคนใหม่ / Warning period or moved: stop handing the room out
+        self._refresh_room_index(room)
+        try:
+            if action == ACTION_WARN:
+                # ทุก worker ตั้งเวลาเดียวกัน จึงเตือนเฉพาะสมาชิกของตัวเอง
+                # Every worker runs the same deadline, so each warns only its own members
+                await self.broadcast(
+                    f"System: Room will transition to ped pong in {ROOM_WARNING_SECONDS} seconds!",
+                    room,
+                    relay=False,
+                )
+            elif action == ACTION_TRANSITION:
+                await self.move_users_to_ped_pong(room)
+        except Exception as e:
+            print(f"Error in transition timer for {room}: {e}")
+            # พยายามย้ายผู้ใช้แม้มี error
+            # Attempt to move users even if there's an error
+            if action == ACTION_TRANSITION:
+                await self.move_users_to_ped_pong(room)
+
+    # --------------------------------------------------------------------------
+    # 4.4 ROOM INFORMATION (ข้อมูลห้อง)
+    # --------------------------------------------------------------------------
+
+    def get_time_remaining(self, room: str) -> Optional[int]:
+        """
+        คำนวณเวลาที่เหลือก่อน transition ไป ped_pong
+        Calculate time remaining before transition to ped_pong
+        
+        Args:
+            room: ชื่อห้อง
+            
+        Returns:
+            จำนวนวินาทีที่เหลือ หรือ None ถ้าไม่มี timer
+        """
+        if room not in self.available_rooms or self.available_rooms[room].get("is_special"):
+            return None
+
+        deadline = self.scheduler.deadline(room, ACTION_TRANSITION)
+        if deadline is None:
+            return None
+
+        return max(0, int(deadline - self.scheduler.clock()))
+
+    def is_boarding(self, room: str) -> bool:
+        """
+        ห้องปกติที่ยังรับคนใหม่: มี deadline และเหลือเวลามากกว่า ROOM_WARNING_SECONDS
+        A regular room still taking newcomers: it has a deadline more than ROOM_WARNING_SECONDS away
+        """
+        deadline = self.scheduler.deadline(room, ACTION_TRANSITION)
+        return deadline is not None and deadline - self.scheduler.clock() > ROOM_WARNING_SECONDS
+
+    def get_room_count(self, room: str) -> int:
+        """
+        นับจำนวนผู้ใช้ในห้อง
+        Count users in a room
+        
+        Args:
+            room: ชื่อห้อง
+            
+        Returns:
+            จำนวนผู้ใช้ในห้อง
+        """
+        return len(self.room_members.get(room, ())) + self.remote_counts[room] + self.reserved[room]
+
+    def get_room_capacity(self, room: str) -> int:
+        """
+        ดึงความจุสูงสุดของห้อง
+        Get room maximum capacity
+        
+        Args:
+            room: ชื่อห้อง
+            
+        Returns:
+            จำนวนผู้ใช้สูงสุดที่ห้องรองรับได้
+        """
+        return self.available_rooms.get(room, {}).get("capacity", 0)
+
+    def get_random_active_room(self, transport_type: str, user_type: str) -> dict:
+        """
+        สุ่มหาห้องที่ว่างสำหรับผู้โดยสาร
+        Find a random available room for passengers
+        
+        ฟังก์ชันนี้ใช้สำหรับ "Join Random Room" 
+        เฉพาะ passenger เท่านั้นที่ใช้ได้
+        
+        Args:
+            transport_type: ประเภทยานพาหนะที่ต้องการ
+            user_type: ประเภทผู้ใช้ (passenger/driver)
+            
+        Returns:
+            dict ข้อมูลห้องที่เลือก หรือ None ถ้าไม่มีห้องว่าง
+        """
+        # เฉพาะ passenger เท่านั้นที่ใช้ random join ได้
+        # Only passengers can use random join
+        if user_type != "passenger":
+            return None
+
+        # สุ่มจากดัชนีห้องว่าง (ไม่ต้องวนดูทุกห้อง)
+        # Pick from the open-room index (no scan over every room)
+        weight = None
+        if RANDOM_ROOM_WEIGHTING == "seats":
+            weight = lambda name: self.get_room_capacity(name) - self.get_room_count(name)
+        elif RANDOM_ROOM_WEIGHTING == "time":
+            weight = lambda name: self.get_time_remaining(name) or 0
+        room_name = self.directory.pick(transport_type, weight)
+        self.metrics.inc("drivechat_random_room_requests_total", label=("result", "miss" if room_name is None else "hit"))
+        if room_name is None:
+            return None
+
+        return {
+            "room": room_name,
+            "capacity": self.get_room_capacity(room_name),
+            "current_users": self.get_room_count(room_name),
+            "time_remaining": self.get_time_remaining(room_name)
+        }
+
+    def room_view(self, room: str) -> Optional[dict]:
+        """
+        ข้อมูลห้องปกติสำหรับ /rooms/stream (None ถ้าไม่มี, เป็นห้องพิเศษ หรือไม่รับคนใหม่แล้ว)
+        A regular room as shown on /rooms/stream (None if missing, special or no longer boarding)
+        """
+        info = self.available_rooms.get(room)
+        if info is None or info.get("is_special") or not self.is_boarding(room):
+            return None
+        return {
+            "room": room,
+            "transport_type": info.get("transport_type"),
+            "capacity": info["capacity"],
+            "free": info["capacity"] - self.get_room_count(room),
+            "time_remaining": self.get_time_remaining(room),
+        }
+
+    # --------------------------------------------------------------------------
+    # 4.5 BROADCASTING (ส่งข้อความ)
+    # --------------------------------------------------------------------------
+
+    async def broadcast(
+        self,
+        message: str,
+        room: str,
+        exclude: WebSocket = None,
+        relay: bool = True,
+        record: bool = False,
+        event: Optional[tuple[str, dict]] = None,
+    ) -> dict:
+        """
+        ส่งข้อความไปยังทุกคนในห้อง
+        Send message to everyone in a room
+        
+        Args:
+            message: ข้อความที่จะส่ง
+            room: ชื่อห้อง
+            exclude: WebSocket ที่ไม่ต้องส่งถึง (optional)
+            relay: ส่งต่อให้สมาชิกของห้องนี้ใน worker อื่นด้วย
+            record: เก็บลงประวัติของห้องเพื่อ replay ให้ผู้ที่เข้ามาทีหลัง (ข้อความแชทของผู้ใช้)
+            event: (ชนิด, ข้อมูล) สำหรับ client แบบมีชนิด (None = สร้างจาก message)
+            
+        Returns:
+            dict: สรุปผลการส่ง (recipients, failed, enqueue_ms)
+        """
+        frame = OutboundFrame(message, FRAME_CHAT, event)
+        frame.seq = self._next_seq(room)
+        if relay:
+            self.broker.publish(room, message, FRAME_CHAT, record, event, frame.seq)
+        return self._deliver(room, frame, exclude, record)
+
+    def _deliver(self, room: str, frame: OutboundFrame, exclude: WebSocket = None, record: bool = False) -> dict:
+        """
+        ส่ง frame ของห้องทันทีถ้าห้องเงียบ หรือรวมไว้ส่งพร้อมกันถ้าห้องคึกคัก
+        Send a room frame right away if the room is quiet, or batch it if the room is busy
+        
+        ห้องถือว่าคึกคักเมื่อส่งครั้งล่าสุดไปไม่ถึง ROOM_BATCH_WINDOW_MS:
+        ข้อความจะรอจนครบช่วงแล้วส่งพร้อมกันครั้งเดียวต่อผู้รับ (client แบบมีชนิด
+        ได้เป็น array frame เดียว) แลก latency ไม่กี่ ms กับ throughput ที่สูงขึ้น
+        A room counts as busy when its last send was less than ROOM_BATCH_WINDOW_MS
+        ago: messages then wait for the window to close and go out together, once
+        per recipient (one array frame for typed clients), trading a few ms of
+        latency for throughput
+        
+        Returns:
+            dict: สรุปผลการส่ง (batched=True ถ้ารอส่งรวม)
+        """
+        batch = self.batches.get(room)
+        if ROOM_BATCH_WINDOW_MS <= 0 or exclude is not None:
+            if batch is not None and batch.pending:
+                self._flush_batch(room)
+            return self._send_now(room, frame, exclude, record)
+
+        window = ROOM_BATCH_WINDOW_MS / 1000
+        loop = asyncio.get_running_loop()
+        if batch is None:
+            batch = self.batches[room] = RoomBatch()
+        if batch.handle is None and loop.time() - batch.last_send >= window:
+            batch.last_send = loop.time()
+            return self._send_now(room, frame, exclude, record)
+
+        batch.pending.append((frame, record))
+        if batch.handle is None:
+            batch.handle = loop.call_at(batch.last_send + window, self._flush_batch, room)
+        return {"room": room, "recipients": 0, "failed": 0, "enqueue_ms": 0.0, "batched": True}
+
+    def _send_now(self, room: str, frame: OutboundFrame, exclude: WebSocket = None, record: bool = False) -> dict:
+        """ส่ง frame ให้ทุกคนในห้องทันที / Send a frame to everyone in the room right away"""
+        if record:
+            self.record_history(room, frame)
+        recipients = [
+            member
+            for connection, member in self.room_members.get(room, {}).items()
+            if connection is not exclude
+        ]
+        return self._fan_out(room, recipients, frame)
+
+    def _flush_batch(self, room: str):
+        """
+        ส่งข้อความที่รอรวมของห้องให้สมาชิกปัจจุบันทุกคนในครั้งเดียว
+        Send a room's batched messages to every current member in one go
+        
+        บันทึกประวัติตอน flush (ไม่ใช่ตอนรับ) ผู้ที่เข้ามาระหว่างรอจึงไม่ได้ข้อความซ้ำ
+        History is recorded at flush (not on arrival), so users who join
+        during the window never get a line twice
+        """
+        batch = self.batches.get(room)
+        if batch is None:
+            return
+        batch.handle = None
+        pending, batch.pending = batch.pending, []
+        if not pending:
+            return
+        batch.last_send = asyncio.get_running_loop().time()
+
+        frames = [frame for frame, _ in pending]
+        for frame, record in pending:
+            if record:
+                self.record_history(room, frame)
+        self.broadcast_stats["batched"] += len(frames)
+        self._fan_out(room, list(self.room_members.get(room, {}).values()), frames)
+
+    def _next_seq(self, room: str) -> int:
+        """ลำดับข้อความถัดไปของห้อง / The room's next message sequence number"""
+        seq = self.room_seq.get(room, 0) + 1
+        self.room_seq[room] = seq
+        return seq
+
+    def _follow_seq(self, room: str, seq: Optional[int]) -> int:
+        """
+        ใช้ลำดับของข้อความจาก worker อื่น และเลื่อนลำดับของห้องตามไป (ข้อความถัดไปของ worker นี้ได้เลขที่มากกว่า)
+        Take another worker's sequence number for its message and move the room's counter
+        past it (this worker's next message gets a higher number)
+        """
+        if seq is None:
+            return self._next_seq(room)
+        if seq > self.room_seq.get(room, 0):
+            self.room_seq[room] = seq
+        return seq
+
+    async def broadcast_user_list(self, room: str) -> Optional[dict]:
+        """
+        ส่งรายชื่อผู้ใช้ในห้องไปยังทุกคนทันที (ไม่รอ debounce)
+        Send the user list to everyone in the room right away (no debounce)
+        
+        ข้อความจะแสดง: จำนวนผู้ใช้, รายชื่อ, และเวลาที่เหลือ
+        Message shows: user count, names, and time remaining
+        
+        Args:
+            room: ชื่อห้อง
+        """
+        if room not in self.room_members:
+            return None
+        return self._fan_out(room, list(self.room_members[room].values()), self._user_list_frame(room))
+
+    def _user_list_frame(self, room: str) -> OutboundFrame:
+        """
+        สร้าง frame รายชื่อผู้ใช้แบบเต็ม ("Active users (n/cap): ..." หรือ event "users")
+        Build the full user-list frame ("Active users (n/cap): ..." or a "users" event)
+        """
+        user_list = self.room_usernames(room)
+        capacity = self.available_rooms[room]["capacity"]
+        time_remaining = self.get_time_remaining(room)
+
+        # สร้างข้อความสถานะ
+        # Create status message
+        status_msg = f"Active users ({len(user_list)}/{capacity}): {', '.join(user_list)}"
+        if time_remaining is not None:
+            status_msg += f" | Time remaining: {time_remaining//60}m {time_remaining%60}s"
+        event = {"users": user_list, "capacity": capacity, "time_remaining": time_remaining}
+        frame = OutboundFrame(status_msg, FRAME_PRESENCE, ("users", event))
+        frame.room = room
+        return frame
+
+    def send_personal(
+        self,
+        websocket: WebSocket,
+        message: str,
+        kind: str = FRAME_CHAT,
+        event: Optional[tuple[str, dict]] = None,
+    ) -> bool:
+        """
+        ส่งข้อความถึง client คนเดียว (ผ่านคิวขาออกของ connection นั้น)
+        Send a message to a single client (through that connection's outbound queue)
+        
+        Args:
+            websocket: WebSocket ของผู้รับ
+            message: ข้อความที่จะส่ง
+            kind: ประเภท frame
+            event: (ชนิด, ข้อมูล) สำหรับ client แบบมีชนิด (None = สร้างจาก message)
+            
+        Returns:
+            bool: True ถ้าใส่คิวสำเร็จ
+        """
+        member = self.members.get(websocket)
+        if member is None:
+            return False
+        frame = OutboundFrame(message, kind, event)
+        frame.room = member.room
+        return member.writer.enqueue(frame)
+
+    def record_history(self, room: str, frame: OutboundFrame):
+        """
+        เก็บ frame ลงประวัติของห้อง
+        Store a frame in the room's history
+        """
+        if HISTORY_MAX_MESSAGES <= 0 or HISTORY_MAX_BYTES <= 0 or room not in self.available_rooms:
+            return
+        history = self.history.get(room)
+        if history is None:
+            history = self.history[room] = RoomHistory()
+        history.append(frame)
+
+    def replay_history(self, member: Member, room: str, since: Optional[int] = None) -> bool:
+        """
+        ส่งประวัติแชทของห้องให้สมาชิกคนเดียวในครั้งเดียว
+        Send a room's chat history to one member in a single batch
+        
+        Args:
+            member: สมาชิกที่จะรับ
+            room: ห้องที่จะ replay ประวัติ
+            since: ส่งเฉพาะ frame ที่ลำดับมากกว่านี้ (None = ทั้งหมด)
+            
+        Returns:
+            bool: False ถ้า connection เสียไปแล้ว
+        """
+        history = self.history.get(room)
+        if history is None:
+            return True
+        frames = history.recent()
+        if since is not None:
+            frames = [frame for frame in frames if frame.seq is not None and frame.seq > since]
+        return member.writer.enqueue_many(frames)
+
+    def _fan_out(self, room: str, recipients: list[Member], frame: Union[OutboundFrame, str, list]) -> dict:
+        """
+        ใส่ข้อความลงคิวขาออกของผู้รับทุกคน
+        Enqueue a message on every recipient's outbound queue
+        
+        การส่งจริงทำโดย writer task ของแต่ละ connection พร้อมกัน
+        โดยแต่ละการส่งมี timeout ของตัวเอง client ที่ช้าหรือส่งไม่สำเร็จ
+        จึงไม่ทำให้คนอื่นได้รับข้อความช้าลง และจะถูกตัดออกจากห้อง
+        The actual writes happen concurrently in each connection's writer task,
+        each with its own timeout, so a slow or failing client never delays
+        anyone else and is pruned from the room
+        
+        Args:
+            room: ชื่อห้อง
+            recipients: รายการสมาชิกที่จะส่งถึง (snapshot)
+            frame: OutboundFrame, ข้อความ (str) หรือ list ของ OutboundFrame ที่จะส่งตามลำดับ
+            
+        Returns:
+            dict: สรุปผลการส่ง (room, recipients, failed, enqueue_ms = เวลาใส่คิวของทุกคน ไม่ใช่เวลาส่งถึง)
+        """
+        if isinstance(frame, str):
+            frame = OutboundFrame(frame)
+        frames = frame if isinstance(frame, list) else [frame]
+        for item in frames:
+            if item.room is None:
+                item.room = room
+
+        started = time.perf_counter()
+        failed = 0
+        for member in recipients:
+            enqueue = member.writer.enqueue
+            for item in frames:
+                if not enqueue(item):
+                    failed += 1
+                    break
+        enqueue_ms = (time.perf_counter() - started) * 1000
+
+        # อัพเดทสถิติ (เวลาส่งถึงจริงวัดใน _on_delivered)
+        # Update statistics (actual delivery time is measured in _on_delivered)
+        stats = self.broadcast_stats
+        stats["broadcasts"] += 1
+        stats["recipients"] += len(recipients)
+        stats["last_enqueue_ms"] = enqueue_ms
+        stats["max_enqueue_ms"] = max(stats["max_enqueue_ms"], enqueue_ms)
+        if self.metrics.enabled:
+            self.metrics.observe("drivechat_broadcast_recipients", len(recipients))
+            self.metrics.observe("drivechat_broadcast_seconds", enqueue_ms / 1000)
+
+        return {
+            "room": room,
+            "recipients": len(recipients),
+            "failed": failed,
+            "enqueue_ms": enqueue_ms,
+        }
+
+    def _on_delivered(self, seconds: float):
+        """
+        callback จาก ConnectionWriter หลังส่งเสร็จ: เวลาตั้งแต่ frame เข้าคิวจนส่งถึง socket
+        Callback from ConnectionWriter after a send: time from enqueue to the completed socket write
+        """
+        latency_ms = seconds * 1000
+        stats = self.broadcast_stats
+        stats["last_latency_ms"] = latency_ms
+        stats["max_latency_ms"] = max(stats["max_latency_ms"], latency_ms)
+        if self.metrics.enabled:
+            self.metrics.observe("drivechat_delivery_seconds", seconds)
+
+    def _on_writer_failure(self, websocket: WebSocket):
+        """
+        callback จาก ConnectionWriter เมื่อส่งไม่สำเร็จหรือคิวล้น
+        Callback from ConnectionWriter when a send fails or the queue overflows
+        """
+        self.broadcast_stats["failures"] += 1
+        if websocket in self.members:
+            spawn_tracked(self.tasks, self._prune_failed([websocket]))
+
+    async def _prune_failed(self, failed: list[WebSocket], code: int = 1000, reason: Optional[str] = None):
+        """
+        ตัด connection ออกจากห้องเป็นชุด แล้วแจ้งคนที่เหลือครั้งเดียวต่อห้อง
+        Remove a batch of connections, then notify each room's remaining users once
+        
+        Args:
+            failed: รายการ WebSocket ที่จะตัด (ส่งไม่สำเร็จ หรือถูก heartbeat ตัด)
+            code, reason: close code และเหตุผลที่ส่งให้ client
+        """
+        removed_by_room: dict[str, list[str]] = {}
+        for connection in failed:
+            member = self._remove_member(connection)
+            if member is None:
+                continue
+            removed_by_room.setdefault(member.room, []).append(member.username)
+            spawn_tracked(self.tasks, self._close_quietly(connection, code, reason))
+
+        for room, usernames in removed_by_room.items():
+            if len(usernames) == 1:
+                await self.broadcast(f"System: {usernames[0]} has left the chat", room)
+            else:
+                await self.broadcast(f"System: {', '.join(usernames)} have left the chat", room)
+            self.presence_changed(room, left=usernames)
+            self._delete_room_if_empty(room)
+
+    async def _close_quietly(self, connection: WebSocket, code: int = 1000, reason: Optional[str] = None):
+        """
+        ปิด WebSocket โดยไม่สนใจ error (connection อาจตายไปแล้ว)
+        Close a WebSocket, ignoring errors (the connection may already be dead)
+        """
+        try:
+            await asyncio.wait_for(connection.close(code, reason), SEND_TIMEOUT_SECONDS)
+        except Exception:
+            pass
+
+
+    # --------------------------------------------------------------------------
+    # 4.6 PRESENCE (รายชื่อผู้ใช้ในห้อง)
+    # --------------------------------------------------------------------------
+
+    def presence_changed(self, room: str, joined: list[str] = (), left: list[str] = ()):
+        """
+        บันทึกการเปลี่ยนแปลงรายชื่อผู้ใช้ แล้วส่งรวมครั้งเดียวเมื่อครบช่วง debounce
+        Record a user-list change and send it once the debounce window closes
+        
+        การเข้า/ออกหลายครั้งในช่วง PRESENCE_DEBOUNCE_MS จึงกลายเป็นการส่ง
+        หนึ่งครั้งต่อห้อง แทนการส่งรายชื่อเต็มทุกครั้งที่มีคนเข้า/ออก
+        Several joins/leaves within PRESENCE_DEBOUNCE_MS become a single
+        update per room instead of a full list on every change
+        
+        Args:
+            room: ชื่อห้อง
+            joined: ชื่อผู้ที่เข้ามา
+            left: ชื่อผู้ที่ออกไป
+        """
+        if room not in self.available_rooms:
+            return
+        presence = self.presence.setdefault(room, RoomPresence())
+        presence.joined.extend(joined)
+        for username in left:
+            # เข้าแล้วออกในช่วงเดียวกัน: หักล้างกันไป
+            # Joined and left within the same window: they cancel out
+            if username in presence.joined:
+                presence.joined.remove(username)
+            else:
+                presence.left.append(username)
+
+        if presence.handle is not None:
+            return
+        if PRESENCE_DEBOUNCE_MS <= 0:
+            self._flush_presence(room)
+            return
+        presence.handle = asyncio.get_running_loop().call_later(
+            PRESENCE_DEBOUNCE_MS / 1000, self._flush_presence, room
+        )
+
+    def _flush_presence(self, room: str):
+        """
+        ส่งการเปลี่ยนแปลงที่ค้างอยู่: รายชื่อเต็มสำหรับ client ทั่วไป, delta สำหรับ client แบบ delta
+        Send pending changes: the full list to regular clients, a delta to delta clients
+        
+        client แบบ delta ที่ขอ snapshot ไว้ (เพิ่งเข้าห้องหรือส่ง /who) ได้ snapshot
+        ที่ version ใหม่แทน delta
+        Delta clients that asked for a snapshot (just joined, or sent /who)
+        get a snapshot at the new version instead of the delta
+        """
+        presence = self.presence.get(room)
+        if presence is None:
+            return
+        presence.handle = None
+        members = list(self.room_members.get(room, {}).values())
+        changed = bool(presence.joined or presence.left)
+        if changed:
+            presence.version += 1
+
+        full_members = []
+        delta_members = []
+        for member in members:
+            if member.presence == PRESENCE_FULL:
+                full_members.append(member)
+            elif member.websocket in presence.snapshot_requests:
+                self._send_snapshot(member, presence)
+            else:
+                delta_members.append(member)
+
+        if full_members and changed:
+            self._fan_out(room, full_members, self._user_list_frame(room))
+
+        # delta ทิ้งได้เมื่อคิวเต็ม: client เห็น version กระโดดแล้วขอ /who ใหม่
+        # Deltas may be dropped on overflow: the client sees a version gap and sends /who
+        if delta_members and changed:
+            delta = {
+                "v": presence.version,
+                "joined": presence.joined,
+                "left": presence.left,
+                "count": self.get_room_count(room),
+                "time_remaining": self.get_time_remaining(room),
+            }
+            text = json.dumps({"type": "presence", "room": logical_room(room), **delta})
+            self._fan_out(room, delta_members, OutboundFrame(text, FRAME_CHAT, ("presence", delta)))
+
+        presence.joined, presence.left = [], []
+        presence.snapshot_requests.clear()
+
+    def send_presence_snapshot(self, websocket: WebSocket) -> bool:
+        """
+        ส่งรายชื่อผู้ใช้ทั้งหมดของห้องให้ client คนเดียว (ตอนเข้าห้องหรือเมื่อขอด้วย /who)
+        Send the room's complete user list to one client (on join or when asked via /who)
+        
+        ถ้ามีการเปลี่ยนแปลงค้างอยู่ snapshot จะถูกส่งตอน flush เพื่อให้ version ตรงกัน
+        If changes are pending, the snapshot is sent at flush so versions line up
+        
+        Returns:
+            bool: True ถ้าส่ง (หรือรอส่ง) สำเร็จ
+        """
+        member = self.members.get(websocket)
+        if member is None:
+            return False
+        if member.presence == PRESENCE_FULL:
+            return member.writer.enqueue(self._user_list_frame(member.room))
+
+        presence = self.presence.setdefault(member.room, RoomPresence())
+        if presence.handle is not None:
+            presence.snapshot_requests.add(websocket)
+            return True
+        return self._send_snapshot(member, presence)
+
+    def _send_snapshot(self, member: Member, presence: RoomPresence) -> bool:
+        """ส่ง presence snapshot (JSON) ให้สมาชิกหนึ่งคน / Send a JSON presence snapshot to one member"""
+        room = member.room
+        snapshot = {
+            "v": presence.version,
+            "users": self.room_usernames(room),
+            "capacity": self.get_room_capacity(room),
+            "time_remaining": self.get_time_remaining(room),
+        }
+        text = json.dumps({"type": "presence_snapshot", "room": logical_room(room), **snapshot})
+        frame = OutboundFrame(text, FRAME_PRESENCE, ("presence_snapshot", snapshot))
+        frame.room = room
+        return member.writer.enqueue(frame)
+
+
+    # --------------------------------------------------------------------------
+    # 4.7 MULTI-WORKER SYNC (ซิงค์ข้อมูลระหว่าง worker ผ่าน broker)
+    # --------------------------------------------------------------------------
+
+    def local_usernames(self, room: str) -> list[str]:
+        """
+        รายชื่อผู้ใช้ของห้องที่เชื่อมต่อกับ worker นี้ (รวมคนที่หลุดและยังอยู่ในช่วง grace)
+        Usernames of a room connected to this worker (including users within their grace period)
+        """
+        usernames = [member.username for member in self.room_members.get(room, {}).values()]
+        usernames.extend(session.username for session in self.detached_rooms.get(room, {}).values())
+        return usernames
+
+    def room_usernames(self, room: str) -> list[str]:
+        """
+        รายชื่อผู้ใช้ทั้งหมดของห้อง (worker นี้ก่อน ตามด้วย worker อื่น)
+        Every username in a room (this worker's first, then other workers')
+        """
+        usernames = self.local_usernames(room)
+        for remote in self.remote_members.get(room, {}).values():
+            usernames.extend(remote)
+        return usernames
+
+    def apply_broker_message(self, message: dict):
+        """
+        นำข้อความจาก broker (ที่มาจาก worker อื่น) มาใช้กับสถานะของ worker นี้
+        Apply a broker message (originating from another worker) to this worker's state
+        
+        Args:
+            message: dict ที่มี "op" เป็น sync, publish, room, room_deleted หรือ members
+        """
+        op = message.get("op")
+        if op == "publish":
+            # ส่งต่อให้สมาชิกใน worker นี้เท่านั้น (ไม่ส่งต่อกลับ) ด้วยลำดับเดียวกับ worker ต้นทาง
+            # ห้องที่ worker นี้ไม่รู้จักไม่สร้างสถานะใหม่
+            # Deliver to this worker's members only (never relayed back) under the origin
+            # worker's sequence number; rooms this worker doesn't know create no state
+            room = message["room"]
+            if room not in self.available_rooms:
+                return
+            event = message.get("event")
+            frame = OutboundFrame(message["text"], message["kind"], tuple(event) if event else None)
+            frame.seq = self._follow_seq(room, message.get("seq"))
+            self._deliver(room, frame, record=bool(message.get("record")))
+        elif op == "room":
+            self._apply_remote_room(message["room"], message["info"])
+        elif op == "room_deleted":
+            room = message["room"]
+            if self.get_room_count(room) == 0 and not self.available_rooms.get(room, {}).get("is_special"):
+                self._drop_room(room)
+        elif op == "members":
+            self._apply_remote_members(message["room"], message["worker"], message["users"])
+        elif op == "sync":
+            # sync คือสถานะทั้งหมดของ worker อื่น: ห้องของ worker ที่ไม่อยู่แล้ว (ว่าง) และรายชื่อที่ไม่มีใน sync ถูกลบ
+            # A sync is every other worker's whole state: empty rooms of workers that are gone,
+            # and member lists missing from it, are dropped
+            for room, by_worker in list(self.remote_members.items()):
+                for worker in list(by_worker):
+                    if worker not in message["members"].get(room, {}):
+                        self._apply_remote_members(room, worker, [])
+            for room, info in list(self.available_rooms.items()):
+                if (
+                    not info.get("is_special") and room not in message["rooms"]
+                    and room not in self.broker.owned_rooms and self.get_room_count(room) == 0
+                ):
+                    self._drop_room(room)
+            for room, info in message["rooms"].items():
+                self._apply_remote_room(room, info)
+            for room, by_worker in message["members"].items():
+                for worker, users in by_worker.items():
+                    self._apply_remote_members(room, worker, users)
+
+    def clear_remote_members(self):
+        """
+        ลืมสมาชิกของ worker อื่นทั้งหมด (ตอนหลุดจาก broker จะไม่รู้ว่า worker ไหนยังอยู่; sync ตอนต่อใหม่ส่งคืนมา)
+        Forget every other worker's members (cut off from the broker, there is no telling
+        which workers are still alive; the sync after reconnecting brings them back)
+        """
+        for room, by_worker in list(self.remote_members.items()):
+            for worker in list(by_worker):
+                self._apply_remote_members(room, worker, [])
+
+    def _apply_remote_room(self, room: str, info: dict):
+        """รับห้องที่ worker อื่นสร้าง/เลื่อนเวลา / Take in a room another worker created or rescheduled"""
+        info = dict(info)
+        transition_at = info.pop("transition_at", None)
+        self.available_rooms[room] = info
+        if transition_at is not None:
+            self.schedule_room_transition(room, max(0.0, transition_at - time.time()), publish=False)
+        self._refresh_room_index(room)
+
+    def _apply_remote_members(self, room: str, worker: str, users: list[str]):
+        """
+        แทนที่รายชื่อสมาชิกของห้องจาก worker หนึ่ง แล้วแจ้ง presence เฉพาะส่วนที่เปลี่ยน
+        Replace one worker's member list for a room and report only the difference as presence
+        """
+        by_worker = self.remote_members.setdefault(room, {})
+        previous = by_worker.get(worker, [])
+        if users:
+            by_worker[worker] = users
+        else:
+            by_worker.pop(worker, None)
+            if not by_worker:
+                del self.remote_members[room]
+        self.remote_counts[room] += len(users) - len(previous)
+        if self.remote_counts[room] <= 0:
+            del self.remote_counts[room]
+
+        joined = list((Counter(users) - Counter(previous)).elements())
+        left = list((Counter(previous) - Counter(users)).elements())
+        self._refresh_room_index(room)
+        if (joined or left) and self.room_members.get(room):
+            self.presence_changed(room, joined=joined, left=left)
+
+
+    # --------------------------------------------------------------------------
+    # 4.8 FLOOD PROTECTION (ป้องกันการส่งข้อความถี่เกินไป)
+    # --------------------------------------------------------------------------
+
+    def check_incoming(self, member: Member, text: str, is_chat: bool) -> str:
+        """
+        ตรวจข้อความขาเข้าก่อนประมวลผล: ขนาด, อัตราต่อ connection, ข้อความซ้ำ และอัตราต่อห้อง
+        Vet an incoming message: size, per-connection rate, duplicates and per-room rate
+        
+        ผิดครั้งแรกของแต่ละช่วงจะได้คำเตือน ผิดติดกันครบ FLOOD_DISCONNECT_AFTER
+        ครั้งจะถูกตัดการเชื่อมต่อ ห้องที่เต็มโควต้าไม่นับเป็นความผิดของผู้ส่ง
+        The first violation of a streak gets a warning; FLOOD_DISCONNECT_AFTER
+        consecutive violations close the connection. A room over its budget
+        is not counted against the sender
+        
+        Args:
+            member: ผู้ส่ง
+            text: ข้อความ
+            is_chat: True ถ้าเป็นข้อความแชท (ไม่ใช่คำสั่งเช่น /who)
+            
+        Returns:
+            str: FLOOD_OK, FLOOD_DROP หรือ FLOOD_DISCONNECT
+        """
+        # UTF-8 ใช้ไม่เกิน 4 bytes ต่อตัวอักษร: encode เฉพาะข้อความที่อาจยาวเกิน
+        # UTF-8 takes at most 4 bytes per character: only encode text that might be too long
+        if len(text) * 4 > MAX_MESSAGE_BYTES and len(text.encode("utf-8")) > MAX_MESSAGE_BYTES:
+            self.flood_stats["oversized"] += 1
+            return self._strike(member, f"Message too long (max {MAX_MESSAGE_BYTES} bytes)")
+
+        if not member.bucket.take():
+            self.flood_stats["throttled"] += 1
+            return self._strike(member, "You are sending messages too fast, slow down")
+
+        if is_chat:
+            now = self.clock()
+            if text == member.last_text and now - member.last_text_at < DUPLICATE_WINDOW_SECONDS:
+                self.flood_stats["duplicates"] += 1
+                return self._strike(member, "Duplicate message dropped")
+
+            bucket = self.room_buckets.get(member.room)
+            if bucket is None:
+                bucket = self.room_buckets[member.room] = TokenBucket(ROOM_RATE_PER_SECOND, ROOM_RATE_BURST, self.clock)
+            if not bucket.take():
+                self.flood_stats["room_throttled"] += 1
+                # เตือนไม่เกินหนึ่งครั้งต่อช่วง ไม่อย่างนั้นทุกข้อความที่ถูกทิ้งได้คำตอบกลับ (ขาออกเพิ่มเป็นเท่าตัว)
+                # Warn at most once per window, or every dropped line would get a reply (doubling outbound traffic)
+                if now - member.busy_notified_at >= ROOM_BUSY_NOTICE_SECONDS:
+                    member.busy_notified_at = now
+                    self.send_personal(
+                        member.websocket, "System: Room is busy, message dropped",
+                        event=("rate_limited", {"reason": "room"}),
+                    )
+                return FLOOD_DROP
+            member.last_text, member.last_text_at = text, now
+
+        member.strikes = 0
+        return FLOOD_OK
+
+    def _strike(self, member: Member, reason: str) -> str:
+        """
+        นับความผิดของสมาชิก เตือนครั้งแรก และตัดสินว่าจะตัดการเชื่อมต่อหรือไม่
+        Count a member's violation, warn on the first one, and decide whether to disconnect
+        """
+        member.strikes += 1
+        member.violations += 1
+        if FLOOD_DISCONNECT_AFTER > 0 and member.strikes >= FLOOD_DISCONNECT_AFTER:
+            self.flood_stats["disconnected"] += 1
+            print(f"Disconnecting {member.username} in {member.room} for flooding")
+            return FLOOD_DISCONNECT
+        if member.strikes == 1:
+            self.send_personal(member.websocket, f"System: {reason}", event=("rate_limited", {"reason": reason}))
+        return FLOOD_DROP
+
+    def top_offenders(self, limit: int = 10) -> list[dict]:
+        """
+        สมาชิกที่เชื่อมต่ออยู่ซึ่งโดนจำกัดอัตรามากที่สุด
+        Connected members that were throttled the most
+        """
+        offenders = sorted(
+            (member for member in self.members.values() if member.violations),
+            key=lambda member: member.violations,
+            reverse=True,
+        )
+        return [
+            {"username": member.username, "room": member.room, "violations": member.violations}
+            for member in offenders[:limit]
+        ]
+
+
+    # --------------------------------------------------------------------------
+    # 4.9 METRICS (ค่าที่อ่านตอน scrape)
+    # --------------------------------------------------------------------------
+
+    def outbound_depth(self) -> int:
+        """จำนวน frame ที่ค้างในคิวขาออกทั้งหมด / Frames waiting in every outbound queue"""
+        return sum(len(member.writer.queue) for member in self.members.values())
+
+    def collect_metrics(self) -> list[tuple[str, str, str, list[tuple[dict, float]]]]:
+        """
+        อ่านค่าจากสถานะปัจจุบันสำหรับ /metrics (ไม่มีต้นทุนบน hot path)
+        Read values from the current state for /metrics (no hot-path cost)
+        
+        Returns:
+            list ของ (ชื่อ, ชนิด, คำอธิบาย, [(labels, ค่า)])
+        """
+        rooms_by_transport: Counter[str] = Counter()
+        users_by_transport: Counter[str] = Counter()
+        for room, info in self.available_rooms.items():
+            transport = info.get("transport_type") or "special"
+            rooms_by_transport[transport] += 1
+            users_by_transport[transport] += len(self.room_members.get(room, ()))
+
+        nearest = self.scheduler.upcoming(1)
+        overdue = max(0.0, -nearest[0]["in_seconds"]) if nearest else 0.0
+        stats = self.broadcast_stats
+        return [
+            ("drivechat_connections", "gauge", "Open WebSocket connections on this worker",
+             [({}, len(self.members))]),
+            ("drivechat_rooms", "gauge", "Rooms by transport type",
+             [({"transport_type": name}, count) for name, count in sorted(rooms_by_transport.items())]),
+            ("drivechat_room_users", "gauge", "Connected users by room transport type",
+             [({"transport_type": name}, count) for name, count in sorted(users_by_transport.items())]),
+            ("drivechat_broadcasts_total", "counter", "Broadcasts fanned out",
+             [({}, stats["broadcasts"])]),
+            ("drivechat_batched_messages_total", "counter", "Messages delivered through a room batch",
+             [({}, stats["batched"])]),
+            ("drivechat_send_failures_total", "counter", "Connections dropped after a failed or stuck send",
+             [({}, stats["failures"])]),
+            ("drivechat_outbound_queued_frames", "gauge", "Frames waiting in outbound queues",
+             [({}, self.outbound_depth())]),
+            ("drivechat_outbound_dropped_frames", "gauge", "Frames dropped by overflow policy (open connections)",
+             [({}, sum(member.writer.dropped for member in self.members.values()))]),
+            ("drivechat_scheduled_deadlines", "gauge", "Room warnings/transitions waiting in the scheduler",
+             [({}, len(self.scheduler.entries))]),
+            ("drivechat_scheduler_overdue_seconds", "gauge", "How late the earliest due deadline is",
+             [({}, overdue)]),
+            ("drivechat_flood_events_total", "counter", "Incoming messages rejected by flood protection",
+             [({"kind": kind}, count) for kind, count in self.flood_stats.items()]),
+            ("drivechat_match_queue_depth", "gauge", "Passengers waiting for a room",
+             [({"transport_type": name}, len(queue)) for name, queue in sorted(self.match_queues.items())]),
+            ("drivechat_match_reserved_seats", "gauge", "Seats held for assigned passengers who have not connected",
+             [({}, len(self.assignments))]),
+            ("drivechat_room_shards", "gauge", "Open shards per special room",
+             [({"room": name}, len(shards)) for name, shards in sorted(self.shards.items())]),
+            ("drivechat_detached_sessions", "gauge", "Dropped users still holding their seat within the grace period",
+             [({}, len(self.detached))]),
+        ]
+
+
+    # --------------------------------------------------------------------------
+    # 4.10 SNAPSHOT & RESTORE (restart โดยไม่ทำให้ทุกห้องหาย)
+    # --------------------------------------------------------------------------
+
+    def snapshot(self) -> dict:
+        """
+        เก็บสถานะห้อง, deadline ที่เหลือ, สมาชิก (รวมห้องเดิม) และประวัติแชท
+        Capture rooms, remaining deadlines, members (with original rooms) and chat history
+        
+        Returns:
+            dict ที่ encode_snapshot แปลงเป็นไฟล์ได้
+        """
+        rooms = {}
+        for room, info in self.available_rooms.items():
+            if info.get("is_special"):
+                continue
+            rooms[room] = {
+                "capacity": info["capacity"],
+                "transport_type": info.get("transport_type"),
+                "transition_in": self.get_time_remaining(room),
+            }
+
+        history = {
+            room: [[frame.text, frame.event, frame.seq, frame.ts] for frame in room_history.recent()]
+            for room, room_history in self.history.items()
+        }
+        return {
+            "saved_at": time.time(),
+            "rooms": rooms,
+            "members": [
+                [member.username, logical_room(member.room), member.original_room, member.role]
+                for member in self.members.values()
+            ] + [
+                [session.username, logical_room(session.room), session.original_room, session.role]
+                for session in self.detached.values()
+            ],
+            "seq": self.room_seq,
+            "history": history,
+        }
+
+    def restore(self, state: dict, downtime: float = 0.0) -> tuple[int, int]:
+        """
+        โหลดสถานะจาก snapshot: สร้างห้องคืนพร้อมเวลาที่เหลือ (หักเวลาที่ server ปิดไป)
+        และจองที่นั่งให้สมาชิกเดิมกลับมาต่อภายใน RESUME_WINDOW_SECONDS
+        Restore a snapshot: recreate rooms with their remaining time (minus the
+        downtime) and hold seats for previous members to resume within
+        RESUME_WINDOW_SECONDS
+        
+        Returns:
+            tuple: (จำนวนห้อง, จำนวนสมาชิกที่รอกลับมา)
+        """
+        for room, info in state.get("rooms", {}).items():
+            if room in self.available_rooms:
+                continue
+            self.available_rooms[room] = {
+                "capacity": info["capacity"],
+                "is_special": False,
+                "transport_type": info.get("transport_type"),
+            }
+            self.room_members.setdefault(room, {})
+            if info.get("transition_in") is not None:
+                self.schedule_room_transition(room, max(1.0, info["transition_in"] - downtime))
+
+        for room, seq in state.get("seq", {}).items():
+            if room in self.available_rooms:
+                self.room_seq[room] = seq
+        for room, frames in state.get("history", {}).items():
+            if room not in self.available_rooms:
+                continue
+            room_history = self.history[room] = RoomHistory()
+            for text, event, seq, ts in frames:
+                frame = OutboundFrame(text, FRAME_CHAT, tuple(event) if event else None)
+                frame.room, frame.seq, frame.ts = room, seq, ts
+                room_history.append(frame)
+
+        # ห้องพิเศษไม่จองที่นั่ง (shard ถูกเลือกใหม่ตอนกลับมา)
+        # Special rooms hold no seat (a shard is picked again on reconnect)
+        waiting = 0
+        for username, room, original_room, role in state.get("members", []):
+            if room not in self.available_rooms:
+                continue
+            held = not self.available_rooms[room].get("is_special")
+            self.resumes.setdefault(username, []).append(
+                {"room": room, "original_room": original_room, "role": role, "held": held}
+            )
+            if held:
+                self.reserved[room] += 1
+            waiting += 1
+
+        for room in self.available_rooms:
+            self._refresh_room_index(room)
+        if waiting:
+            asyncio.get_running_loop().call_later(RESUME_WINDOW_SECONDS, self._expire_resumes)
+        return len(state.get("rooms", {})), waiting
+
+    def claim_resume(self, room: str, username: str) -> Optional[dict]:
+        """
+        หาที่นั่งที่จองไว้ให้ผู้ใช้ที่กลับมาต่อ (ตรงกับห้องปัจจุบันหรือห้องเดิมก่อนถูกย้าย)
+        Find the seat held for a reconnecting user (matching their current room or the
+        room they were moved from)
+        
+        Returns:
+            dict (room, original_room, role) หรือ None ถ้าไม่ได้อยู่ใน snapshot
+        """
+        records = self.resumes.get(username)
+        if not records:
+            return None
+        for index, record in enumerate(records):
+            if room in (record["room"], record["original_room"]):
+                records.pop(index)
+                if not records:
+                    del self.resumes[username]
+                if record["held"]:
+                    self._release_seat(record["room"])
+                return record
+        return None
+
+    def _release_seat(self, room: str):
+        """ปล่อยที่นั่งที่จองไว้หนึ่งที่ / Release one held seat"""
+        self.reserved[room] -= 1
+        if self.reserved[room] <= 0:
+            del self.reserved[room]
+        self._refresh_room_index(room)
+
+    def _expire_resumes(self):
+        """
+        ปล่อยที่นั่งของผู้ใช้ที่ไม่กลับมาภายในเวลา และลบห้องที่ว่าง
+        Release the seats of users who did not come back in time and drop empty rooms
+        """
+        rooms = [record["room"] for records in self.resumes.values() for record in records if record["held"]]
+        self.resumes.clear()
+        for room in rooms:
+            self._release_seat(room)
+        for room in set(rooms):
+            self._delete_room_if_empty(room)
+
+    def prepare_shutdown(self):
+        """
+        เริ่มปิด server: หยุดรับผู้ใช้ใหม่และเก็บ snapshot ก่อนที่ socket จะถูกปิด
+        Begin shutting down: stop new joins and take the snapshot before sockets are closed
+        """
+        if self.shutting_down:
+            return
+        self.draining = True
+        self.shutting_down = True
+        self.shutdown_snapshot = self.snapshot()
+
+    # --------------------------------------------------------------------------
+    # 4.11 MATCHMAKING QUEUE (คิวรอห้องของผู้โดยสาร)
+    # --------------------------------------------------------------------------
+
+    def enqueue_passenger(self, username: str, transport_type: str) -> MatchTicket:
+        """
+        ใส่ผู้โดยสารเข้าคิวรอห้อง แล้วจับคู่ทันทีถ้ามีห้องว่างอยู่แล้ว
+        Queue a passenger for a room, matching immediately if one is already open
+        
+        ถ้าผู้ใช้ชื่อนี้รอ transport_type เดียวกันอยู่แล้วจะได้ตั๋วเดิมกลับไป
+        A user already waiting for the same transport_type gets their existing ticket back
+        
+        Raises:
+            HTTPException 503: ถ้าคิวของ transport_type นี้เต็ม
+        """
+        queue = self.match_queues.get(transport_type, ())
+        for ticket in queue:
+            if ticket.username == username:
+                ticket.seen = self.clock()
+                return ticket
+        if len(queue) >= MATCH_QUEUE_MAX:
+            raise HTTPException(status_code=503, detail="Queue is full", headers={"Retry-After": "10"})
 
-        # เคลียร์ห้องปัจจุบัน
-        # Clear current room
-        self.active_connections[room] = []
-        self.active_users[room] = []
+        ticket = MatchTicket(username, transport_type, self.clock())
+        ticket.handle = asyncio.get_running_loop().call_later(
+            MATCH_MAX_WAIT_SECONDS, self._finish_ticket, ticket, TICKET_EXPIRED
+        )
+        self.tickets[ticket.id] = ticket
+        self.match_queues.setdefault(transport_type, deque()).append(ticket)
+        self._match(transport_type)
+        return ticket
 
-        # ย้ายผู้ใช้แต่ละคนไป ped_pong
-        # Move each user to ped_pong
-        for websocket, username in users_to_move:
-            try:
-                # แจ้งผู้ใช้ว่ากำลังย้าย
-                # Notify user about moving
-                await websocket.send_text(f"System: Moving all users to ped pong...")
-                await asyncio.sleep(0.1)  # รอให้ข้อความถูกส่ง
-
-                # สร้าง list ใหม่ถ้า ped_pong ยังไม่มี
-                # Create new list if ped_pong doesn't exist yet
-                if "ped_pong" not in self.active_connections:
-                    self.active_connections["ped_pong"] = []
-                    self.active_users["ped_pong"] = []
-
-                # เพิ่มผู้ใช้เข้า ped_pong
-                # Add user to ped_pong
-                self.active_connections["ped_pong"].append(websocket)
-                self.active_users["ped_pong"].append(username)
-
-                # ส่งคำสั่งให้ client เปลี่ยนห้อง
-                # Send command to client to change room
-                await websocket.send_text("System: ROOM_CHANGE:ped_pong")
-
-                # แจ้งคนใน ped_pong ว่ามีคนเข้ามา
-                # Notify ped_pong that someone joined
-                await self.broadcast("System: " + username + " was moved from " + room, "ped_pong")
-                await self.broadcast_user_list("ped_pong")
+    def cancel_ticket(self, ticket: MatchTicket):
+        """
+        ยกเลิกตั๋ว: ออกจากคิว หรือปล่อยที่นั่งที่จองไว้ถ้าได้ห้องแล้ว
+        Cancel a ticket: leave the queue, or release the held seat if already assigned
+        """
+        self._finish_ticket(ticket, TICKET_CANCELLED)
 
-            except Exception as e:
-                print(f"Error moving user {username}: {e}")
+    def ticket_status(self, ticket: MatchTicket) -> dict:
+        """
+        สถานะของตั๋วสำหรับ /rooms/queue (ลำดับในคิวถ้ายังรอ, ห้องถ้าได้แล้ว)
+        A ticket as returned by /rooms/queue (queue position while waiting, the room once assigned)
+        """
+        now = self.clock()
+        status = {"ticket": ticket.id, "status": ticket.status, "transport_type": ticket.transport_type}
+        if ticket.status == TICKET_WAITING:
+            position = 1
+            for queued in self.match_queues.get(ticket.transport_type, ()):
+                if queued is ticket:
+                    break
+                position += 1
+            status["position"] = position
+            status["expires_in"] = max(0, int(ticket.deadline - now))
+        elif ticket.status == TICKET_ASSIGNED:
+            status.update(
+                room=ticket.room,
+                capacity=self.get_room_capacity(ticket.room),
+                time_remaining=self.get_time_remaining(ticket.room),
+                expires_in=max(0, int(ticket.deadline - now)),
+            )
+        return status
 
-    async def move_back_to_original_room(self, username: str, websocket: WebSocket):
+    def claim_assignment(self, room: str, username: str) -> bool:
         """
-        ย้ายผู้ใช้กลับไปห้องเดิม (หลังจากอยู่ที่ ped_pong)
-        Move user back to their original room (after being at ped_pong)
-        
-        ผู้ใช้สามารถใช้คำสั่ง /return เพื่อกลับห้องเดิม
-        User can use /return command to go back
+        ใช้ที่นั่งที่จองไว้ให้ผู้โดยสารจากคิวเมื่อ WebSocket ของเขาเข้ามา
+        Use the seat held for a queued passenger when their WebSocket arrives
         
-        Args:
-            username: ชื่อผู้ใช้ที่จะย้าย
-            websocket: WebSocket connection ของผู้ใช้
-            
         Returns:
-            bool: True ถ้าย้ายสำเร็จ, False ถ้าไม่สำเร็จ
+            True ถ้ามีที่นั่งจองไว้ให้ (ปล่อยที่นั่งแล้ว ให้ connect ใช้แทน)
         """
-        # ตรวจสอบว่ามีห้องเดิมบันทึกไว้หรือไม่
-        # Check if original room is recorded
-        if username not in self.original_rooms:
-            return False
-
-        original_room = self.original_rooms[username]
-        current_room = None
-
-        # หาห้องปัจจุบันของผู้ใช้
-        # Find user's current room
-        for room, connections in self.active_connections.items():
-            if websocket in connections:
-                current_room = room
-                break
-
-        # ไม่ย้ายถ้าอยู่ห้องเดิมแล้ว
-        # Don't move if already in original room
-        if not current_room or current_room == original_room:
+        ticket = self.assignments.get((room, username))
+        if ticket is None:
             return False
+        self._finish_ticket(ticket, TICKET_JOINED)
+        return True
 
-        # ดำเนินการย้ายกลับห้องเดิม
-        # Execute move back to original room
-        try:
-            # ลบจากห้องปัจจุบัน
-            # Remove from current room
-            if current_room in self.active_connections:
-                self.active_connections[current_room].remove(websocket)
-                self.active_users[current_room].remove(username)
+    def _match_soon(self, transport_type: str):
+        """
+        รวมการจับคู่ไว้ทำครั้งเดียวใน loop รอบถัดไป (ที่นั่งว่างหลายที่ในรอบเดียว = batch เดียว)
+        Coalesce matching into one pass on the next loop iteration (seats freed together = one batch)
+        """
+        self.match_pending.add(transport_type)
+        if self.match_handle is None:
+            self.match_handle = asyncio.get_running_loop().call_soon(self._run_matches)
 
-            # เพิ่มเข้าห้องเดิม
-            # Add to original room
-            if original_room not in self.active_connections:
-                self.active_connections[original_room] = []
-                self.active_users[original_room] = []
+    def _run_matches(self):
+        """จับคู่ทุก transport_type ที่รออยู่ / Match every pending transport_type"""
+        self.match_handle = None
+        pending, self.match_pending = self.match_pending, set()
+        for transport_type in pending:
+            self._match(transport_type)
 
-            self.active_connections[original_room].append(websocket)
-            self.active_users[original_room].append(username)
+    def _match(self, transport_type: str):
+        """
+        จ่ายห้องให้ผู้โดยสารตามลำดับคิว (FIFO)
+        Assign rooms to queued passengers in FIFO order
+        
+        ห้องที่เหลือเวลามากที่สุด (ห้องใหม่) ถูกเติมก่อน ทีละ batch เท่าที่นั่งว่าง
+        (directory มีเฉพาะห้องที่ยังรับคนใหม่ ดู is_boarding)
+        Rooms with the most time left (new rooms) are filled first, one batch per
+        room sized to its free seats (the directory only holds rooms still boarding,
+        see is_boarding)
+        """
+        queue = self.match_queues.get(transport_type)
+        if not queue or self.draining:
+            return
 
-            # อัพเดท client
-            # Update client
-            await websocket.send_text(f"System: Moving back to {original_room}...")
-            await websocket.send_text(f"System: ROOM_CHANGE:{original_room}")
+        # เช็ค is_boarding ซ้ำเผื่อ deadline เตือนผ่านไปแล้วแต่ scheduler ยังไม่ได้ทำงาน
+        # is_boarding again in case the warning deadline passed before the scheduler ran
+        open_rooms = sorted(
+            (room for room in self.directory.rooms_for(transport_type) if self.is_boarding(room)),
+            key=self.get_time_remaining, reverse=True,
+        )
 
-            # แจ้งห้องเดิมว่ากลับมาแล้ว
-            # Notify original room about return
-            await self.broadcast(f"System: {username} has returned to the room", original_room)
-            await self.broadcast_user_list(original_room)
+        now = self.clock()
+        for room in open_rooms:
+            if not queue:
+                break
+            batch = []
+            free = self.get_room_capacity(room) - self.get_room_count(room)
+            while queue and len(batch) < free:
+                ticket = queue.popleft()
+                if now - ticket.seen > MATCH_ABANDON_SECONDS:
+                    self._finish_ticket(ticket, TICKET_ABANDONED)
+                else:
+                    batch.append(ticket)
+            for ticket in batch:
+                self._assign(ticket, room, now)
 
-            # ลบ tracking
-            # Clean up tracking
-            del self.original_rooms[username]
+        if not queue:
+            self.match_queues.pop(transport_type, None)
 
-            return True
-        except Exception as e:
-            print(f"Error moving user back: {e}")
-            return False
+    def _assign(self, ticket: MatchTicket, room: str, now: float):
+        """
+        จองที่นั่งในห้องให้ตั๋ว (ตั๋วออกจากคิวแล้ว) และปลุก long poll ที่รออยู่
+        Hold a seat in the room for a ticket (already out of the queue) and wake its long poll
+        """
+        ticket.handle.cancel()
+        ticket.status = TICKET_ASSIGNED
+        ticket.room = room
+        ticket.deadline = now + MATCH_RESERVATION_SECONDS
+        ticket.handle = asyncio.get_running_loop().call_later(
+            MATCH_RESERVATION_SECONDS, self._finish_ticket, ticket, TICKET_EXPIRED
+        )
+        self.assignments[(room, ticket.username)] = ticket
+        self.reserved[room] += 1
+        self._refresh_room_index(room)
+        self.metrics.inc("drivechat_match_tickets_total", label=("result", TICKET_ASSIGNED))
+        self.metrics.observe("drivechat_match_wait_seconds", now - ticket.created)
+        ticket.ready.set()
 
-    async def start_room_transition_timer(self, room: str):
+    def _finish_ticket(self, ticket: MatchTicket, status: str):
         """
-        เริ่ม timer สำหรับย้ายผู้ใช้ไป ped_pong หลังจาก 3 นาที
-        Start timer to move users to ped_pong after 3 minutes
-        
-        ห้องปกติจะมีเวลา 3 นาที หลังจากนั้นทุกคนจะถูกย้ายไป ped_pong
-        Normal rooms have 3 minutes, after which everyone moves to ped_pong
-        
-        Args:
-            room: ชื่อห้องที่จะตั้ง timer
+        ปิดตั๋ว: ออกจากคิว หรือปล่อยที่นั่งที่จองไว้ (ถ้ายังไม่เชื่อมต่อ ห้องว่างจะถูกลบ)
+        Close a ticket: drop it from the queue, or release its held seat (if the
+        passenger never connected, a now-empty room is deleted)
         """
-        # ไม่ตั้ง timer สำหรับห้องพิเศษ
-        # Don't set timer for special rooms
-        if room in ["duck_pond", "ped_pong"] or self.available_rooms[room].get("is_special"):
+        if ticket.status not in (TICKET_WAITING, TICKET_ASSIGNED):
             return
+        previous, ticket.status = ticket.status, status
+        ticket.handle.cancel()
+        self.tickets.pop(ticket.id, None)
+        self.metrics.inc("drivechat_match_tickets_total", label=("result", status))
 
-        try:
-            # บันทึกเวลา transition (3 นาทีจากตอนนี้)
-            # Record transition time (3 minutes from now)
-            next_transition = datetime.now() + timedelta(minutes=3)
-            self.available_rooms[room]["next_transition"] = next_transition
-
-            # รอ 2 นาที 40 วินาที แล้วเตือนผู้ใช้
-            # Wait 2m 40s then warn users
-            await asyncio.sleep(160)
-            await self.broadcast(f"System: Room will transition to ped pong in 20 seconds!", room)
-
-            # รอ 20 วินาทีสุดท้าย แล้วย้าย
-            # Wait final 20 seconds then move
-            await asyncio.sleep(20)
-            await self.move_users_to_ped_pong(room)
-
-        except asyncio.CancelledError:
-            print(f"Room transition timer cancelled for {room}")
-        except Exception as e:
-            print(f"Error in transition timer for {room}: {e}")
-            # พยายามย้ายผู้ใช้แม้มี error
-            # Attempt to move users even if there's an error
-            await self.move_users_to_ped_pong(room)
+        if previous == TICKET_WAITING:
+            queue = self.match_queues.get(ticket.transport_type)
+            if queue and ticket in queue:
+                queue.remove(ticket)
+                if not queue:
+                    self.match_queues.pop(ticket.transport_type, None)
+        elif status == TICKET_JOINED:
+            # ที่นั่งส่งต่อให้ connect โดยไม่ refresh ดัชนี จะได้ไม่มีใครแย่งระหว่างรอ accept
+            # The seat passes straight to connect without refreshing the index,
+            # so nobody else is matched into it while the accept is awaited
+            del self.assignments[(ticket.room, ticket.username)]
+            self.reserved[ticket.room] -= 1
+            if self.reserved[ticket.room] <= 0:
+                del self.reserved[ticket.room]
+        else:
+            del self.assignments[(ticket.room, ticket.username)]
+            self._release_seat(ticket.room)
+            self._delete_room_if_empty(ticket.room)
+        ticket.ready.set()
 
     # --------------------------------------------------------------------------
-    # 3.4 ROOM INFORMATION (ข้อมูลห้อง)
+    # 4.12 HEARTBEAT (ตรวจ connection ที่ตายหรือไม่ใช้งาน)
     # --------------------------------------------------------------------------
 
-    def get_time_remaining(self, room: str) -> Optional[int]:
+    def start_heartbeat(self):
+        """เริ่ม task ตรวจ heartbeat (ถ้าเปิด) / Start the heartbeat sweep task (if enabled)"""
+        if HEARTBEAT_INTERVAL_SECONDS > 0 and self.heartbeat_task is None:
+            self.heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    def stop_heartbeat(self):
+        """หยุด task ตรวจ heartbeat / Stop the heartbeat sweep task"""
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+
+    def seen(self, member: Member, is_chat: bool = False):
         """
-        คำนวณเวลาที่เหลือก่อน transition ไป ped_pong
-        Calculate time remaining before transition to ped_pong
+        บันทึกว่าได้รับข้อความจาก client (ทุกข้อความนับเป็นคำตอบของ PING)
+        Record that the client sent something (any message counts as a PING reply)
+        """
+        member.last_seen = self.clock()
+        member.pings = 0
+        if is_chat:
+            member.last_chat = member.last_seen
+
+    async def _heartbeat_loop(self):
+        """วน sweep ทุก HEARTBEAT_INTERVAL_SECONDS / Sweep every HEARTBEAT_INTERVAL_SECONDS"""
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+            try:
+                await self.sweep_connections()
+            except Exception as e:
+                print(f"Error in heartbeat sweep: {e}")
+
+    async def sweep_connections(self) -> tuple[int, int]:
+        """
+        ตรวจทุก connection รอบเดียว: ส่ง PING ให้คนที่เงียบ (เฉพาะ client ที่ขอ ?heartbeat=1),
+        ตัดคนที่ไม่ตอบครบ HEARTBEAT_MISSES ครั้ง และคนที่ไม่ได้แชทนานกว่า IDLE_TIMEOUT_SECONDS;
+        ตัดเป็นชุดพร้อมแจ้งแต่ละห้องครั้งเดียว
+        One pass over every connection: PING the silent ones (only clients that opted in
+        with ?heartbeat=1), and reap those that missed HEARTBEAT_MISSES pings or have not
+        chatted for IDLE_TIMEOUT_SECONDS, in one batch with a single notification per room
         
-        Args:
-            room: ชื่อห้อง
-            
         Returns:
-            จำนวนวินาทีที่เหลือ หรือ None ถ้าไม่มี timer
+            tuple: (จำนวนที่ตายแล้ว, จำนวนที่ไม่ใช้งาน)
         """
-        if room not in self.available_rooms or room in ["duck_pond", "ped_pong"]:
-            return None
+        if self.shutting_down:
+            return 0, 0
 
-        next_transition = self.available_rooms[room].get("next_transition")
-        if not next_transition:
-            return None
+        now = self.clock()
+        dead: list[WebSocket] = []
+        idle: list[WebSocket] = []
+        ping: list[Member] = []
+        for websocket, member in self.members.items():
+            if IDLE_TIMEOUT_SECONDS > 0 and now - member.last_chat >= IDLE_TIMEOUT_SECONDS:
+                idle.append(websocket)
+            elif member.heartbeat and now - member.last_seen >= HEARTBEAT_INTERVAL_SECONDS:
+                if member.pings >= HEARTBEAT_MISSES:
+                    dead.append(websocket)
+                else:
+                    ping.append(member)
 
-        remaining = (next_transition - datetime.now()).seconds
-        return max(0, remaining)
+        if ping:
+            frame = OutboundFrame("System: PING", FRAME_CONTROL, ("ping", {}))
+            for member in ping:
+                member.writer.enqueue(frame)
+                member.pings += 1
+        if dead:
+            self.metrics.inc("drivechat_reaped_connections_total", len(dead), label=("reason", "dead"))
+            await self._prune_failed(dead, 1001, "Connection timed out")
+        if idle:
+            self.metrics.inc("drivechat_reaped_connections_total", len(idle), label=("reason", "idle"))
+            await self._prune_failed(idle, 1000, "Disconnected for inactivity")
+        return len(dead), len(idle)
 
-    def get_room_count(self, room: str) -> int:
+    # --------------------------------------------------------------------------
+    # 4.13 SPECIAL ROOM SHARDS (แบ่ง duck_pond/ped_pong เป็นหลาย shard ตามจำนวนคน)
+    # --------------------------------------------------------------------------
+
+    def resolve_room(self, room: str) -> str:
         """
-        นับจำนวนผู้ใช้ในห้อง
-        Count users in a room
-        
-        Args:
-            room: ชื่อห้อง
-            
-        Returns:
-            จำนวนผู้ใช้ในห้อง
+        แปลงชื่อห้องที่ client ขอเป็นห้องจริง: ห้องพิเศษได้ shard ที่พอดีที่สุด ห้องอื่นคงเดิม
+        Map the room a client asked for to a real room: a special room resolves to
+        its best-fitting shard, anything else is unchanged
         """
-        return len(self.active_users.get(room, []))
+        room = logical_room(room)
+        if room not in self.shards:
+            return room
+        plan = self._allocate_seats(room, 1)
+        return plan[0][0] if plan else room
 
-    def get_room_capacity(self, room: str) -> int:
+    def _allocate_seats(self, logical: str, count: int) -> list[tuple[str, int]]:
         """
-        ดึงความจุสูงสุดของห้อง
-        Get room maximum capacity
+        แบ่งผู้ใช้ count คนลง shard ของห้องพิเศษ
+        Split count users across a special room's shards
+        
+        ทั้งกลุ่มลง shard ที่ที่ว่างพอดีที่สุดถ้ามี ไม่อย่างนั้นเปิด shard ใหม่ (ไม่เกิน MAX_SHARDS)
+        แล้วค่อยเติม shard ที่ว่างมากที่สุด เพื่อให้คนที่มาด้วยกันอยู่ด้วยกันมากที่สุด
+        The whole group goes to the tightest shard that fits it; failing that, new
+        shards open (up to MAX_SHARDS) and then the emptiest shards are topped up,
+        so people who arrive together stay together as far as possible
         
-        Args:
-            room: ชื่อห้อง
-            
         Returns:
-            จำนวนผู้ใช้สูงสุดที่ห้องรองรับได้
+            list ของ (shard, จำนวนที่นั่ง) รวมกันอาจน้อยกว่า count ถ้าที่นั่งไม่พอ
         """
-        return self.available_rooms.get(room, {}).get("capacity", 0)
+        shards = self.shards[logical]
+        capacity = self.get_room_capacity(logical)
+        free = {shard: capacity - self.get_room_count(shard) for shard in shards}
+        plan: list[tuple[str, int]] = []
+        while count > 0:
+            fits = [shard for shard in shards if free[shard] >= count]
+            if fits:
+                shard = min(fits, key=lambda name: free[name])
+            elif len(shards) < MAX_SHARDS:
+                shard = self._open_shard(logical)
+                free[shard] = capacity
+            else:
+                shard = max(shards, key=lambda name: free[name])
+                if free[shard] <= 0:
+                    break
+            seats = min(count, free[shard])
+            plan.append((shard, seats))
+            free[shard] -= seats
+            count -= seats
+        return plan
 
-    def get_random_active_room(self, transport_type: str, user_type: str) -> dict:
+    def _open_shard(self, logical: str) -> str:
         """
-        สุ่มหาห้องที่ว่างสำหรับผู้โดยสาร
-        Find a random available room for passengers
+        เปิด shard ใหม่ของห้องพิเศษ (ใช้เลขที่ว่างน้อยที่สุด)
+        Open a new shard of a special room (taking the lowest free number)
+        """
+        shards = self.shards[logical]
+        number = 2
+        while f"{logical}{SHARD_SEPARATOR}{number}" in shards:
+            number += 1
+        shard = f"{logical}{SHARD_SEPARATOR}{number}"
+        shards.append(shard)
+        self.available_rooms[shard] = dict(self.available_rooms[logical], shard_of=logical)
+        self.room_members[shard] = {}
+        self._refresh_room_index(shard)
+        return shard
+
+    def _merge_soon(self, logical: str):
+        """
+        รวมการรวม shard ไว้ทำครั้งเดียวใน loop รอบถัดไป
+        Coalesce shard merging into one pass on the next loop iteration
+        """
+        self.merge_pending.add(logical)
+        if self.merge_handle is None:
+            self.merge_handle = asyncio.get_running_loop().call_soon(self._run_merges)
+
+    def _run_merges(self):
+        """รวม shard ของทุกห้องพิเศษที่รออยู่ / Merge the shards of every pending special room"""
+        self.merge_handle = None
+        pending, self.merge_pending = self.merge_pending, set()
+        if self.shutting_down:
+            return
+        for logical in pending:
+            spawn_tracked(self.tasks, self.merge_shards(logical))
+
+    async def merge_shards(self, logical: str) -> int:
+        """
+        รวม shard ที่คนน้อยเข้าด้วยกันเมื่อรวมแล้วไม่เกิน SHARD_MERGE_FILL ของความจุ และลบ shard ที่ว่าง
+        Merge sparse shards together when the result stays under SHARD_MERGE_FILL of
+        capacity, and drop empty shards
         
-        ฟังก์ชันนี้ใช้สำหรับ "Join Random Room" 
-        เฉพาะ passenger เท่านั้นที่ใช้ได้
+        shard ที่มีสมาชิกจาก worker อื่นหรือมีคนกำลังเข้า จะไม่ถูกย้ายออก; ห้องเดิมที่บันทึกไว้
+        (original_room) ติดตัวสมาชิกไป จึงใช้ /return ได้เหมือนเดิม
+        Shards with members on other workers or a connect in progress are left alone;
+        the recorded original_room travels with each member, so /return keeps working
         
-        Args:
-            transport_type: ประเภทยานพาหนะที่ต้องการ
-            user_type: ประเภทผู้ใช้ (passenger/driver)
-            
         Returns:
-            dict ข้อมูลห้องที่เลือก หรือ None ถ้าไม่มีห้องว่าง
+            จำนวนผู้ใช้ที่ถูกย้าย
         """
-        # เฉพาะ passenger เท่านั้นที่ใช้ random join ได้
-        # Only passengers can use random join
-        if user_type != "passenger":
-            return None
+        shards = self.shards.get(logical)
+        if not shards:
+            return 0
+        capacity = self.get_room_capacity(logical)
+        limit = int(capacity * SHARD_MERGE_FILL)
+        moved_total = 0
+        while True:
+            movable = [
+                shard for shard in shards[1:]
+                if not self.remote_counts[shard] and not self.reserved[shard]
+            ]
+            for shard in movable:
+                if not self.room_members.get(shard):
+                    self._delete_room_if_empty(shard)
+            movable = [shard for shard in movable if shard in shards]
+            if not movable:
+                break
 
-        available_rooms = []
-        for room_name, room_info in self.available_rooms.items():
-            # ตรวจสอบ transport_type และไม่ใช่ห้องพิเศษ
-            # Check transport_type and not special room
-            if (room_name not in ["duck_pond", "ped_pong"] and 
-                room_info.get("transport_type") == transport_type):
-                current_users = self.get_room_count(room_name)
-                # ตรวจสอบว่ายังมีที่ว่าง
-                # Check if there's still space
-                if current_users < room_info["capacity"]:
-                    available_rooms.append({
-                        "room": room_name,
-                        "capacity": room_info["capacity"],
-                        "current_users": current_users,
-                        "time_remaining": self.get_time_remaining(room_name)
-                    })
-        
-        # สุ่มเลือกห้องจากที่มี
-        # Randomly select from available rooms
-        return random.choice(available_rooms) if available_rooms else None
+            source = min(movable, key=self.get_room_count)
+            size = self.get_room_count(source)
+            targets = [
+                shard for shard in shards
+                if shard != source and self.get_room_count(shard) + size <= limit
+            ]
+            if not targets:
+                break
+            target = max(targets, key=self.get_room_count)
+
+            members = list(self.room_members[source].values())
+            for member in members:
+                self._move_member(member, target)
+                self.replay_history(member, target)
+            usernames = [member.username for member in members]
+            verb = "was" if len(usernames) == 1 else "were"
+            await self.broadcast(
+                f"System: {', '.join(usernames)} {verb} moved in from another {logical} group", target
+            )
+            self.presence_changed(target, joined=usernames)
+            for member in members:
+                if member.presence == PRESENCE_DELTA:
+                    self.send_presence_snapshot(member.websocket)
+            self._delete_room_if_empty(source)
+            self.metrics.inc("drivechat_shard_merges_total")
+            moved_total += len(members)
+        return moved_total
 
     # --------------------------------------------------------------------------
-    # 3.5 BROADCASTING (ส่งข้อความ)
+    # 4.14 SESSION RESUME (ต่อกลับหลัง connection หลุดด้วย resume token)
     # --------------------------------------------------------------------------
 
-    async def broadcast(self, message: str, room: str, exclude: WebSocket = None):
+    def _issue_token(self, member: Member):
         """
-        ส่งข้อความไปยังทุกคนในห้อง
-        Send message to everyone in a room
-        
-        Args:
-            message: ข้อความที่จะส่ง
-            room: ชื่อห้อง
-            exclude: WebSocket ที่ไม่ต้องส่งถึง (optional)
+        ออก resume token ใหม่ให้ connection และส่งให้ client (System: SESSION:<token> หรือ event session)
+        Issue a fresh resume token for a connection and send it to the client
+        (System: SESSION:<token>, or a session event)
         """
-        if room in self.active_connections:
-            for connection in self.active_connections[room]:
-                if connection != exclude:
-                    await connection.send_text(message)
+        if SESSION_GRACE_SECONDS <= 0:
+            return
+        member.token = secrets.token_urlsafe(16)
+        self.tokens[member.token] = member
+        self.send_personal(
+            member.websocket, f"System: SESSION:{member.token}", FRAME_CONTROL,
+            event=("session", {"token": member.token, "grace": SESSION_GRACE_SECONDS}),
+        )
 
-    async def broadcast_user_list(self, room: str):
+    def claim_session(self, token: str, username: str, last_seq: Optional[int] = None) -> Optional[dict]:
         """
-        ส่งรายชื่อผู้ใช้ในห้องไปยังทุกคน
-        Send user list to everyone in the room
-        
-        ข้อความจะแสดง: จำนวนผู้ใช้, รายชื่อ, และเวลาที่เหลือ
-        Message shows: user count, names, and time remaining
+        ใช้ resume token ต่อ session เดิม: จากผู้ใช้ที่หลุดอยู่ในช่วง grace หรือแย่งจาก
+        connection เดิมที่ยังไม่รู้ว่าหลุด (ปิด connection เดิมแบบเงียบๆ)
+        Resume a session by token: either a user within their grace period, or a
+        takeover from an old connection that has not noticed it dropped yet (the old
+        connection is closed quietly)
         
         Args:
-            room: ชื่อห้อง
+            token: resume token จาก SESSION
+            username: ต้องตรงกับเจ้าของ token
+            last_seq: ลำดับข้อความล่าสุดที่ client ได้รับแล้ว (None = ใช้ค่าที่ server ส่งถึงล่าสุด)
+            
+        Returns:
+            dict (room, original_room, role, listed, since) หรือ None ถ้า token ใช้ไม่ได้
+        """
+        session = self.detached.get(token)
+        if session is not None and session.username == username:
+            del self.detached[token]
+            session.handle.cancel()
+            if session.listed:
+                self.detached_rooms[session.room].pop(token, None)
+                if not self.detached_rooms[session.room]:
+                    del self.detached_rooms[session.room]
+                self._release_seat(session.room)
+            self.metrics.inc("drivechat_session_resumes_total", label=("result", "resumed"))
+            since = last_seq if last_seq is not None else session.since
+            return {
+                "room": session.room,
+                "original_room": session.original_room,
+                "role": session.role,
+                "listed": session.listed,
+                "since": since if session.listed else None,
+            }
+
+        member = self.tokens.get(token)
+        if member is not None and member.username == username:
+            writer = member.writer
+            since = last_seq
+            if since is None and writer.sent_room == member.room:
+                since = writer.sent_seq
+            self._remove_member(member.websocket)
+            spawn_tracked(self.tasks, self._close_quietly(member.websocket, 1000, "Resumed on another connection"))
+            self.metrics.inc("drivechat_session_resumes_total", label=("result", "takeover"))
+            return {
+                "room": member.room,
+                "original_room": member.original_room,
+                "role": member.role,
+                "listed": True,
+                "since": since,
+            }
+        return None
+
+    def _detach(self, member: Member):
+        """
+        เก็บ session ของผู้ใช้ที่หลุด: ถือที่นั่งและชื่อในรายชื่อไว้จนกว่าจะต่อกลับหรือหมดเวลา
+        Keep a dropped user's session: hold their seat and their place in the user
+        list until they reconnect or the grace period runs out
+        """
+        writer = member.writer
+        since = writer.sent_seq if writer.sent_room == member.room else None
+        session = DetachedSession(member, since)
+        self.detached[session.token] = session
+        self.detached_rooms.setdefault(session.room, {})[session.token] = session
+        self.reserved[session.room] += 1
+        self._refresh_room_index(session.room)
+        session.handle = asyncio.get_running_loop().call_later(
+            SESSION_GRACE_SECONDS, self._expire_session, session.token
+        )
+
+    def _redirect_detached(self, room: str, target: str):
         """
-        if room in self.active_users:
-            user_list = self.active_users[room]
-            capacity = self.available_rooms[room]["capacity"]
-            time_remaining = self.get_time_remaining(room)
+        ย้ายผู้ใช้ที่หลุดจากห้องไปห้อง target (ปล่อยที่นั่งเดิม, เลือก shard ตอนต่อกลับ)
+        Point a room's detached users at target instead (their seat is released and a
+        shard is picked on reconnect)
+        """
+        for session in self.detached_rooms.pop(room, {}).values():
+            session.listed = False
+            session.original_room, session.room, session.since = room, target, None
+            self._release_seat(room)
 
-            # สร้างข้อความสถานะ
-            # Create status message
-            status_msg = f"Active users ({len(user_list)}/{capacity}): {', '.join(user_list)}"
-            if time_remaining is not None:
-                status_msg += f" | Time remaining: {time_remaining//60}m {time_remaining%60}s"
+    def _expire_session(self, token: str):
+        """หมดช่วง grace: ปล่อยที่นั่งและแจ้งว่าออก / Grace period over: release the seat and announce the leave"""
+        session = self.detached.pop(token, None)
+        if session is None:
+            return
+        self.metrics.inc("drivechat_session_resumes_total", label=("result", "expired"))
+        if not session.listed or self.shutting_down:
+            return
+        self.detached_rooms[session.room].pop(token, None)
+        if not self.detached_rooms[session.room]:
+            del self.detached_rooms[session.room]
+        self._release_seat(session.room)
+        self.broker.members_changed(session.room)
+        spawn_tracked(self.tasks, self._announce_leave(session.room, session.username))
 
-            # ส่งไปยังทุกคน
-            # Send to everyone
-            for connection in self.active_connections[room]:
-                await connection.send_text(status_msg)
+    async def _announce_leave(self, room: str, username: str):
+        """แจ้งห้องว่าผู้ใช้ที่หลุดไม่กลับมา / Tell a room that a dropped user is not coming back"""
+        await self.broadcast(f"System: {username} has left the chat", room)
+        self.presence_changed(room, left=[username])
+        self._delete_room_if_empty(room)
 
 
 # สร้าง instance ของ ConnectionManager
 # Create ConnectionManager instance
-manager = ConnectionManager()
+manager = ConnectionManager(
+    create_broker(BROKER_URL),
+    PrometheusMetrics() if METRICS_ENABLED else NullMetrics(),
+)
+
+def save_snapshot(path: str, state: dict):
+    """
+    เขียน snapshot แบบ atomic (เขียนไฟล์ชั่วคราวแล้ว rename)
+    Write a snapshot atomically (temporary file, then rename)
+    """
+    try:
+        temporary = f"{path}.tmp"
+        with open(temporary, "wb") as snapshot_file:
+            snapshot_file.write(encode_snapshot(state))
+        os.replace(temporary, path)
+        print(f"Saved snapshot: {len(state['rooms'])} rooms, {len(state['members'])} members")
+    except OSError as e:
+        print(f"Error saving snapshot: {e}")
+
+
+def restore_snapshot(path: str):
+    """
+    โหลด snapshot (ถ้ามีและยังไม่เก่าเกิน) แล้วลบไฟล์ทิ้งเพื่อไม่ให้โหลดซ้ำ
+    Restore the snapshot (if present and fresh enough), then delete it so it is not restored twice
+    """
+    try:
+        with open(path, "rb") as snapshot_file:
+            data = snapshot_file.read()
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        print(f"Error reading snapshot: {e}")
+        return
+
+    try:
+        state = decode_snapshot(data)
+    except ValueError as e:
+        print(f"Ignoring snapshot: {e}")
+        return
+    downtime = max(0.0, time.time() - state.get("saved_at", 0))
+    if downtime > SNAPSHOT_MAX_AGE_SECONDS:
+        print(f"Ignoring snapshot: {int(downtime)} seconds old")
+        return
+    rooms, waiting = manager.restore(state, downtime)
+    print(f"Restored snapshot: {rooms} rooms, {waiting} members may resume")
+
+
+# ตัวตรวจ event loop (เริ่มใน lifespan)
+# Event-loop monitor (started in lifespan)
+loop_monitor = LoopMonitor(LOOP_MONITOR_INTERVAL_MS, SLOW_CALLBACK_MS, ConnectionManager, LOOP_MONITOR_DUMP)
+
+# ตัวคัดกรอง connect ใหม่ก่อน accept
+# Admission control for new connects, ahead of accept
+admission = AdmissionController(lambda: loop_monitor.lag, manager.outbound_depth)
+
+# ตัวกรองข้อความแชท (นอก event loop)
+# Chat-line moderation (off the event loop)
+moderator = create_moderator(manager.metrics)
 
 
 # ==============================================================================
-# 4. API ENDPOINTS (จุดเชื่อมต่อ API)
+# 5. API ENDPOINTS (จุดเชื่อมต่อ API)
 # ==============================================================================
 
 @app.post("/rooms")
@@ -580,11 +4551,16 @@ async def create_room(room: RoomCreate):
         dict: สถานะและข้อมูลห้องที่สร้าง
         
     Raises:
-        HTTPException 400: ถ้าห้องมีอยู่แล้ว หรือไม่ใช่คนขับ
+        HTTPException 400: ถ้าห้องมีอยู่แล้ว, ไม่ใช่คนขับ หรือ transport_type ไม่รู้จัก
     """
+    # ระหว่าง drain ไม่รับห้องใหม่
+    # No new rooms while draining
+    if manager.draining:
+        raise HTTPException(status_code=503, detail="Server is restarting", headers={"Retry-After": "5"})
+
     # ตรวจสอบว่าห้องมีอยู่แล้วหรือไม่
     # Check if room already exists
-    if room.room_name in manager.available_rooms:
+    if room.room_name in manager.available_rooms or logical_room(room.room_name) in SPECIAL_ROOMS:
         raise HTTPException(status_code=400, detail="Room already exists")
     
     # ตรวจสอบว่าเป็นคนขับหรือไม่
@@ -592,20 +4568,14 @@ async def create_room(room: RoomCreate):
     if room.creator_type != "driver":
         raise HTTPException(status_code=400, detail="Only drivers can create rooms")
 
-    # สร้างห้องใหม่
-    # Create new room
-    manager.available_rooms[room.room_name] = {
-        "capacity": room.capacity,
-        "next_transition": None,
-        "is_special": False,
-        "transport_type": room.transport_type
-    }
+    # ตรวจสอบประเภทยานพาหนะ (ใช้เป็น label ของ metrics และ key ของคิว)
+    # Check the transport type (it becomes a metrics label and a queue key)
+    if room.transport_type not in TRANSPORT_TYPES:
+        raise HTTPException(status_code=400, detail="Unknown transport_type")
 
-    # เริ่ม transition timer สำหรับห้องใหม่
-    # Start transition timer for new room
-    manager.room_transition_tasks[room.room_name] = asyncio.create_task(
-        manager.start_room_transition_timer(room.room_name)
-    )
+    # สร้างห้องใหม่และเริ่ม transition timer
+    # Create new room and start its transition timer
+    manager.create_room(room.room_name, room.capacity, room.transport_type)
 
     return {
         "status": "success",
@@ -633,6 +4603,125 @@ async def get_random_room(transport_type: str, user_type: str):
     return {"room": None, "message": "No suitable rooms available"}
 
 
+@app.post("/rooms/queue")
+async def join_queue(request: QueueJoin):
+    """
+    เข้าคิวรอห้องแทนการเรียก /rooms/random ซ้ำๆ (เฉพาะผู้โดยสาร)
+    Queue for a room instead of retrying /rooms/random (passengers only)
+    
+    ผู้โดยสารได้ห้องตามลำดับคิว (FIFO) เมื่อคนขับสร้างห้องหรือมีที่นั่งว่าง
+    ที่นั่งถูกจองไว้ MATCH_RESERVATION_SECONDS ให้เชื่อมต่อ /ws/{room}/{username}
+    Passengers are assigned in FIFO order when a driver creates a room or a seat
+    frees up; the seat is held for MATCH_RESERVATION_SECONDS for the
+    /ws/{room}/{username} connection
+    
+    Returns:
+        dict: สถานะตั๋ว (status = waiting หรือ assigned ถ้ามีห้องว่างอยู่แล้ว)
+        
+    Raises:
+        HTTPException 400: ถ้าไม่ใช่ผู้โดยสาร หรือ transport_type ไม่รู้จัก
+        HTTPException 503: ถ้ากำลัง drain หรือคิวเต็ม
+    """
+    if request.user_type != "passenger":
+        raise HTTPException(status_code=400, detail="Only passengers can queue for a room")
+    if request.transport_type not in TRANSPORT_TYPES:
+        raise HTTPException(status_code=400, detail="Unknown transport_type")
+    if manager.draining:
+        raise HTTPException(status_code=503, detail="Server is restarting", headers={"Retry-After": "5"})
+    ticket = manager.enqueue_passenger(request.username, request.transport_type)
+    return manager.ticket_status(ticket)
+
+
+@app.get("/rooms/queue/{ticket_id}")
+async def poll_queue(ticket_id: str, wait: float = 0):
+    """
+    อ่านสถานะตั๋ว (long poll: รอได้ถึง wait วินาที สูงสุด MATCH_POLL_SECONDS จนกว่าจะได้ห้อง)
+    Read a ticket's status (long poll: waits up to wait seconds, at most
+    MATCH_POLL_SECONDS, until it is assigned)
+    
+    ตั๋วที่ไม่ถูก poll นานกว่า MATCH_ABANDON_SECONDS จะถูกตัดออกจากคิว
+    Tickets not polled for MATCH_ABANDON_SECONDS are dropped from the queue
+    
+    Raises:
+        HTTPException 404: ถ้าไม่มีตั๋วนี้ (เชื่อมต่อ, หมดอายุ หรือยกเลิกไปแล้ว)
+    """
+    ticket = manager.tickets.get(ticket_id)
+    if ticket is None:
+        raise HTTPException(status_code=404, detail="Unknown ticket")
+    ticket.seen = manager.clock()
+    if ticket.status == TICKET_WAITING and wait > 0:
+        try:
+            await asyncio.wait_for(ticket.ready.wait(), min(wait, MATCH_POLL_SECONDS))
+        except asyncio.TimeoutError:
+            pass
+        ticket.seen = manager.clock()
+    return manager.ticket_status(ticket)
+
+
+@app.delete("/rooms/queue/{ticket_id}")
+async def leave_queue(ticket_id: str):
+    """
+    ยกเลิกตั๋ว (ออกจากคิว หรือคืนที่นั่งที่จองไว้)
+    Cancel a ticket (leave the queue, or give back the held seat)
+    """
+    ticket = manager.tickets.get(ticket_id)
+    if ticket is None:
+        raise HTTPException(status_code=404, detail="Unknown ticket")
+    manager.cancel_ticket(ticket)
+    return manager.ticket_status(ticket)
+
+
+@app.get("/rooms/stream")
+async def stream_rooms(transport_type: Optional[str] = None):
+    """
+    Server-Sent Events ของห้องว่าง แทนการเรียก /rooms/random ซ้ำๆ
+    Server-Sent Events of open rooms, instead of polling /rooms/random
+    
+    ส่ง "snapshot" (ห้องว่างทั้งหมด) ก่อน แล้วตามด้วย "opened", "seats" และ "closed"
+    ทุก ROOM_STREAM_INTERVAL_MS เมื่อมีการเปลี่ยนแปลง; ถ้าอ่านไม่ทันจะได้ "snapshot" ใหม่
+    Sends a "snapshot" (every open room) first, then "opened", "seats" and "closed"
+    every ROOM_STREAM_INTERVAL_MS when something changed; a listener that falls
+    behind gets a fresh "snapshot"
+    
+    Args:
+        transport_type: กรองเฉพาะประเภทยานพาหนะนี้ (ไม่ระบุ = ทุกประเภท)
+    """
+    feed = manager.room_feed
+    subscriber = feed.subscribe(transport_type, list(manager.available_rooms))
+
+    def event(name: str, data: dict) -> str:
+        return f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    def snapshot() -> str:
+        return event("snapshot", {"transport_type": transport_type, "rooms": feed.snapshot(transport_type)})
+
+    async def events():
+        try:
+            yield snapshot()
+            while True:
+                try:
+                    await asyncio.wait_for(subscriber.ready.wait(), ROOM_STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                subscriber.ready.clear()
+                if subscriber.overflowed:
+                    subscriber.overflowed = False
+                    yield snapshot()
+                    continue
+                chunk = "".join(event(name, data) for name, data in subscriber.pending)
+                subscriber.pending.clear()
+                yield chunk
+        finally:
+            feed.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/rooms/debug")
 async def debug_rooms():
     """
@@ -652,15 +4741,86 @@ async def debug_rooms():
                 "current_users": manager.get_room_count(room_name),
                 "time_remaining": manager.get_time_remaining(room_name),
                 "is_special": room_info.get("is_special", False),
-                "transport_type": room_info.get("transport_type")
+                "transport_type": room_info.get("transport_type"),
+                "history_bytes": manager.history[room_name].size if room_name in manager.history else 0,
             }
             for room_name, room_info in manager.available_rooms.items()
-        }
+        },
+        "upcoming_deadlines": manager.scheduler.upcoming(),
+        "flood": {**manager.flood_stats, "offenders": manager.top_offenders()},
     }
 
 
+@app.get("/metrics")
+async def metrics(request: Request, token: str = ""):
+    """
+    metrics แบบ Prometheus text format (เปิดด้วย METRICS_ENABLED)
+    Metrics in the Prometheus text format (enabled by METRICS_ENABLED)
+    
+    ถ้าตั้ง METRICS_TOKEN ต้องส่ง "Authorization: Bearer <token>" หรือ ?token=<token>
+    If METRICS_TOKEN is set, send "Authorization: Bearer <token>" or ?token=<token>
+    """
+    if not manager.metrics.enabled:
+        raise HTTPException(status_code=404, detail="Not found")
+    if METRICS_TOKEN:
+        check_token(request, token, METRICS_TOKEN)
+
+    return PlainTextResponse(
+        manager.metrics.render(
+            manager.collect_metrics() + loop_monitor.collect_metrics() + admission.collect_metrics()
+            + moderator.collect_metrics()
+        ),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@app.get("/admin/loop")
+async def admin_loop(request: Request, token: str = "", limit: int = 10):
+    """
+    lag ของ event loop และเมธอดที่ทำให้ loop ค้างนานที่สุดล่าสุด
+    Event-loop lag and the recent worst offenders that stalled the loop
+    
+    ต้องส่ง ADMIN_TOKEN (ถ้าไม่ได้ตั้ง เปิดเฉพาะ ENVIRONMENT=development)
+    Requires ADMIN_TOKEN (when unset, only available with ENVIRONMENT=development)
+    """
+    check_admin(request, token)
+    return loop_monitor.report(max(1, min(limit, 100)))
+
+
+@app.post("/admin/drain")
+async def admin_drain(request: Request, token: str = "", enabled: bool = True):
+    """
+    เปิด/ปิด drain mode: ไม่รับผู้ใช้และห้องใหม่ ส่วน connection เดิมใช้งานต่อได้จนจบ
+    Turn drain mode on/off: no new users or rooms, existing connections carry on
+    """
+    check_admin(request, token)
+    manager.draining = enabled
+    return {"draining": manager.draining, "connections": len(manager.members)}
+
+
+def check_admin(request: Request, token: str):
+    """
+    ตรวจสิทธิ์ /admin/*: ADMIN_TOKEN หรือ (ถ้าไม่ได้ตั้ง) ENVIRONMENT=development
+    Authorize /admin/*: ADMIN_TOKEN, or ENVIRONMENT=development when it is unset
+    """
+    if ADMIN_TOKEN:
+        check_token(request, token, ADMIN_TOKEN)
+    elif ENVIRONMENT != "development":
+        raise HTTPException(status_code=404, detail="Not found")
+
+
+def check_token(request: Request, token: str, expected: str):
+    """
+    ตรวจ token จาก "Authorization: Bearer <token>" หรือ ?token=<token>
+    Check the token from "Authorization: Bearer <token>" or ?token=<token>
+    """
+    supplied = request.headers.get("authorization", "").removeprefix("Bearer ").strip() or token
+    if not hmac.compare_digest(supplied, expected):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+
 # ==============================================================================
-# 5. WEBSOCKET HANDLER (ตัวจัดการ WebSocket)
+# 6. WEBSOCKET HANDLER (ตัวจัดการ WebSocket)
 # ==============================================================================
 
 @app.websocket("/ws/{room_id}/{username}")
@@ -680,38 +4840,180 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, username: str):
         room_id: ชื่อห้องที่จะเข้า
         username: ชื่อผู้ใช้
     """
+    # คัดกรองก่อน accept: server เต็ม, loop ช้า, คิวขาออกล้น หรือ connect ถี่เกิน
+    # Screen before accept: server full, loop lagging, outbound queues backed up, or connecting too fast
+    rejection = admission.check(websocket.client.host if websocket.client else "", len(manager.members))
+    if rejection is not None:
+        await deny_websocket(websocket, rejection[1])
+        return
+
     try:
         # เชื่อมต่อเข้าห้อง
         # Connect to room
-        await manager.connect(websocket, room_id, username)
-        
-        # แจ้งทุกคนว่ามีคนเข้ามา
-        # Notify everyone that someone joined
-        await manager.broadcast(f"System: {username} has joined the chat", room_id)
-        await manager.broadcast_user_list(room_id)
+        role = websocket.query_params.get("role", "passenger")
+        presence = PRESENCE_DELTA if websocket.query_params.get("presence") == PRESENCE_DELTA else PRESENCE_FULL
+        protocol, subprotocol = negotiate_protocol(websocket)
+        heartbeat = websocket.query_params.get("heartbeat") == "1"
+        resumable = websocket.query_params.get("session") == "1"
+
+        # ต่อกลับด้วย resume token (หลุดไม่เกิน SESSION_GRACE_SECONDS) หรือผู้ใช้ที่อยู่ใน snapshot
+        # ก่อน restart: กลับเข้าห้องเดิมแบบเงียบ
+        # Reconnects carrying a resume token (dropped within SESSION_GRACE_SECONDS), or users
+        # from the pre-restart snapshot, resume into their room silently
+        token = websocket.query_params.get("resume")
+        last_seq = websocket.query_params.get("last_seq", "")
+        resume = None
+        if token:
+            resume = manager.claim_session(token, username, int(last_seq) if last_seq.isdigit() else None)
+        if resume is None:
+            resume = manager.claim_resume(room_id, username)
+        listed = bool(resume and resume.get("listed"))
+
+        # ผู้โดยสารจากคิวใช้ที่นั่งที่จองไว้ให้ (ได้เข้าแม้กำลัง drain)
+        # Queued passengers take the seat held for them (admitted even while draining)
+        assigned = resume is None and manager.claim_assignment(room_id, username)
+        if manager.draining and resume is None and not assigned:
+            await websocket.accept()
+            await websocket.close(code=1012, reason="Server is restarting")
+            return
+        logical = logical_room(resume["room"]) if resume else room_id
+
+        # ห้องพิเศษ: เลือก shard ที่พอดีที่สุด (client ยังเห็นชื่อห้องพิเศษ)
+        # ยกเว้น session ที่ยังอยู่ในรายชื่อ ซึ่งกลับเข้า shard เดิม
+        # Special rooms: pick the best-fitting shard (the client still sees the special room's
+        # name), except for a session still listed, which returns to its own shard
+        room = resume["room"] if listed else manager.resolve_room(logical)
+        await manager.connect(
+            websocket, room, username, role, presence, protocol, subprotocol,
+            since=resume.get("since") if listed else None, heartbeat=heartbeat,
+            resumable=resumable or bool(token),
+        )
+
+        if resume:
+            manager.members[websocket].original_room = resume["original_room"]
+            if logical != logical_room(room_id):
+                manager.send_personal(
+                    websocket, f"System: ROOM_CHANGE:{logical}", FRAME_CONTROL,
+                    event=("room_change", {"room": logical}),
+                )
+        else:
+            # แจ้งทุกคนว่ามีคนเข้ามา (รายชื่อผู้ใช้ส่งรวมหลัง debounce)
+            # Notify everyone that someone joined (the user list follows after the debounce)
+            await manager.broadcast(f"System: {username} has joined the chat", room)
+
+        # session ที่ยังอยู่ในรายชื่อไม่ทำให้รายชื่อเปลี่ยน: ส่งรายชื่อให้คนที่ต่อกลับคนเดียว
+        # A session that stayed listed changes nobody's list: only the reconnecting user gets it
+        if not listed:
+            manager.presence_changed(room, joined=[username])
+        if presence == PRESENCE_DELTA or listed:
+            manager.send_presence_snapshot(websocket)
         
         # Loop รับข้อความ
         # Message receiving loop
         while True:
-            data = await websocket.receive_text()
+            data = await receive_client_text(websocket, protocol)
+            if data is None:
+                continue
 
             # ตรวจสอบคำสั่ง /return สำหรับกลับห้องเดิม
             # Check for /return command to go back to original room
-            if data.strip().lower() == "/return" and username in manager.original_rooms:
+            member = manager.get_member(websocket)
+            if member is None:
+                # connection ถูกตัดออกจากห้องไปแล้ว (เช่น อ่านช้าจนคิวล้น)
+                # Connection was already pruned (e.g. too slow to read its queue)
+                break
+            command = data.strip().lower()
+            manager.seen(member, command not in ("/who", "/return", "/pong"))
+
+            # จำกัดอัตรา/ขนาด/ข้อความซ้ำ ก่อนทำอะไรต่อ
+            # Rate, size and duplicate checks before anything else
+            verdict = manager.check_incoming(member, data, command not in ("/who", "/return", "/pong"))
+            if verdict == FLOOD_DROP:
+                continue
+            if verdict == FLOOD_DISCONNECT:
+                await manager.disconnect(websocket, room_id)
+                await manager._close_quietly(websocket, 1008)
+                break
+
+            # /pong: คำตอบของ PING จาก heartbeat (บันทึกแล้วใน manager.seen)
+            # /pong: a heartbeat PING reply (already recorded by manager.seen)
+            if command == "/pong":
+                continue
+
+            # /who: ขอรายชื่อผู้ใช้ทั้งหมดของห้อง
+            # /who: ask for the room's complete user list
+            if command == "/who":
+                manager.send_presence_snapshot(websocket)
+                continue
+
+            if command == "/return" and member.original_room:
                 success = await manager.move_back_to_original_room(username, websocket)
                 if success:
                     continue
             
-            # ส่งข้อความไปยังทุกคนในห้อง
-            # Broadcast message to everyone in room
-            await manager.broadcast(f"{username}: {data}", room_id)
+            # กรองคำหยาบนอก event loop (ระหว่างรอ connection อาจถูกตัดไปแล้ว)
+            # Filter profanity off the event loop (the connection may be gone once it returns)
+            if moderator.enabled:
+                data = await moderator.review(data)
+                if manager.get_member(websocket) is None:
+                    break
 
-    except WebSocketDisconnect:
-        # ผู้ใช้ disconnect
-        # User disconnected
-        await manager.disconnect(websocket, room_id)
+            # ส่งข้อความไปยังทุกคนในห้องปัจจุบันของผู้ใช้
+            # Broadcast message to everyone in the user's current room
+            await manager.broadcast(
+                f"{username}: {data}", member.room, record=True, event=("chat", {"u": username, "m": data})
+            )
+
+    except WebSocketDisconnect as e:
+        # uvicorn ปิดทุก WebSocket ด้วย 1012 ก่อนถึง shutdown ของ lifespan: เก็บ snapshot ตั้งแต่ครั้งแรก
+        # ก่อนที่ใครจะถูกลบออก
+        # uvicorn closes every WebSocket with 1012 before the lifespan shutdown runs: take the
+        # snapshot on the first one, before anyone is removed
+        if e.code == 1012:
+            manager.prepare_shutdown()
+        # ผู้ใช้ disconnect: เฉพาะการหลุดกลางคัน (1006) ที่รอ resume; ปิดแท็บ/ออกจากหน้า (1001) หรือ
+        # ปิดแบบปกติ (1000) คือออกจริง
+        # User disconnected: only an abnormal drop (1006) waits for a resume; closing the tab or
+        # navigating away (1001) and a clean close (1000) are real leaves
+        await manager.disconnect(websocket, room_id, grace=e.code == 1006)
     except Exception as e:
         # จัดการ error อื่นๆ
         # Handle other errors
         print(f"Error in websocket connection: {e}")
         await manager.disconnect(websocket, room_id)
+
+
+async def deny_websocket(websocket: WebSocket, retry_after: int):
+    """
+    ปฏิเสธ WebSocket โดยไม่ accept: ตอบ HTTP 503 + Retry-After ถ้า server รองรับ
+    (ASGI extension websocket.http.response) ไม่อย่างนั้น accept แล้วปิดด้วย 1013 (Try Again Later)
+    Refuse a WebSocket without accepting it: an HTTP 503 with Retry-After when the
+    server supports it (the websocket.http.response ASGI extension), otherwise
+    accept and close with 1013 (Try Again Later)
+    """
+    try:
+        if "websocket.http.response" in websocket.scope.get("extensions", {}):
+            await websocket.send_denial_response(
+                PlainTextResponse("Server is busy", status_code=503, headers={"Retry-After": str(retry_after)})
+            )
+        else:
+            await websocket.accept()
+            await websocket.close(code=1013, reason=f"Server is busy, retry in {retry_after}s")
+    except Exception as e:
+        print(f"Error refusing websocket: {e}")
+
+
+# ==============================================================================
+# 7. COMMAND LINE (รันจาก command line)
+# ==============================================================================
+
+if __name__ == "__main__":
+    # รัน broker กลางสำหรับหลาย worker:
+    #   python main.py broker /tmp/drivechat.sock
+    #   BROKER_URL=unix:///tmp/drivechat.sock uvicorn main:app --workers 4
+    # Run the shared broker for multiple workers (see above)
+    if len(sys.argv) == 3 and sys.argv[1] == "broker":
+        asyncio.run(run_broker_server(sys.argv[2]))
+    else:
+        print("usage: python main.py broker <socket-path>")
+        sys.exit(2)
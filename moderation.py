@@ -0,0 +1,312 @@
+"""
+================================================================================
+DriveChat@KMITL - Chat Moderation
+================================================================================
+ตัวกรองคำหยาบของข้อความแชท: automaton แบบ Aho-Corasick (WordMatcher) กับ
+ขั้นตอนตรวจบน thread pool (Moderator) ที่ main.py สร้างผ่าน create_moderator
+Profanity filtering for chat lines: an Aho-Corasick automaton (WordMatcher) and
+the thread-pool review stage (Moderator) that main.py builds in create_moderator
+================================================================================
+"""
+
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from main import NullMetrics
+
+# ข้อความสูงสุดต่อ batch ที่ส่งเข้า pool ครั้งเดียว
+# Most lines handed to the pool in one batch
+MODERATION_BATCH_SIZE = 256
+
+
+# คำตั้งต้นของตัวกรอง: อังกฤษตรงทั้งคำ, ไทยตรงเป็น substring (ภาษาไทยไม่เว้นวรรคระหว่างคำ)
+# จึงเลือกเฉพาะคำที่ไม่เป็นส่วนของคำปกติ (เช่น ไม่ใส่ "หี" ที่อยู่ใน "หีบ" หรือ "สัด" ใน "สัดส่วน")
+# Built-in filter terms: English terms match whole words; Thai terms match as substrings
+# (Thai does not put spaces between words), so only terms that are not part of everyday
+# words are listed (e.g. no "หี", found in "หีบ", and no "สัด", found in "สัดส่วน")
+DEFAULT_MODERATION_WORDS = (
+    "fuck", "fucking", "fucked", "fucker", "motherfucker", "shit", "shitty", "bullshit",
+    "bitch", "bitches", "asshole", "bastard", "cunt", "dick", "dickhead", "wanker", "slut", "whore",
+    "ควย", "เหี้ย", "เย็ด", "สัส", "อีดอก", "ระยำ", "จัญไร", "ส้นตีน", "ชาติหมา", "ไอ้สัตว์", "อีสัตว์",
+    "เงี่ยน", "แตด",
+)
+
+
+def _is_word_char(char: str) -> bool:
+    """ตัวอักษร/ตัวเลขละติน (ใช้ตรวจขอบคำของคำอังกฤษ) / A Latin letter or digit (word edge for English terms)"""
+    return char.isascii() and char.isalnum()
+
+
+class WordMatcher:
+    """
+    automaton แบบ Aho-Corasick ที่ compile จากรายการคำครั้งเดียว แล้วหาทุกคำในข้อความเดียวในรอบเดียว
+    Aho-Corasick automaton compiled once from a word list; finds every term in a
+    message in a single pass, whatever the number of terms
+    
+    ไม่สนตัวพิมพ์เล็ก/ใหญ่; คำที่ขึ้นต้น/ลงท้ายด้วยอักษรละตินต้องตรงขอบคำ
+    ("ass" ไม่ตรงใน "class") ส่วนคำไทยตรงได้ทุกตำแหน่ง
+    Case-insensitive; a term whose edge is a Latin letter must match on a word
+    boundary ("ass" does not match inside "class"), Thai terms match anywhere
+    """
+
+    def __init__(self, words):
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        # ต่อ node: (ความยาวคำ, ต้องมีขอบซ้าย, ต้องมีขอบขวา) ของทุกคำที่จบที่ node นี้
+        # Per node: (length, needs left edge, needs right edge) of every term ending here
+        self.out: list[tuple[tuple[int, bool, bool], ...]] = [()]
+        self.size = 0
+        for word in words:
+            word = word.strip().lower()
+            if word:
+                self._add(word)
+        self._link()
+
+    def _add(self, word: str):
+        """เพิ่มคำลง trie / Add a term to the trie"""
+        node = 0
+        for char in word:
+            child = self.goto[node].get(char)
+            if child is None:
+                child = len(self.goto)
+                self.goto[node][char] = child
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+            node = child
+        self.out[node] += ((len(word), _is_word_char(word[0]), _is_word_char(word[-1])),)
+        self.size += 1
+
+    def _link(self):
+        """สร้าง failure link แบบ BFS / Build the failure links breadth-first"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[child] = target if target != child else 0
+                self.out[child] += self.out[self.fail[child]]
+
+    def find(self, text: str) -> list[tuple[int, int]]:
+        """
+        หาตำแหน่ง (เริ่ม, จบ) ของทุกคำที่พบ
+        Find the (start, end) span of every term in the text
+        """
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            # ตัวอักษรบางตัวยาวขึ้นเมื่อเป็นตัวเล็ก: แปลงทีละตัวเพื่อให้ตำแหน่งตรงกับข้อความเดิม
+            # Some characters grow when lowercased: convert one by one so positions stay aligned
+            lowered = "".join(char if len(char.lower()) != 1 else char.lower() for char in text)
+        goto, fail, out = self.goto, self.fail, self.out
+        spans = []
+        node = 0
+        for index, char in enumerate(lowered):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length, left, right in out[node]:
+                start = index - length + 1
+                if left and start > 0 and _is_word_char(lowered[start - 1]):
+                    continue
+                if right and index + 1 < len(lowered) and _is_word_char(lowered[index + 1]):
+                    continue
+                spans.append((start, index + 1))
+        return spans
+
+    def mask(self, text: str) -> Optional[str]:
+        """
+        แทนทุกคำที่พบด้วย * (ความยาวเท่าเดิม)
+        Replace every term found with * of the same length
+        
+        Returns:
+            ข้อความที่ถูกแทนแล้ว หรือ None ถ้าไม่พบคำใดเลย
+        """
+        spans = self.find(text)
+        if not spans:
+            return None
+        chars = list(text)
+        for start, end in spans:
+            chars[start:end] = "*" * (end - start)
+        return "".join(chars)
+
+
+def load_moderation_words(path: str) -> list[str]:
+    """
+    รายการคำตั้งต้นรวมกับคำจากไฟล์ (หนึ่งคำต่อบรรทัด, # เป็น comment)
+    The built-in terms plus those from a file (one per line, # starts a comment)
+    """
+    words = list(DEFAULT_MODERATION_WORDS)
+    if not path:
+        return words
+    try:
+        with open(path, encoding="utf-8") as handle:
+            for line in handle:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    words.append(line)
+    except OSError as e:
+        print(f"Could not read moderation words from {path}: {e}")
+    return words
+
+
+class NullModerator:
+    """
+    การกรองแบบปิด: ข้อความผ่านไปตามเดิมโดยไม่มี await เพิ่ม (handler เช็ค enabled ก่อน)
+    Moderation turned off: lines go through untouched with no extra await (the handler checks enabled)
+    """
+    enabled = False
+
+    async def review(self, text: str) -> str:
+        """คืนข้อความเดิม / Return the text unchanged"""
+        return text
+
+    def stop(self):
+        """ไม่มีอะไรต้องหยุด / Nothing to stop"""
+
+    def collect_metrics(self) -> list[tuple[str, str, str, list[tuple[dict, float]]]]:
+        return []
+
+
+class Moderator(NullModerator):
+    """
+    ตรวจข้อความแชทด้วย WordMatcher บน thread pool โดย event loop ไม่ต้องรอการสแกน
+    Review chat lines with a WordMatcher on a thread pool, so the event loop never
+    waits on a scan
+    
+    ข้อความที่เข้ามาใน loop รอบเดียวกันถูกรวมเป็น batch เดียว (ส่งเข้า pool ครั้งเดียว)
+    ถ้าข้อความที่รอตรวจเกิน max_pending หรือ pool ใช้ไม่ได้ ข้อความถูกส่งต่อโดยไม่ตรวจ
+    (pass-through) แทนที่จะทำให้แชทช้า; เวลาแต่ละช่วง (รอ thread, สแกน, รวม) อยู่ใน metrics
+    Lines arriving in the same loop iteration form one batch (one pool submission).
+    With more than max_pending lines awaiting review, or a pool that fails, lines
+    pass through unchecked rather than slowing the chat; each stage's time (thread
+    wait, scan, end to end) goes to the metrics
+    """
+    enabled = True
+
+    def __init__(
+        self,
+        matcher: WordMatcher,
+        metrics: "NullMetrics",
+        workers: int = 1,
+        max_pending: int = 500,
+        batch_size: int = MODERATION_BATCH_SIZE,
+    ):
+        self.matcher = matcher
+        self.metrics = metrics
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="moderation")
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.batch: list[tuple[str, asyncio.Future]] = []
+        self.batch_started = 0.0
+        self.handle: Optional[asyncio.Handle] = None
+        # batch ที่อยู่ใน pool ตามลำดับที่ส่ง (คืนผลตามลำดับนี้ แม้มีหลาย worker ข้อความจึงไม่สลับกัน)
+        # Batches in the pool in submission order (verdicts are released in this order,
+        # so lines never overtake each other even with several workers)
+        self.inflight: deque[tuple[list[tuple[str, asyncio.Future]], float, asyncio.Future]] = deque()
+        self.pending = 0
+
+    async def review(self, text: str) -> str:
+        """
+        ส่งข้อความเข้า batch ถัดไปแล้วรอผล
+        Add a line to the next batch and wait for its verdict
+        
+        Returns:
+            ข้อความที่ถูกแทนคำแล้ว (หรือข้อความเดิมถ้าไม่พบคำ / pass-through)
+        """
+        if self.pending >= self.max_pending:
+            self.metrics.inc("drivechat_moderation_messages_total", label=("result", "bypassed"))
+            return text
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.batch:
+            self.batch_started = time.perf_counter()
+        self.batch.append((text, future))
+        self.pending += 1
+        if len(self.batch) >= self.batch_size:
+            self._flush()
+        elif self.handle is None:
+            self.handle = loop.call_soon(self._flush)
+        return await future
+
+    def _flush(self):
+        """ส่ง batch ปัจจุบันเข้า pool / Hand the current batch to the pool"""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        submitted = time.perf_counter()
+        try:
+            scan = asyncio.get_running_loop().run_in_executor(
+                self.pool, self._scan, [text for text, _ in batch], submitted
+            )
+        except RuntimeError as e:
+            print(f"Moderation pool unavailable, passing messages through: {e}")
+            self._finish(batch, self.batch_started, None)
+            return
+        self.inflight.append((batch, self.batch_started, scan))
+        scan.add_done_callback(self._release)
+
+    def _release(self, _done: asyncio.Future):
+        """คืนผลของ batch ที่เสร็จแล้วตามลำดับที่ส่ง / Release finished batches in submission order"""
+        while self.inflight and self.inflight[0][2].done():
+            batch, started, scan = self.inflight.popleft()
+            self._finish(batch, started, scan)
+
+    def _scan(self, texts: list[str], submitted: float) -> tuple[list[Optional[str]], float, float]:
+        """
+        สแกน batch (รันใน thread ของ pool)
+        Scan a batch (runs on a pool thread)
+        
+        Returns:
+            tuple: (ผลของแต่ละข้อความ, เวลารอ thread, เวลาสแกน)
+        """
+        started = time.perf_counter()
+        masked = [self.matcher.mask(text) for text in texts]
+        return masked, started - submitted, time.perf_counter() - started
+
+    def _finish(self, batch: list[tuple[str, asyncio.Future]], started: float, done: Optional[asyncio.Future]):
+        """คืนผลให้ผู้รอแต่ละคน (บน event loop) / Hand each waiter its verdict (on the event loop)"""
+        self.pending -= len(batch)
+        results: list[Optional[str]] = [None] * len(batch)
+        result = "bypassed"
+        if done is not None:
+            try:
+                results, waited, scanned = done.result()
+                self.metrics.observe("drivechat_moderation_queue_seconds", waited)
+                self.metrics.observe("drivechat_moderation_scan_seconds", scanned)
+                self.metrics.observe("drivechat_moderation_seconds", time.perf_counter() - started)
+                result = None
+            except asyncio.CancelledError:
+                # pool ถูกปิดก่อนถึงคิวของ batch นี้ (stop) / The pool shut down before this batch ran (stop)
+                pass
+            except Exception as e:
+                print(f"Moderation failed, passing messages through: {e}")
+        for (text, future), masked in zip(batch, results):
+            if not future.done():
+                future.set_result(masked if masked is not None else text)
+            label = result or ("masked" if masked is not None else "clean")
+            self.metrics.inc("drivechat_moderation_messages_total", label=("result", label))
+
+    def stop(self):
+        """หยุด pool (ข้อความที่ค้างถูกส่งต่อโดยไม่ตรวจ) / Stop the pool (pending lines pass through)"""
+        self._flush()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def collect_metrics(self) -> list[tuple[str, str, str, list[tuple[dict, float]]]]:
+        """ค่าสำหรับ /metrics / Values for /metrics"""
+        return [
+            ("drivechat_moderation_pending", "gauge", "Chat lines waiting for a moderation verdict",
+             [({}, self.pending)]),
+            ("drivechat_moderation_terms", "gauge", "Terms compiled into the moderation matcher",
+             [({}, self.matcher.size)]),
+        ]
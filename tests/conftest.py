@@ -0,0 +1,96 @@
+"""
+ตัวช่วยร่วมของ test: ConnectionManager ตัวจริงบน VirtualClock กับ WebSocket ปลอม (ไม่มี network)
+Shared test helpers: the real ConnectionManager on a VirtualClock with fake WebSockets (no network)
+
+รันด้วย / Run with:
+    python -m pytest -q
+"""
+
+import asyncio
+import os
+import sys
+
+# ส่งรายชื่อผู้ใช้ทันทีและไม่เปิด feature ที่ต้องมี server จริง (ต้องตั้งก่อน import main)
+# Flush user lists immediately and leave server-only features off (set before importing main)
+os.environ.setdefault("PRESENCE_DEBOUNCE_MS", "0")
+os.environ.setdefault("SNAPSHOT_PATH", "")
+os.environ.setdefault("BROKER_URL", "")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pytest  # noqa: E402
+from starlette.websockets import WebSocket  # noqa: E402
+
+import main  # noqa: E402
+
+
+class FakeClient:
+    """
+    WebSocket ของ Starlette ที่ต่อกับ ASGI send ปลอม เก็บทุก frame ที่ server ส่งออก
+    A Starlette WebSocket wired to a fake ASGI send that keeps every frame the server sends
+    """
+
+    def __init__(self, query: str = ""):
+        self.sent: list = []
+        self.closed: list[int] = []
+        # ตั้งด้วย hold(): การส่งค้างจนกว่าจะ release() / Set by hold(): sends stall until release()
+        self.gate: asyncio.Event | None = None
+        # ตั้งเป็น exception เพื่อให้การส่งครั้งถัดไปล้ม / Set to an exception to fail the next send
+        self.error: Exception | None = None
+
+        async def receive():
+            return {"type": "websocket.connect"}
+
+        async def send(message):
+            if self.gate is not None:
+                await self.gate.wait()
+            if self.error is not None:
+                raise self.error
+            if message["type"] == "websocket.send":
+                self.sent.append(message.get("text", message.get("bytes")))
+            elif message["type"] == "websocket.close":
+                self.closed.append(message.get("code", 1000))
+
+        scope = {
+            "type": "websocket", "path": "/ws", "headers": [],
+            "query_string": query.encode(), "client": ("127.0.0.1", 1),
+        }
+        self.websocket = WebSocket(scope, receive, send)
+
+    def hold(self):
+        """ให้การส่งค้าง (เหมือน client ที่อ่านช้า) / Stall sends (like a client that stopped reading)"""
+        self.gate = asyncio.Event()
+
+    def release(self):
+        """ปล่อยการส่งที่ค้าง / Let stalled sends through"""
+        self.gate.set()
+        self.gate = None
+
+    def texts(self) -> list[str]:
+        """frame แบบข้อความ (batch ถูกแยกเป็นบรรทัด) / Text frames (batches split into lines)"""
+        lines = []
+        for frame in self.sent:
+            if isinstance(frame, str):
+                lines.extend(frame.split("\n"))
+        return lines
+
+
+async def settle():
+    """ให้ writer task ส่ง frame ที่ค้างออกไป / Let writer tasks flush queued frames"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def clock():
+    return main.VirtualClock()
+
+
+@pytest.fixture
+def manager(clock):
+    return main.ConnectionManager(clock=clock)
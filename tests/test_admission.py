@@ -0,0 +1,102 @@
+"""การคัดกรอง connect ใหม่ก่อน accept (AdmissionController) / Pre-accept admission control (AdmissionController)"""
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    """ค่าเล็ก ๆ ให้ทดสอบง่าย / Small limits that are easy to hit"""
+    monkeypatch.setattr(main, "MAX_CONNECTIONS", 100)
+    monkeypatch.setattr(main, "SHED_LOOP_LAG_MS", 250)
+    monkeypatch.setattr(main, "SHED_QUEUE_DEPTH", 1000)
+    monkeypatch.setattr(main, "CONNECT_RATE_PER_SECOND", 2)
+    monkeypatch.setattr(main, "CONNECT_RATE_BURST", 3)
+    monkeypatch.setattr(main, "CONNECT_RATE_PER_IP", 0)
+    monkeypatch.setattr(main, "CONNECT_BURST_PER_IP", 2)
+
+
+class Load:
+    """lag และจำนวน frame ค้างที่ปรับได้ / Adjustable lag and queued-frame total"""
+
+    def __init__(self):
+        self.lag = 0.0
+        self.depth = 0
+
+
+def make_admission(clock):
+    load = Load()
+    return main.AdmissionController(lambda: load.lag, lambda: load.depth, clock), load
+
+
+def test_global_bucket_refills_on_the_clock(clock, limits):
+    admission, _ = make_admission(clock)
+    assert [admission.check("10.0.0.1", 0) for _ in range(3)] == [None, None, None]
+    # bucket ว่าง: Retry-After คือเวลาจนได้ token ถัดไป / Bucket empty: Retry-After is the time to the next token
+    assert admission.check("10.0.0.2", 0) == (main.SHED_RATE, 1)
+
+    clock.advance(0.5)
+    assert admission.check("10.0.0.2", 0) is None
+    assert admission.admitted == 4
+    assert admission.rejected == {main.SHED_RATE: 1}
+
+
+def test_per_ip_bucket_limits_one_address(clock, limits, monkeypatch):
+    monkeypatch.setattr(main, "CONNECT_RATE_PER_IP", 0.5)
+    admission, _ = make_admission(clock)
+    assert admission.check("10.0.0.1", 0) is None
+    assert admission.check("10.0.0.1", 0) is None
+    assert admission.check("10.0.0.1", 0) == (main.SHED_IP_RATE, 2)
+    # IP อื่นยังเข้าได้ / Other addresses still get in
+    assert admission.check("10.0.0.2", 0) is None
+
+    clock.advance(2)
+    assert admission.check("10.0.0.1", 0) is None
+
+
+def test_global_refusal_does_not_spend_the_ip_token(clock, limits, monkeypatch):
+    monkeypatch.setattr(main, "CONNECT_RATE_PER_IP", 0.5)
+    monkeypatch.setattr(main, "CONNECT_BURST_PER_IP", 5)
+    admission, _ = make_admission(clock)
+    for ip in ("10.0.0.1", "10.0.0.2", "10.0.0.3"):
+        assert admission.check(ip, 0) is None
+    assert admission.check("10.0.0.4", 0)[0] == main.SHED_RATE
+    assert admission.ip_buckets["10.0.0.4"].tokens == 5
+
+
+def test_capacity_lag_and_queue_depth_shed_without_spending_tokens(clock, limits):
+    admission, load = make_admission(clock)
+    assert admission.check("10.0.0.1", 100) == (main.SHED_CAPACITY, main.SHED_RETRY_AFTER[main.SHED_CAPACITY])
+
+    load.lag = 0.3
+    assert admission.check("10.0.0.1", 0) == (main.SHED_LAG, main.SHED_RETRY_AFTER[main.SHED_LAG])
+    load.lag = 0.0
+
+    load.depth = 1000
+    assert admission.check("10.0.0.1", 0) == (main.SHED_QUEUE, main.SHED_RETRY_AFTER[main.SHED_QUEUE])
+    assert admission.bucket.tokens == 3
+    assert admission.rejected == {main.SHED_CAPACITY: 1, main.SHED_LAG: 1, main.SHED_QUEUE: 1}
+
+
+def test_queue_depth_is_sampled_not_read_every_connect(clock, limits):
+    admission, load = make_admission(clock)
+    load.depth = 1000
+    assert admission.check("10.0.0.1", 0)[0] == main.SHED_QUEUE
+
+    # คิวระบายแล้วแต่ยังอยู่ในช่วงเดิม: ใช้ค่าเก่า / Queue drained inside the same sample window: the old value stands
+    load.depth = 0
+    assert admission.check("10.0.0.1", 0)[0] == main.SHED_QUEUE
+    clock.advance(admission.DEPTH_SAMPLE_SECONDS)
+    assert admission.check("10.0.0.1", 0) is None
+
+
+def test_refilled_ip_buckets_are_pruned(clock, limits, monkeypatch):
+    monkeypatch.setattr(main, "CONNECT_RATE_PER_IP", 1)
+    admission, _ = make_admission(clock)
+    admission.check("10.0.0.1", 0)
+    assert "10.0.0.1" in admission.ip_buckets
+
+    clock.advance(admission.PRUNE_SECONDS)
+    assert admission.check("10.0.0.2", 0) is None
+    assert list(admission.ip_buckets) == ["10.0.0.2"]
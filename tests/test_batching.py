@@ -0,0 +1,77 @@
+"""การรวมข้อความของห้องที่คึกคัก (ROOM_BATCH_WINDOW_MS) / Busy-room batching (ROOM_BATCH_WINDOW_MS)"""
+
+import asyncio
+import json
+
+import pytest
+
+import main
+from tests.conftest import FakeClient, settle
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def window(monkeypatch):
+    monkeypatch.setattr(main, "ROOM_BATCH_WINDOW_MS", 20)
+    return 0.02
+
+
+async def join(manager, name, protocol=main.PROTOCOL_TEXT):
+    client = FakeClient()
+    await manager.connect(client.websocket, "duck_pond", name, protocol=protocol)
+    await settle()
+    client.sent.clear()
+    return client
+
+
+def chats(frame):
+    events = json.loads(frame)
+    return [event["d"]["m"] for event in (events if isinstance(events, list) else [events]) if event["t"] == "chat"]
+
+
+async def test_quiet_room_sends_at_once_and_busy_room_batches(manager, window):
+    alice = await join(manager, "alice", main.PROTOCOL_JSON)
+
+    first = await manager.broadcast("bob: 1", "duck_pond", event=("chat", {"u": "bob", "m": "1"}))
+    assert not first.get("batched")
+    for index in (2, 3):
+        result = await manager.broadcast(f"bob: {index}", "duck_pond", event=("chat", {"u": "bob", "m": str(index)}))
+        assert result["batched"]
+    await settle()
+    assert [chats(frame) for frame in alice.sent] == [["1"]]
+
+    await asyncio.sleep(window * 2)
+    await settle()
+    # ข้อความที่รวมไว้ไปเป็น array frame เดียวตามลำดับ / The batch goes out as one array frame, in order
+    assert [chats(frame) for frame in alice.sent] == [["1"], ["2", "3"]]
+    assert manager.broadcast_stats["batched"] == 2
+
+
+async def test_history_is_recorded_at_flush(manager, window):
+    await join(manager, "alice")
+    await manager.broadcast("bob: 1", "duck_pond", record=True)
+    await manager.broadcast("bob: 2", "duck_pond", record=True)
+    assert [frame.text for frame in manager.history["duck_pond"].recent()] == ["bob: 1"]
+
+    # คนที่เข้ามาระหว่างรอได้ข้อความจาก flush ไม่ใช่จาก replay (ไม่ซ้ำ)
+    # Someone joining inside the window gets the line from the flush, not replay (no duplicate)
+    carol = FakeClient()
+    await manager.connect(carol.websocket, "duck_pond", "carol")
+    await asyncio.sleep(window * 2)
+    await settle()
+    assert carol.texts().count("bob: 2") == 1
+    assert [frame.text for frame in manager.history["duck_pond"].recent()] == ["bob: 1", "bob: 2"]
+
+
+async def test_send_with_exclude_flushes_pending_first(manager, window):
+    alice = await join(manager, "alice")
+    bob = await join(manager, "bob")
+    await manager.broadcast("carol: 1", "duck_pond")
+    await manager.broadcast("carol: 2", "duck_pond")
+    await manager.broadcast("System: alice typed", "duck_pond", exclude=alice.websocket)
+    await settle()
+    assert [line for line in bob.texts() if line.startswith(("carol", "System: alice"))] == [
+        "carol: 1", "carol: 2", "System: alice typed",
+    ]
+    assert manager.batches["duck_pond"].handle is None
@@ -0,0 +1,179 @@
+"""สอง worker ผ่าน broker กลางจริง (Unix socket) / Two workers through the real shared broker (Unix socket)"""
+
+import asyncio
+import json
+
+import pytest
+
+import main
+from tests.conftest import FakeClient, settle
+
+pytestmark = pytest.mark.anyio
+
+
+async def until(condition, timeout: float = 2.0):
+    """รอจนเงื่อนไขเป็นจริง (ข้อความผ่าน socket จริง) / Wait for a condition (messages cross a real socket)"""
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out waiting for the broker"
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+async def workers(tmp_path):
+    path = str(tmp_path / "broker.sock")
+    server = asyncio.create_task(main.run_broker_server(path))
+    await until(lambda: tmp_path.joinpath("broker.sock").exists())
+    managers = []
+    for _ in range(2):
+        manager = main.ConnectionManager(main.UnixSocketBroker(path), clock=main.VirtualClock())
+        await manager.broker.start(manager)
+        managers.append(manager)
+    yield managers
+    for manager in managers:
+        await manager.broker.stop()
+    server.cancel()
+
+
+def chat_seqs(client):
+    """ลำดับ (s) ของข้อความแชทที่ client แบบ JSON ได้รับ / Sequence numbers of chat events a JSON client got"""
+    seqs = {}
+    for frame in client.sent:
+        for event in json.loads(frame) if frame.startswith("[") else [json.loads(frame)]:
+            if event["t"] == "chat":
+                seqs[event["d"]["m"]] = event["s"]
+    return seqs
+
+
+async def test_rooms_members_and_chat_cross_workers(workers):
+    a, b = workers
+    a.create_room("taxi_a", 4, "taxi")
+    await until(lambda: "taxi_a" in b.available_rooms)
+
+    alice = FakeClient()
+    bob = FakeClient()
+    await a.connect(alice.websocket, "taxi_a", "alice", protocol=main.PROTOCOL_JSON)
+    await b.connect(bob.websocket, "taxi_a", "bob", protocol=main.PROTOCOL_JSON)
+    await until(lambda: a.get_room_count("taxi_a") == 2 and b.get_room_count("taxi_a") == 2)
+
+    await a.broadcast("alice: one", "taxi_a", record=True, event=("chat", {"u": "alice", "m": "one"}))
+    await until(lambda: "one" in chat_seqs(bob))
+    await b.broadcast("bob: two", "taxi_a", record=True, event=("chat", {"u": "bob", "m": "two"}))
+    await until(lambda: "two" in chat_seqs(alice))
+    await settle()
+
+    # ทั้งสอง worker ให้เลขเดียวกันกับข้อความเดียวกัน และเลขเพิ่มขึ้นข้าม worker
+    # Both workers number each message the same, and numbers keep rising across workers
+    assert chat_seqs(alice) == chat_seqs(bob)
+    assert chat_seqs(bob)["two"] > chat_seqs(bob)["one"]
+    assert a.room_seq["taxi_a"] == b.room_seq["taxi_a"]
+
+
+async def test_publish_for_unknown_room_creates_no_state(workers):
+    a, b = workers
+    a.create_room("taxi_a", 4, "taxi")
+    await until(lambda: "taxi_a" in b.available_rooms)
+
+    a.broker.publish("nowhere", "ghost", main.FRAME_CHAT, record=True, seq=7)
+    await a.broadcast("marker", "taxi_a")
+    await until(lambda: "taxi_a" in b.room_seq)
+    assert "nowhere" not in b.room_seq
+    assert "nowhere" not in b.history
+
+
+async def test_remote_room_deleted_drops_all_room_state(manager):
+    manager.apply_broker_message({
+        "op": "room", "room": "taxi_a", "worker": "w2",
+        "info": {"capacity": 4, "is_special": False, "transport_type": "taxi", "transition_at": None},
+    })
+    manager.apply_broker_message({"op": "members", "room": "taxi_a", "worker": "w2", "users": ["bob"]})
+    manager.room_buckets["taxi_a"] = main.TokenBucket(1, 1, manager.clock)
+    manager.presence_changed("taxi_a", joined=["bob"])
+
+    manager.apply_broker_message({"op": "members", "room": "taxi_a", "worker": "w2", "users": []})
+    manager.apply_broker_message({"op": "room_deleted", "room": "taxi_a", "worker": "w2"})
+    for state in (
+        manager.available_rooms, manager.presence, manager.batches, manager.room_buckets,
+        manager.remote_members, manager.remote_counts, manager.room_members,
+    ):
+        assert "taxi_a" not in state
+    assert "taxi_a" not in manager.directory.rooms_for("taxi")
+
+
+async def test_lost_broker_connection_forgets_remote_members(workers):
+    a, b = workers
+    a.create_room("taxi_a", 4, "taxi")
+    await until(lambda: "taxi_a" in b.available_rooms)
+    alice = FakeClient()
+    await a.connect(alice.websocket, "taxi_a", "alice")
+    await until(lambda: b.get_room_count("taxi_a") == 1)
+
+    b.broker.writer.close()
+    await until(lambda: b.get_room_count("taxi_a") == 0)
+    assert not b.remote_members and not b.remote_counts
+    # sync หลังต่อใหม่ส่งสมาชิกที่ยังอยู่คืนมา / The sync after reconnecting brings live members back
+    await until(lambda: b.get_room_count("taxi_a") == 1)
+
+
+async def test_sync_replaces_remote_state(tmp_path):
+    # broker ที่ยังไม่ต่อ: จำห้องของตัวเองไว้แต่ไม่ส่งอะไร / A broker not yet connected: remembers its own rooms, sends nothing
+    manager = main.ConnectionManager(main.UnixSocketBroker(str(tmp_path / "none.sock")), clock=main.VirtualClock())
+    info = {"capacity": 4, "is_special": False, "transport_type": "taxi", "transition_at": None}
+    manager.apply_broker_message({"op": "room", "room": "taxi_gone", "worker": "w2", "info": info})
+    manager.apply_broker_message({"op": "members", "room": "taxi_gone", "worker": "w2", "users": ["ghost"]})
+    manager.create_room("taxi_mine", 4, "taxi")
+
+    manager.apply_broker_message({
+        "op": "sync", "rooms": {"taxi_live": info}, "members": {"taxi_live": {"w3": ["carol"]}},
+    })
+    assert "taxi_gone" not in manager.available_rooms
+    assert manager.get_room_count("taxi_gone") == 0
+    assert "taxi_mine" in manager.available_rooms
+    assert manager.room_usernames("taxi_live") == ["carol"]
+
+
+async def test_rooms_of_a_departed_worker_are_deleted(workers):
+    a, b = workers
+    a.create_room("taxi_a", 4, "taxi")
+    await until(lambda: "taxi_a" in b.directory.rooms_for("taxi"))
+
+    await a.broker.stop()
+    await until(lambda: "taxi_a" not in b.available_rooms)
+    assert b.directory.rooms_for("taxi") == []
+
+    # worker ที่ต่อเข้ามาทีหลังไม่ได้ห้องนั้นใน sync / A worker connecting later gets no such room in its sync
+    b.create_room("taxi_b", 4, "taxi")
+    late = main.ConnectionManager(main.UnixSocketBroker(b.broker.path), clock=main.VirtualClock())
+    await late.broker.start(late)
+    await until(lambda: "taxi_b" in late.available_rooms)
+    assert "taxi_a" not in late.available_rooms
+    await late.broker.stop()
+
+
+async def test_broker_skips_lines_that_are_not_objects(workers):
+    a, b = workers
+    a.broker.writer.write(b"[1, 2]\n")
+    a.create_room("taxi_a", 4, "taxi")
+    await until(lambda: "taxi_a" in b.available_rooms)
+
+
+async def test_over_long_line_reconnects_instead_of_killing_the_client(tmp_path):
+    path = str(tmp_path / "fake.sock")
+    connections = []
+
+    async def fake_broker(reader, writer):
+        connections.append(writer)
+        if len(connections) == 1:
+            # บรรทัดยาวเกิน limit ของ reader / A line longer than the reader's limit
+            writer.write(b"x" * (2 ** 24 + 1))
+        else:
+            writer.write(b'{"op":"sync","rooms":{},"members":{}}\n')
+        await writer.drain()
+
+    server = await asyncio.start_unix_server(fake_broker, path)
+    manager = main.ConnectionManager(main.UnixSocketBroker(path), clock=main.VirtualClock())
+    await manager.broker.start(manager)
+    await until(lambda: len(connections) == 2, timeout=5)
+    assert not manager.broker.task.done()
+    await manager.broker.stop()
+    server.close()
@@ -0,0 +1,44 @@
+"""การจำกัดอัตราข้อความขาเข้า / Incoming message rate limits"""
+
+import pytest
+
+import main
+from tests.conftest import FakeClient, settle
+
+pytestmark = pytest.mark.anyio
+
+
+async def join(manager, name):
+    client = FakeClient()
+    await manager.connect(client.websocket, "duck_pond", name)
+    return client, manager.get_member(client.websocket)
+
+
+async def test_duplicate_line_is_dropped(manager):
+    _, member = await join(manager, "alice")
+    assert manager.check_incoming(member, "hi", True) == main.FLOOD_OK
+    assert manager.check_incoming(member, "hi", True) == main.FLOOD_DROP
+
+
+async def test_room_busy_notice_is_rate_limited(manager, clock):
+    client, member = await join(manager, "alice")
+    manager.room_buckets["duck_pond"] = main.TokenBucket(main.ROOM_RATE_PER_SECOND, 0, clock)
+
+    for index in range(20):
+        member.bucket.tokens = member.bucket.burst
+        assert manager.check_incoming(member, f"line {index}", True) == main.FLOOD_DROP
+    await settle()
+    assert client.texts().count("System: Room is busy, message dropped") == 1
+
+    clock.advance(main.ROOM_BUSY_NOTICE_SECONDS)
+    manager.room_buckets["duck_pond"].tokens = 0
+    manager.check_incoming(member, "again", True)
+    await settle()
+    assert client.texts().count("System: Room is busy, message dropped") == 2
+
+
+async def test_repeat_offender_is_disconnected(manager):
+    _, member = await join(manager, "alice")
+    member.bucket.tokens = 0
+    results = [manager.check_incoming(member, "spam", True) for _ in range(main.FLOOD_DISCONNECT_AFTER)]
+    assert results[-1] == main.FLOOD_DISCONNECT
@@ -0,0 +1,40 @@
+"""การตรวจ heartbeat ของ connection / The connection heartbeat sweep"""
+
+import pytest
+
+import main
+from tests.conftest import FakeClient, settle
+
+pytestmark = pytest.mark.anyio
+
+
+async def join(manager, room, name, heartbeat):
+    client = FakeClient()
+    await manager.connect(client.websocket, room, name, heartbeat=heartbeat)
+    return client
+
+
+async def test_only_opted_in_clients_are_pinged_and_reaped(manager, clock):
+    legacy = await join(manager, "duck_pond", "legacy", heartbeat=False)
+    modern = await join(manager, "duck_pond", "modern", heartbeat=True)
+
+    for _ in range(main.HEARTBEAT_MISSES + 1):
+        clock.advance(main.HEARTBEAT_INTERVAL_SECONDS)
+        await manager.sweep_connections()
+        await settle()
+
+    assert "System: PING" in modern.texts()
+    assert "System: PING" not in legacy.texts()
+    assert modern.closed == [1001]
+    assert legacy.closed == []
+    assert manager.get_member(legacy.websocket) is not None
+
+
+async def test_any_message_answers_a_ping(manager, clock):
+    client = await join(manager, "duck_pond", "alice", heartbeat=True)
+    for _ in range(main.HEARTBEAT_MISSES + 2):
+        clock.advance(main.HEARTBEAT_INTERVAL_SECONDS)
+        await manager.sweep_connections()
+        manager.seen(manager.get_member(client.websocket))
+    await settle()
+    assert client.closed == []
@@ -0,0 +1,46 @@
+"""ring buffer ของประวัติแชทและการ replay / The chat history ring buffer and replay"""
+
+import pytest
+
+import main
+from tests.conftest import FakeClient, settle
+
+pytestmark = pytest.mark.anyio
+
+
+def frame(text):
+    return main.OutboundFrame(text)
+
+
+def test_ring_buffer_evicts_oldest_by_count(monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_MAX_MESSAGES", 3)
+    history = main.RoomHistory()
+    for index in range(5):
+        history.append(frame(f"line {index}"))
+    assert [item.text for item in history.recent()] == ["line 2", "line 3", "line 4"]
+    assert history.size == sum(history.sizes)
+
+
+def test_ring_buffer_evicts_oldest_by_bytes(monkeypatch):
+    monkeypatch.setattr(main, "HISTORY_MAX_BYTES", frame("x" * 10).size * 2)
+    history = main.RoomHistory()
+    for letter in "abc":
+        history.append(frame(letter * 10))
+    history.append(frame("y" * 10_000))
+    assert [item.text[0] for item in history.recent()] == ["b", "c"]
+
+
+async def test_replay_since_sends_only_missed_lines(manager):
+    manager.create_room("taxi_a", 3, "taxi")
+    for index in range(4):
+        await manager.broadcast(f"bob: {index}", "taxi_a", record=True)
+    seen = manager.history["taxi_a"].recent()[1].seq
+
+    full = FakeClient()
+    await manager.connect(full.websocket, "taxi_a", "alice")
+    partial = FakeClient()
+    await manager.connect(partial.websocket, "taxi_a", "carol", since=seen)
+    await settle()
+
+    assert [line for line in full.texts() if line.startswith("bob:")] == [f"bob: {i}" for i in range(4)]
+    assert [line for line in partial.texts() if line.startswith("bob:")] == ["bob: 2", "bob: 3"]
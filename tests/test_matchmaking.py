@@ -0,0 +1,81 @@
+"""คิวรอห้องของผู้โดยสาร (FIFO) / The passenger matching queue (FIFO)"""
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+async def expire(manager, clock, room):
+    """ให้ timer ของห้องทำงานจนย้ายไป ped_pong / Let a room's timer fire its move to ped_pong"""
+    clock.advance_to(manager.scheduler.deadline(room))
+    await manager.scheduler.run_due()
+
+
+async def test_fifo_order_fills_room(manager):
+    manager.create_room("taxi_a", 2, "taxi")
+    first = manager.enqueue_passenger("alice", "taxi")
+    second = manager.enqueue_passenger("bob", "taxi")
+    third = manager.enqueue_passenger("carol", "taxi")
+
+    assert (first.status, first.room) == (main.TICKET_ASSIGNED, "taxi_a")
+    assert (second.status, second.room) == (main.TICKET_ASSIGNED, "taxi_a")
+    assert third.status == main.TICKET_WAITING
+    assert manager.ticket_status(third)["position"] == 1
+
+
+async def test_same_user_gets_existing_ticket(manager):
+    ticket = manager.enqueue_passenger("alice", "taxi")
+    assert manager.enqueue_passenger("alice", "taxi") is ticket
+
+
+async def test_newest_room_is_filled_first(manager, clock):
+    manager.create_room("older", 4, "taxi")
+    clock.advance(30)
+    manager.create_room("newer", 4, "taxi")
+    assert manager.enqueue_passenger("alice", "taxi").room == "newer"
+
+
+async def test_room_about_to_move_is_skipped(manager, clock):
+    manager.create_room("closing", 4, "taxi")
+    clock.advance(main.ROOM_LIFETIME_SECONDS - main.ROOM_WARNING_SECONDS)
+    assert manager.enqueue_passenger("alice", "taxi").status == main.TICKET_WAITING
+
+
+@pytest.mark.parametrize("deadline", [main.ACTION_WARN, main.ACTION_TRANSITION])
+async def test_random_stream_and_queue_agree_on_closing_rooms(manager, clock, deadline):
+    manager.create_room("closing", 4, "taxi")
+    assert manager.get_random_active_room("taxi", "passenger")["room"] == "closing"
+
+    clock.advance_to(manager.scheduler.deadline("closing", deadline))
+    await manager.scheduler.run_due()
+    assert manager.get_random_active_room("taxi", "passenger") is None
+    assert manager.room_view("closing") is None
+    assert manager.enqueue_passenger("alice", "taxi").status == main.TICKET_WAITING
+
+    # เลื่อนเวลาออกไปแล้วรับคนได้อีก / Rescheduled far enough out, it boards again
+    manager.schedule_room_transition("closing", main.ROOM_LIFETIME_SECONDS)
+    assert manager.get_random_active_room("taxi", "passenger")["room"] == "closing"
+
+
+async def test_room_that_already_moved_is_skipped(manager, clock):
+    manager.create_room("old", 4, "taxi")
+    await expire(manager, clock, "old")
+    assert manager.get_time_remaining("old") is None
+
+    ticket = manager.enqueue_passenger("alice", "taxi")
+    assert ticket.status == main.TICKET_WAITING
+
+    manager.create_room("fresh", 4, "taxi")
+    manager._run_matches()
+    assert ticket.room == "fresh"
+    assert manager.ticket_status(ticket)["time_remaining"] is not None
+
+
+async def test_cancel_releases_held_seat(manager):
+    manager.create_room("taxi_a", 1, "taxi")
+    ticket = manager.enqueue_passenger("alice", "taxi")
+    assert manager.get_room_count("taxi_a") == 1
+    manager.cancel_ticket(ticket)
+    assert manager.get_room_count("taxi_a") == 0
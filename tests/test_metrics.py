@@ -0,0 +1,35 @@
+"""Prometheus text format ของ /metrics / The /metrics Prometheus text format"""
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+def test_label_values_are_escaped():
+    metrics = main.PrometheusMetrics()
+    text = metrics.render([
+        ("drivechat_rooms", "gauge", "Rooms", [({"transport_type": 'a"b\\c\nd'}, 1)]),
+    ])
+    assert 'drivechat_rooms{transport_type="a\\"b\\\\c\\nd"} 1' in text.splitlines()
+
+
+def test_counters_render_with_labels():
+    metrics = main.PrometheusMetrics()
+    metrics.inc("drivechat_moderation_messages_total", label=("result", "masked"))
+    metrics.inc("drivechat_moderation_messages_total", 2, label=("result", "masked"))
+    assert 'drivechat_moderation_messages_total{result="masked"} 3' in metrics.render([]).splitlines()
+
+
+async def test_unknown_transport_type_is_rejected():
+    with pytest.raises(HTTPException) as raised:
+        await main.create_room(main.RoomCreate(
+            room_name="x", capacity=4, creator_type="driver", transport_type='taxi"}\nfake 1',
+        ))
+    assert raised.value.status_code == 400
+    assert "x" not in main.manager.available_rooms
+
+    with pytest.raises(HTTPException):
+        await main.join_queue(main.QueueJoin(username="alice", user_type="passenger", transport_type="rocket"))
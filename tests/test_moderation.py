@@ -0,0 +1,76 @@
+"""ตัวกรองข้อความแชท / Chat-line moderation"""
+
+import asyncio
+import time
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("what the SHIT", "what the ****"),
+    ("ไอ้ควายเอ๊ย", "ไอ้****เอ๊ย"),
+    ("first class seat", None),
+    ("bass guitar", None),
+    ("ass, then more ass.", "***, then more ***."),
+])
+def test_mask(text, expected):
+    matcher = main.WordMatcher(["shit", "ควาย", "ass"])
+    assert matcher.mask(text) == expected
+
+
+def test_overlapping_terms_are_all_found():
+    # คำไทยไม่ต้องตรงขอบคำ จึงซ้อนกันได้ / Thai terms need no boundary, so they can overlap
+    matcher = main.WordMatcher(["กข", "ขกข", "กขค", "ค"])
+    text = "ขกขกขคง"
+    naive = {
+        (start, start + len(word))
+        for word in ("กข", "ขกข", "กขค", "ค") for start in range(len(text)) if text.startswith(word, start)
+    }
+    assert sorted(matcher.find(text)) == sorted(naive)
+    assert matcher.mask(text) == "******ง"
+
+
+def test_latin_overlap_respects_word_boundaries():
+    matcher = main.WordMatcher(["he", "she", "hers"])
+    assert matcher.find("she said hers") == [(0, 3), (9, 13)]
+    assert matcher.find("ushers") == []
+
+
+async def test_review_keeps_order_across_workers():
+    moderator = main.Moderator(main.WordMatcher(["shit"]), main.NullMetrics(), workers=4)
+    lines = [f"line {index}" + (" shit" if index % 3 == 0 else "") for index in range(40)]
+    try:
+        results = await asyncio.gather(*(moderator.review(line) for line in lines))
+    finally:
+        moderator.stop()
+    assert results == [line.replace("shit", "****") for line in lines]
+
+
+async def test_review_bypasses_when_backlog_is_full():
+    metrics = main.PrometheusMetrics()
+    moderator = main.Moderator(main.WordMatcher(["shit"]), metrics, workers=1, max_pending=0)
+    try:
+        assert await moderator.review("shit") == "shit"
+    finally:
+        moderator.stop()
+    assert metrics.counters[("drivechat_moderation_messages_total", ("result", "bypassed"))] == 1
+
+
+async def test_stop_passes_queued_lines_through():
+    metrics = main.PrometheusMetrics()
+    moderator = main.Moderator(main.WordMatcher(["shit"]), metrics, workers=1)
+    # ให้ worker เดียวไม่ว่าง batch จึงยังค้างในคิวของ pool ตอน stop
+    # Keep the only worker busy so the batch is still queued in the pool at stop
+    moderator.pool.submit(time.sleep, 0.2)
+
+    waiters = [asyncio.ensure_future(moderator.review(text)) for text in ("shit happens", "hello")]
+    await asyncio.sleep(0)
+    moderator.stop()
+
+    assert await asyncio.wait_for(asyncio.gather(*waiters), 1) == ["shit happens", "hello"]
+    assert moderator.pending == 0
+    assert metrics.counters[("drivechat_moderation_messages_total", ("result", "bypassed"))] == 2
@@ -0,0 +1,79 @@
+"""protocol แบบมีชนิด (JSON/MessagePack) / The typed protocols (JSON/MessagePack)"""
+
+import json
+
+import pytest
+
+import main
+from tests.conftest import FakeClient
+
+pytestmark = pytest.mark.anyio
+
+
+def offer(query="", subprotocols=()):
+    client = FakeClient(query)
+    client.websocket.scope["subprotocols"] = list(subprotocols)
+    return client.websocket
+
+
+@pytest.mark.parametrize("websocket, expected", [
+    (offer(), (main.PROTOCOL_TEXT, None)),
+    (offer("protocol=json"), (main.PROTOCOL_JSON, None)),
+    (offer("protocol=JSON"), (main.PROTOCOL_JSON, None)),
+    (offer("protocol=xml"), (main.PROTOCOL_TEXT, None)),
+    (offer(subprotocols=["chat", "drivechat.v1.json"]), (main.PROTOCOL_JSON, "drivechat.v1.json")),
+    (offer("protocol=json", ["drivechat.v1.msgpack"]), (main.PROTOCOL_MSGPACK, "drivechat.v1.msgpack")),
+])
+def test_negotiate_protocol(websocket, expected):
+    assert main.negotiate_protocol(websocket) == expected
+
+
+def test_msgpack_falls_back_to_json_without_the_package(monkeypatch):
+    monkeypatch.setattr(main, "msgpack", None)
+    assert main.negotiate_protocol(offer(subprotocols=["drivechat.v1.msgpack"])) == (main.PROTOCOL_TEXT, None)
+    assert main.negotiate_protocol(offer("protocol=msgpack")) == (main.PROTOCOL_JSON, None)
+
+
+def sample_frames():
+    chat = main.OutboundFrame("alice: hi", main.FRAME_CHAT, ("chat", {"u": "alice", "m": "hi"}))
+    chat.room, chat.seq = "taxi_a", 7
+    system = main.OutboundFrame("System: bob has joined the chat")
+    system.room = "ped_pong#2"
+    return [chat, system]
+
+
+def test_json_batch_is_an_array_of_the_single_envelopes():
+    frames = sample_frames()
+    batch = main.batch_message(frames, main.PROTOCOL_JSON)
+    singles = [json.loads(frame.message_for(main.PROTOCOL_JSON)["text"]) for frame in frames]
+    assert json.loads(batch["text"]) == singles
+    assert singles[0]["t"] == "chat" and singles[0]["s"] == 7 and singles[0]["d"]["m"] == "hi"
+    # ชื่อ shard ไม่หลุดไปถึง client / Shard names never reach the client
+    assert singles[1]["r"] == "ped_pong"
+
+
+@pytest.mark.parametrize("count", [2, 16, 70000])
+def test_msgpack_batch_header_matches_the_count(count):
+    msgpack = pytest.importorskip("msgpack")
+    frames = [main.OutboundFrame(f"line {index}") for index in range(count)]
+    decoded = msgpack.unpackb(main.batch_message(frames, main.PROTOCOL_MSGPACK)["bytes"])
+    assert len(decoded) == count
+    assert decoded[-1] == msgpack.unpackb(frames[-1].message_for(main.PROTOCOL_MSGPACK)["bytes"])
+
+
+async def test_typed_client_messages_map_to_legacy_text():
+    inbox = [
+        {"type": "websocket.receive", "text": json.dumps({"t": "chat", "d": {"m": "hello"}})},
+        {"type": "websocket.receive", "text": json.dumps({"t": "who"})},
+        {"type": "websocket.receive", "text": "plain words"},
+        {"type": "websocket.receive", "text": json.dumps({"t": "dance"})},
+    ]
+    client = FakeClient()
+    await client.websocket.accept()
+
+    async def receive():
+        return inbox.pop(0)
+
+    client.websocket._receive = receive
+    results = [await main.receive_client_text(client.websocket, main.PROTOCOL_JSON) for _ in range(4)]
+    assert results == ["hello", "/who", "plain words", None]
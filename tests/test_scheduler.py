@@ -0,0 +1,73 @@
+"""ตัวจับเวลากลางแบบ heap / The heap-based room scheduler"""
+
+import asyncio
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+
+def make_scheduler(clock, fired):
+    async def handler(room, action):
+        fired.append((room, action))
+
+    return main.RoomScheduler(handler, clock, autorun=False)
+
+
+async def test_due_entries_fire_in_deadline_order(clock):
+    fired = []
+    scheduler = make_scheduler(clock, fired)
+    scheduler.schedule("late", main.ACTION_TRANSITION, 30)
+    scheduler.schedule("early", main.ACTION_TRANSITION, 10)
+    scheduler.schedule("early", main.ACTION_WARN, 5)
+
+    clock.advance(10)
+    assert await scheduler.run_due() == 2
+    assert fired == [("early", main.ACTION_WARN), ("early", main.ACTION_TRANSITION)]
+    assert scheduler.next_deadline() == 30
+
+
+async def test_reschedule_replaces_the_old_deadline(clock):
+    fired = []
+    scheduler = make_scheduler(clock, fired)
+    scheduler.schedule("room", main.ACTION_TRANSITION, 10)
+    scheduler.schedule("room", main.ACTION_TRANSITION, 20)
+    assert scheduler.deadline("room") == 20
+
+    clock.advance(15)
+    assert await scheduler.run_due() == 0
+    clock.advance(5)
+    assert await scheduler.run_due() == 1
+
+
+async def test_cancel_is_lazy_and_compacts(clock):
+    fired = []
+    scheduler = make_scheduler(clock, fired)
+    for index in range(100):
+        scheduler.schedule(f"room{index}", main.ACTION_TRANSITION, index + 1)
+    for index in range(99):
+        scheduler.cancel(f"room{index}")
+
+    assert scheduler.deadline("room0") is None
+    assert len(scheduler.heap) < 100
+    clock.advance(1000)
+    assert await scheduler.run_due() == 1
+    assert fired == [("room99", main.ACTION_TRANSITION)]
+
+
+async def test_runner_keeps_handler_tasks_until_done():
+    done = asyncio.Event()
+
+    async def handler(room, action):
+        await done.wait()
+
+    scheduler = main.RoomScheduler(handler)
+    scheduler.schedule("room", main.ACTION_TRANSITION, 0)
+    await asyncio.sleep(0.01)
+    assert len(scheduler.running) == 1
+    done.set()
+    await asyncio.sleep(0.01)
+    assert not scheduler.running
+    scheduler.task.cancel()
@@ -0,0 +1,87 @@
+"""resume token และช่วง grace หลัง connection หลุด / Resume tokens and the grace period after a drop"""
+
+import pytest
+
+from tests.conftest import FakeClient, settle
+
+pytestmark = pytest.mark.anyio
+
+
+async def join(manager, room, name, resumable=True, since=None):
+    client = FakeClient()
+    await manager.connect(client.websocket, room, name, resumable=resumable, since=since)
+    await settle()
+    return client
+
+
+def token_of(client):
+    for line in client.texts():
+        if line.startswith("System: SESSION:"):
+            return line[len("System: SESSION:"):]
+    return None
+
+
+async def test_token_is_opt_in(manager):
+    legacy = await join(manager, "duck_pond", "legacy", resumable=False)
+    modern = await join(manager, "duck_pond", "modern")
+    assert token_of(legacy) is None
+    assert token_of(modern)
+
+
+@pytest.mark.parametrize("grace", [False, True])
+async def test_leave_is_immediate_without_grace(manager, grace):
+    bob = await join(manager, "duck_pond", "bob")
+    # ไม่มี token: หลุดแล้วออกทันทีแม้ได้ grace / No token: a drop leaves at once even with grace
+    alice = await join(manager, "duck_pond", "alice", resumable=not grace)
+    await manager.disconnect(alice.websocket, grace=grace)
+    await settle()
+    assert "System: alice has left the chat" in bob.texts()
+    assert manager.get_room_count("duck_pond") == 1
+
+
+async def test_drop_keeps_seat_and_resumes_silently(manager):
+    manager.create_room("taxi_a", 2, "taxi")
+    bob = await join(manager, "taxi_a", "bob")
+    alice = await join(manager, "taxi_a", "alice")
+    token = token_of(alice)
+
+    await manager.disconnect(alice.websocket, grace=True)
+    await manager.broadcast("bob: missed", "taxi_a", record=True)
+    await settle()
+    assert manager.get_room_count("taxi_a") == 2
+    assert not any("alice has left" in line for line in bob.texts())
+
+    resume = manager.claim_session(token, "alice")
+    assert resume["room"] == "taxi_a" and resume["listed"]
+    back = await join(manager, resume["room"], "alice", since=resume["since"])
+    assert "bob: missed" in back.texts()
+    assert token_of(back) != token
+    assert manager.claim_session(token, "alice") is None
+
+
+async def test_token_belongs_to_its_user(manager):
+    alice = await join(manager, "duck_pond", "alice")
+    await manager.disconnect(alice.websocket, grace=True)
+    assert manager.claim_session(token_of(alice), "mallory") is None
+
+
+async def test_takeover_closes_old_connection(manager):
+    old = await join(manager, "duck_pond", "alice")
+    resume = manager.claim_session(token_of(old), "alice")
+    await settle()
+    assert resume["listed"]
+    assert old.closed == [1000]
+    assert manager.get_member(old.websocket) is None
+
+
+async def test_expired_session_announces_leave(manager):
+    bob = await join(manager, "duck_pond", "bob")
+    alice = await join(manager, "duck_pond", "alice")
+    token = token_of(alice)
+    await manager.disconnect(alice.websocket, grace=True)
+
+    manager._expire_session(token)
+    await settle()
+    assert "System: alice has left the chat" in bob.texts()
+    assert manager.get_room_count("duck_pond") == 1
+    assert manager.claim_session(token, "alice") is None
@@ -0,0 +1,92 @@
+"""การแบ่ง shard ของห้องพิเศษ / Special-room sharding"""
+
+import pytest
+
+import main
+from tests.conftest import FakeClient, settle
+
+pytestmark = pytest.mark.anyio
+
+CAPACITY = 15
+
+
+async def fill(manager, room, count, prefix="u"):
+    clients = []
+    for index in range(count):
+        client = FakeClient()
+        await manager.connect(client.websocket, room, f"{prefix}{index}")
+        clients.append(client)
+    return clients
+
+
+async def test_resolve_room_opens_a_shard_when_full(manager):
+    assert manager.resolve_room("duck_pond") == "duck_pond"
+    await fill(manager, "duck_pond", CAPACITY)
+    shard = manager.resolve_room("duck_pond")
+    assert shard == "duck_pond#2"
+    assert main.logical_room(shard) == "duck_pond"
+    assert manager.shards["duck_pond"] == ["duck_pond", "duck_pond#2"]
+
+
+async def test_group_goes_to_the_tightest_fitting_shard(manager):
+    await fill(manager, "duck_pond", 10, "a")
+    manager._open_shard("duck_pond")
+    await fill(manager, "duck_pond#2", 2, "b")
+    # 4 ที่ว่างใน shard แรก (5) พอดีกว่า shard ที่สอง (13)
+    # The first shard's 5 free seats fit 4 people more tightly than the second's 13
+    assert manager._allocate_seats("duck_pond", 4) == [("duck_pond", 4)]
+    assert manager._allocate_seats("duck_pond", 8) == [("duck_pond#2", 8)]
+
+
+async def test_group_too_big_for_any_shard_is_split(manager):
+    await fill(manager, "duck_pond", 10)
+    plan = manager._allocate_seats("duck_pond", 20)
+    assert sum(seats for _, seats in plan) == 20
+    assert plan[0] == ("duck_pond#2", 15)
+
+
+async def test_allocation_stops_at_max_shards(manager, monkeypatch):
+    monkeypatch.setattr(main, "MAX_SHARDS", 2)
+    plan = manager._allocate_seats("ped_pong", 40)
+    assert sum(seats for _, seats in plan) == 2 * CAPACITY
+
+
+async def test_sparse_shards_merge(manager):
+    await fill(manager, "duck_pond", 3, "a")
+    manager._open_shard("duck_pond")
+    movers = await fill(manager, "duck_pond#2", 2, "b")
+
+    assert await manager.merge_shards("duck_pond") == 2
+    await settle()
+    assert manager.shards["duck_pond"] == ["duck_pond"]
+    assert "duck_pond#2" not in manager.available_rooms
+    assert manager.get_room_count("duck_pond") == 5
+    assert manager.get_member(movers[0].websocket).room == "duck_pond"
+
+
+async def test_busy_shards_do_not_merge(manager):
+    await fill(manager, "duck_pond", 10, "a")
+    manager._open_shard("duck_pond")
+    await fill(manager, "duck_pond#2", 5, "b")
+    assert await manager.merge_shards("duck_pond") == 0
+    assert manager.shards["duck_pond"] == ["duck_pond", "duck_pond#2"]
+
+
+async def test_presence_names_the_logical_room(manager):
+    await fill(manager, "ped_pong", CAPACITY)
+    client = FakeClient()
+    await manager.connect(client.websocket, manager.resolve_room("ped_pong"), "late")
+    manager.presence_changed("ped_pong#2", joined=["late"])
+    await settle()
+    assert not any("ped_pong#2" in line for line in client.texts())
+
+
+async def test_leaving_triggers_a_tracked_merge(manager):
+    clients = await fill(manager, "duck_pond", CAPACITY, "a")
+    await fill(manager, manager.resolve_room("duck_pond"), 1, "b")
+    for client in clients[:10]:
+        await manager.disconnect(client.websocket)
+    await settle()
+    assert manager.shards["duck_pond"] == ["duck_pond"]
+    assert manager.get_room_count("duck_pond") == 6
+    assert not manager.tasks
@@ -0,0 +1,60 @@
+"""snapshot ตอนปิด server และการโหลดคืน / The shutdown snapshot and restore"""
+
+import pytest
+
+import main
+from tests.conftest import FakeClient, settle
+
+pytestmark = pytest.mark.anyio
+
+
+async def join(manager, room, name):
+    client = FakeClient()
+    await manager.connect(client.websocket, room, name)
+    await settle()
+    return client
+
+
+def test_codec_round_trip():
+    state = {"saved_at": 1.5, "rooms": {"taxi_a": {"capacity": 2}}, "members": [["นก", "taxi_a", None, "user"]]}
+    assert main.decode_snapshot(main.encode_snapshot(state)) == state
+
+
+@pytest.mark.parametrize("data", [
+    b"DC",
+    b"XXXX" + main.encode_snapshot({})[4:],
+    main.SNAPSHOT_HEADER.pack(main.SNAPSHOT_MAGIC, main.SNAPSHOT_VERSION + 1),
+    main.SNAPSHOT_HEADER.pack(main.SNAPSHOT_MAGIC, main.SNAPSHOT_VERSION) + b"not zlib",
+])
+def test_codec_rejects_bad_files(data):
+    with pytest.raises(ValueError):
+        main.decode_snapshot(data)
+
+
+async def test_shutdown_snapshot_is_taken_before_members_leave(manager):
+    manager.create_room("taxi_a", 3, "taxi")
+    manager.schedule_room_transition("taxi_a", 60)
+    alice = await join(manager, "taxi_a", "alice")
+    bob = await join(manager, "taxi_a", "bob")
+    await manager.broadcast("alice: hello", "taxi_a", record=True)
+
+    # เหมือน WebSocket แรกที่ได้ 1012 ตอน uvicorn ปิด / As on the first 1012 close during uvicorn shutdown
+    manager.prepare_shutdown()
+    await manager.disconnect(alice.websocket, "taxi_a")
+    await settle()
+    await manager.disconnect(bob.websocket, "taxi_a")
+    assert not any("has left" in line for line in bob.texts())
+    assert "taxi_a" in manager.available_rooms
+
+    state = main.decode_snapshot(main.encode_snapshot(manager.shutdown_snapshot))
+    assert sorted(member[0] for member in state["members"]) == ["alice", "bob"]
+
+    restored = main.ConnectionManager(clock=main.VirtualClock())
+    assert restored.restore(state, downtime=10) == (1, 2)
+    assert restored.get_room_count("taxi_a") == 2
+    assert 45 <= restored.get_time_remaining("taxi_a") <= 50
+
+    assert restored.claim_resume("taxi_a", "alice")["room"] == "taxi_a"
+    assert restored.get_room_count("taxi_a") == 1
+    back = await join(restored, "taxi_a", "alice")
+    assert "alice: hello" in back.texts()
@@ -0,0 +1,138 @@
+"""คิวขาออกต่อ connection (ConnectionWriter) / The per-connection outbound queue (ConnectionWriter)"""
+
+import pytest
+
+import main
+from tests.conftest import FakeClient, settle
+
+pytestmark = pytest.mark.anyio
+
+
+async def make_writer(clock, client=None, **options):
+    client = client or FakeClient()
+    await client.websocket.accept()
+    failures = []
+    latencies = []
+    writer = main.ConnectionWriter(
+        client.websocket, failures.append, on_sent=latencies.append,
+        clock=clock, call_later=clock.call_later, **options,
+    )
+    return client, writer, failures, latencies
+
+
+async def test_latency_runs_from_enqueue_to_completed_send(clock):
+    client, writer, _, latencies = await make_writer(clock)
+    client.hold()
+    writer.start()
+    writer.enqueue(main.OutboundFrame("hello"))
+    await settle()
+    clock.advance(0.25)
+    client.release()
+    await settle()
+    assert client.texts() == ["hello"]
+    assert latencies == [pytest.approx(0.25)]
+    writer.stop()
+
+
+async def test_manager_reports_delivery_latency(manager, clock):
+    client = FakeClient()
+    await manager.connect(client.websocket, "duck_pond", "alice")
+    await settle()
+    client.hold()
+    await manager.broadcast("System: hi", "duck_pond")
+    await settle()
+    clock.advance(0.05)
+    client.release()
+    await settle()
+    stats = manager.broadcast_stats
+    assert stats["last_latency_ms"] == pytest.approx(50)
+    assert stats["last_enqueue_ms"] < 50
+
+
+def frames(writer):
+    return [frame.text for frame in writer.queue]
+
+
+async def test_drop_oldest_keeps_control_frames(clock):
+    _, writer, failures, _ = await make_writer(clock, maxsize=3, policy="drop_oldest")
+    writer.enqueue(main.OutboundFrame("hello", main.FRAME_CONTROL))
+    writer.enqueue(main.OutboundFrame("one"))
+    writer.enqueue(main.OutboundFrame("two"))
+    assert writer.enqueue(main.OutboundFrame("three"))
+    assert frames(writer) == ["hello", "two", "three"]
+    assert len(writer.queued_at) == len(writer.queue)
+    assert writer.dropped == 1 and not failures
+
+
+async def test_queue_of_control_frames_overflows(clock):
+    client, writer, failures, _ = await make_writer(clock, maxsize=1, policy="drop_oldest")
+    writer.enqueue(main.OutboundFrame("hello", main.FRAME_CONTROL))
+    assert not writer.enqueue(main.OutboundFrame("chat"))
+    assert failures == [client.websocket]
+    assert not writer.enqueue(main.OutboundFrame("later"))
+    assert failures == [client.websocket]
+
+
+async def test_coalesce_keeps_only_newest_user_list(clock):
+    _, writer, failures, _ = await make_writer(clock, maxsize=3, policy="coalesce")
+    writer.enqueue(main.OutboundFrame("users 1", main.FRAME_PRESENCE))
+    writer.enqueue(main.OutboundFrame("chat"))
+    writer.enqueue(main.OutboundFrame("users 2", main.FRAME_PRESENCE))
+    assert writer.enqueue(main.OutboundFrame("users 3", main.FRAME_PRESENCE))
+    assert frames(writer) == ["chat", "users 3"]
+    assert len(writer.queued_at) == len(writer.queue)
+    assert not failures
+
+
+async def test_disconnect_policy_fails_on_overflow(clock):
+    client, writer, failures, _ = await make_writer(clock, maxsize=1, policy="disconnect")
+    writer.enqueue(main.OutboundFrame("one"))
+    assert not writer.enqueue(main.OutboundFrame("two"))
+    assert failures == [client.websocket] and writer.failed
+
+
+async def test_stalled_send_times_out_on_the_clock(clock):
+    client, writer, failures, latencies = await make_writer(clock)
+    client.hold()
+    writer.start()
+    writer.enqueue(main.OutboundFrame("stuck"))
+    await settle()
+    clock.advance(main.SEND_TIMEOUT_SECONDS - 0.01)
+    await settle()
+    assert not failures
+
+    clock.advance(0.01)
+    await settle()
+    assert failures == [client.websocket]
+    assert writer.task.done() and not latencies
+    client.release()
+
+
+async def test_failed_send_notifies_once(clock):
+    client, writer, failures, _ = await make_writer(clock)
+    client.error = RuntimeError("socket closed")
+    writer.start()
+    writer.enqueue(main.OutboundFrame("one"))
+    writer.enqueue(main.OutboundFrame("two"))
+    await settle()
+    assert failures == [client.websocket]
+
+
+async def test_stalled_member_is_pruned_from_the_room(manager, clock):
+    alice, bob = FakeClient(), FakeClient()
+    await manager.connect(alice.websocket, "duck_pond", "alice")
+    await manager.connect(bob.websocket, "duck_pond", "bob")
+    await settle()
+    bob.hold()
+
+    await manager.broadcast("alice: anyone there?", "duck_pond")
+    await settle()
+    clock.advance(main.SEND_TIMEOUT_SECONDS)
+    await settle()
+
+    assert bob.websocket not in manager.members
+    assert manager.room_usernames("duck_pond") == ["alice"]
+    assert manager.broadcast_stats["failures"] == 1
+    assert "System: bob has left the chat" in alice.texts()
+    bob.release()
+    await settle()